@@ -0,0 +1,73 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import Optional
+
+from torch import Tensor
+
+from diagnnose.typedefs.activations import ActivationName
+
+
+class ActivationCache:
+    """Least-recently-used cache of activation tensors, bounded by a
+    budget on the total number of bytes that is stored.
+
+    The most recently added activations are always kept, even if they
+    exceed the budget on their own. A budget of 0 therefore stores
+    exactly one activation tensor.
+
+    Parameters
+    ----------
+    max_bytes : int, optional
+        Maximum number of bytes the cached activations may occupy. If
+        set to None activations are never evicted. Defaults to 0.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = 0) -> None:
+        self.max_bytes = max_bytes
+
+        self._cache: "OrderedDict[ActivationName, Tensor]" = OrderedDict()
+        self._lock = Lock()
+
+    def __contains__(self, activation_name: ActivationName) -> bool:
+        return activation_name in self._cache
+
+    def __len__(self) -> int:
+        return len(self._cache)
+
+    @property
+    def nbytes(self) -> int:
+        """ Returns the total number of bytes of the cached tensors. """
+        return sum(self._tensor_bytes(t) for t in self._cache.values())
+
+    def get(self, activation_name: ActivationName) -> Optional[Tensor]:
+        """ Returns the cached activations, or None on a cache miss. """
+        with self._lock:
+            activations = self._cache.get(activation_name, None)
+            if activations is not None:
+                self._cache.move_to_end(activation_name)
+
+        return activations
+
+    def put(self, activation_name: ActivationName, activations: Tensor) -> None:
+        """Adds activations to the cache, and evicts the least recently
+        used activations until the cache fits within its budget.
+        """
+        with self._lock:
+            self._cache[activation_name] = activations
+            self._cache.move_to_end(activation_name)
+
+            if self.max_bytes is None:
+                return
+
+            nbytes = self.nbytes
+            while nbytes > self.max_bytes and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                nbytes -= self._tensor_bytes(evicted)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    @staticmethod
+    def _tensor_bytes(tensor: Tensor) -> int:
+        return tensor.element_size() * tensor.nelement()
@@ -1,8 +1,13 @@
-from typing import Iterable, Optional, Sized
+from typing import Iterable, List, Optional, Sized, Union
 
+import torch
 from torch import Tensor, long
 
-from diagnnose.typedefs.activations import ActivationIndex
+from diagnnose.typedefs.activations import (
+    ActivationIndex,
+    ActivationOffsets,
+    ActivationRanges,
+)
 
 
 def activation_index_to_iterable(
@@ -41,3 +46,84 @@ def activation_index_len(activation_index: ActivationIndex) -> int:
         f"Activation index of incorrect type: {type(activation_index)}, "
         f"should be one of {{int, List[int], np.ndarray or torch.Tensor}}"
     )
+
+
+def activation_index_to_tensor(
+    activation_index: ActivationIndex, stop_index: int
+) -> Tensor:
+    """Transforms an activation index into a 1-d tensor of indices.
+
+    Negative indices are resolved with respect to ``stop_index``.
+    """
+    if isinstance(activation_index, slice):
+        return torch.arange(*activation_index.indices(stop_index))
+
+    if isinstance(activation_index, int):
+        activation_index = [activation_index]
+
+    index_tensor = torch.as_tensor(activation_index, dtype=long).view(-1)
+
+    return torch.where(index_tensor < 0, index_tensor + stop_index, index_tensor)
+
+
+def ranges_to_offsets(activation_ranges: ActivationRanges) -> ActivationOffsets:
+    """ Converts a list of (start, stop) ranges to an offsets tensor. """
+    stops = [stop for _start, stop in activation_ranges]
+
+    return torch.tensor([0] + stops, dtype=long)
+
+
+def offsets_to_ranges(activation_offsets: ActivationOffsets) -> ActivationRanges:
+    """ Converts an offsets tensor to a list of (start, stop) ranges. """
+    offsets = activation_offsets.tolist()
+
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def ranges_to_row_ids(starts: Tensor, stops: Tensor) -> Tensor:
+    """Concatenates the row indices covered by a batch of ranges.
+
+    Vectorized equivalent of
+    ``torch.cat([torch.arange(start, stop) for ...])``.
+    """
+    lengths = stops - starts
+    offsets = torch.cumsum(lengths, 0) - lengths
+
+    return torch.repeat_interleave(starts - offsets, lengths) + torch.arange(
+        int(lengths.sum())
+    )
+
+
+def ranges_to_runs(starts: Tensor, stops: Tensor) -> List[slice]:
+    """Merges a batch of ranges into runs of adjacent ranges.
+
+    A range that does not continue where its predecessor stopped
+    starts a new run. The order of the ranges is preserved, each run
+    covers a contiguous block of rows.
+    """
+    if len(starts) == 0:
+        return []
+
+    run_starts = torch.nonzero(starts[1:] != stops[:-1]).view(-1) + 1
+    start_ids = [0] + run_starts.tolist()
+    stop_ids = [idx - 1 for idx in start_ids[1:]] + [len(starts) - 1]
+
+    return [
+        slice(int(starts[start_idx]), int(stops[stop_idx]))
+        for start_idx, stop_idx in zip(start_ids, stop_ids)
+    ]
+
+
+def ranges_to_row_index(starts: Tensor, stops: Tensor) -> Union[slice, Tensor]:
+    """Creates an index for the rows covered by a batch of ranges.
+
+    Ranges that form a single run of adjacent ranges are indexed by a
+    slice, which allows a contiguous read or write. Otherwise the rows
+    are indexed by a tensor of row indices.
+    """
+    runs = ranges_to_runs(starts, stops)
+
+    if len(runs) == 1:
+        return runs[0]
+
+    return ranges_to_row_ids(starts, stops)
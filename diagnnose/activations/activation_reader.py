@@ -1,16 +1,27 @@
+import json
 import os
 import pickle
-from typing import Optional, Tuple, Union
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from torch import Tensor
 
-from diagnnose.activations.activation_index import activation_index_to_iterable
+from diagnnose.activations.activation_cache import ActivationCache
+from diagnnose.activations.activation_index import (
+    activation_index_to_tensor,
+    offsets_to_ranges,
+    ranges_to_offsets,
+    ranges_to_row_index,
+    ranges_to_runs,
+)
 from diagnnose.typedefs.activations import (
     ActivationDict,
     ActivationKey,
     ActivationName,
     ActivationNames,
+    ActivationOffsets,
     ActivationRanges,
     SelectionFunc,
 )
@@ -18,11 +29,12 @@ from diagnnose.utils.pickle import load_pickle
 
 
 class ActivationReader:
-    """Reads in pickled activations that have been extracted.
+    """Reads in activations that have been extracted.
 
     An ``ActivationReader`` can also be created directly from an
     ``ActivationDict``, in which case the corresponding
-    ``ActivationRanges`` and ``SelectionFunc`` should be provided too.
+    ``ActivationOffsets`` (or ``ActivationRanges``) and
+    ``SelectionFunc`` should be provided too.
 
     Parameters
     ----------
@@ -34,20 +46,27 @@ class ActivationReader:
         provided directly as well.
     activation_names : ActivationNames, optional
         Activation names, provided as a list of ``(layer, name)``
-        tuples. If not provided the index to
+        tuples. If not provided these are inferred from the manifest
+        of ``activations_dir``. If they can not be inferred the index to
         :func:`~diagnnose.activations.ActivationReader.__getitem__`
         must always contain the activation_name that is being requested,
         as the ``ActivationReader`` can not infer it automatically.
     activation_ranges : ActivationRanges, optional
-        ``ActivationRanges`` dictionary that should be provided if
+        ``ActivationRanges`` list that can be provided if
         ``activation_dict`` is passed directly.
+    activation_offsets : ActivationOffsets, optional
+        ``ActivationOffsets`` tensor that can be provided instead of
+        ``activation_ranges`` if ``activation_dict`` is passed directly.
     selection_func : SelectionFunc, optional
         ``SelectionFunc`` that was used for extraction and that should
         be passed if ``activation_dict`` is passed directly.
-    store_multiple_activations : bool, optional
-        Set to true to store multiple activation arrays in RAM at once.
-        Defaults to False, meaning that only one activation type will be
-        stored in the class.
+    cache_size : int, optional
+        Maximum number of bytes that is used to keep activations that
+        are read from disk in RAM. Activations are evicted in a
+        least-recently-used order, but the most recently read
+        activations are always kept. Set to None to never evict
+        activations. Defaults to 0, meaning that only one activation
+        type will be stored in the class.
     cat_activations : bool, optional
         Toggle to concatenate the activations returned by
         :func:`~diagnnose.activations.ActivationReader.__getitem__`.
@@ -61,8 +80,9 @@ class ActivationReader:
         activation_dict: Optional[ActivationDict] = None,
         activation_names: Optional[ActivationNames] = None,
         activation_ranges: Optional[ActivationRanges] = None,
+        activation_offsets: Optional[ActivationOffsets] = None,
         selection_func: Optional[SelectionFunc] = None,
-        store_multiple_activations: bool = False,
+        cache_size: Optional[int] = 0,
         cat_activations: bool = False,
     ) -> None:
         if activations_dir is not None:
@@ -74,21 +94,29 @@ class ActivationReader:
             ), "activations_dir and activations_dict can not be provided simultaneously"
         else:
             assert activation_dict is not None
-            assert activation_ranges is not None
+            assert activation_ranges is not None or activation_offsets is not None
             assert selection_func is not None
 
+        if activation_ranges is not None:
+            activation_offsets = ranges_to_offsets(activation_ranges)
+
         self.activations_dir = activations_dir
         self.activation_dict: ActivationDict = activation_dict or {}
-        self.activation_names: ActivationNames = activation_names or list(
-            self.activation_dict.keys()
+        self.activation_names: ActivationNames = (
+            activation_names or self._default_activation_names()
         )
 
+        self._activation_offsets: Optional[ActivationOffsets] = activation_offsets
         self._activation_ranges: Optional[ActivationRanges] = activation_ranges
         self._selection_func: Optional[SelectionFunc] = selection_func
 
-        self.store_multiple_activations = store_multiple_activations
+        self.cache = ActivationCache(cache_size)
         self.cat_activations = cat_activations
 
+        self._activation_memmaps: Dict[ActivationName, np.memmap] = {}
+        self._prefetch_executor: Optional[ThreadPoolExecutor] = None
+        self._prefetches: Dict[ActivationName, Future] = {}
+
     def __getitem__(self, key: ActivationKey) -> Union[Tensor, Tuple[Tensor, ...]]:
         """Allows for concise and efficient indexing of activations.
 
@@ -104,6 +132,9 @@ class ActivationReader:
         The return value is a tuple of tensors, with each tensor of
         shape (sen_len, nhid).
 
+        Only the rows of the requested sentences are read from disk,
+        the full activation matrix is not loaded into memory.
+
         Example usage:
 
         .. code-block:: python
@@ -145,31 +176,60 @@ class ActivationReader:
             index = key
             activation_name = self.activation_names[0]
 
-        iterable_index = activation_index_to_iterable(
-            index, len(self.activation_ranges)
-        )
-        ranges = [self.activation_ranges[idx] for idx in iterable_index]
+        sen_ids = activation_index_to_tensor(index, self.num_sentences)
+        starts = self.activation_offsets[sen_ids]
+        stops = self.activation_offsets[sen_ids + 1]
 
-        sen_indices = torch.cat([torch.arange(*r) for r in ranges]).to(torch.long)
-        activations = self.activations(activation_name)[sen_indices]
+        activations = self._read_rows(activation_name, starts, stops)
 
         if self.cat_activations:
             return activations
 
-        lengths = [x[1] - x[0] for x in ranges]
+        lengths = (stops - starts).tolist()
         split_activations: Tuple[Tensor, ...] = torch.split(activations, lengths)
 
         return split_activations
 
     def __len__(self) -> int:
         """ Returns total number of extracted activations. """
-        return self.activation_ranges[-1][1]
+        return int(self.activation_offsets[-1])
+
+    @property
+    def num_sentences(self) -> int:
+        """ Returns the number of sentences that have been extracted. """
+        return len(self.activation_offsets) - 1
+
+    def _default_activation_names(self) -> ActivationNames:
+        """Infers the activation names from the activation_dict, or from
+        the store manifest if activations are read from disk.
+        """
+        if self.activations_dir is not None:
+            manifest_path = os.path.join(self.activations_dir, "manifest.json")
+            if os.path.exists(manifest_path):
+                with open(manifest_path) as f:
+                    manifest = json.load(f)
+                return [(a["layer"], a["name"]) for a in manifest["activations"]]
+
+        return list(self.activation_dict.keys())
+
+    @property
+    def activation_offsets(self) -> ActivationOffsets:
+        if self._activation_offsets is None:
+            offsets_path = os.path.join(self.activations_dir, "activation_offsets.npy")
+            if os.path.exists(offsets_path):
+                self._activation_offsets = torch.from_numpy(np.load(offsets_path))
+            else:
+                # Older stores contain a pickled list of activation ranges.
+                ranges_path = os.path.join(
+                    self.activations_dir, "activation_ranges.pickle"
+                )
+                self._activation_offsets = ranges_to_offsets(load_pickle(ranges_path))
+        return self._activation_offsets
 
     @property
     def activation_ranges(self) -> ActivationRanges:
         if self._activation_ranges is None:
-            ranges_path = os.path.join(self.activations_dir, "activation_ranges.pickle")
-            self._activation_ranges = load_pickle(ranges_path)
+            self._activation_ranges = offsets_to_ranges(self.activation_offsets)
         return self._activation_ranges
 
     @property
@@ -182,18 +242,118 @@ class ActivationReader:
         return self._selection_func
 
     def activations(self, activation_name: ActivationName) -> Tensor:
-        activations = self.activation_dict.get(activation_name, None)
+        """Returns the full activation matrix of ``activation_name``.
+
+        Activations that are read from disk are kept in the cache of
+        the reader, or retrieved from a pending prefetch.
+        """
+        activations = self._in_memory_activations(activation_name)
 
         if activations is None:
-            activations = self._read_activations(activation_name)
-            if not self.store_multiple_activations:
-                self.activation_dict = {}  # reset activation_dict
-            self.activation_dict[activation_name] = activations
+            prefetch = self._prefetches.pop(activation_name, None)
+            if prefetch is not None:
+                activations = prefetch.result()
+            else:
+                activations = self._read_activations(activation_name)
+            self.cache.put(activation_name, activations)
 
         return activations
 
+    def prefetch(self, activation_name: ActivationName) -> None:
+        """Starts reading the activations of ``activation_name`` in a
+        background thread.
+
+        This allows the next activations to be read while the current
+        ones are being processed. The prefetched activations are added
+        to the cache once they are requested by ``activations``.
+        """
+        if (
+            self._in_memory_activations(activation_name) is not None
+            or activation_name in self._prefetches
+        ):
+            return
+
+        if self._prefetch_executor is None:
+            self._prefetch_executor = ThreadPoolExecutor(max_workers=1)
+
+        self._prefetches[activation_name] = self._prefetch_executor.submit(
+            self._read_activations, activation_name
+        )
+
+    def _in_memory_activations(
+        self, activation_name: ActivationName
+    ) -> Optional[Tensor]:
+        """ Returns the activations if these are already stored in RAM. """
+        activations = self.activation_dict.get(activation_name, None)
+        if activations is None:
+            activations = self.cache.get(activation_name)
+
+        return activations
+
+    def _read_rows(
+        self, activation_name: ActivationName, starts: Tensor, stops: Tensor
+    ) -> Tensor:
+        """Reads the activation rows that are covered by a batch of
+        (start, stop) ranges.
+
+        Ranges that are adjacent are merged into runs, and each run is
+        read from the memory-mapped file as a single contiguous block.
+        Activations that are already stored in memory are indexed
+        directly.
+
+        Parameters
+        ----------
+        activation_name : ActivationName
+            (layer, name) tuple indicating the activations to be read.
+        starts : Tensor
+            Start row of each range.
+        stops : Tensor
+            Stop row of each range.
+
+        Returns
+        -------
+        activations : Tensor
+            Tensor containing the concatenated rows of each range.
+        """
+        activations = self._in_memory_activations(activation_name)
+        if activations is None:
+            activations = self._open_memmap(activation_name)
+        if activations is None:
+            activations = self.activations(activation_name)
+
+        if isinstance(activations, np.ndarray):
+            runs = ranges_to_runs(starts, stops)
+            if len(runs) == 0:
+                return torch.from_numpy(np.array(activations[:0]))
+
+            return torch.from_numpy(np.concatenate([activations[run] for run in runs]))
+
+        return activations[ranges_to_row_index(starts, stops)]
+
+    def _open_memmap(self, activation_name: ActivationName) -> Optional[np.memmap]:
+        """Opens a read-only memory map of an activation file.
+
+        Returns None if activations have not been stored as a ``.npy``
+        file.
+        """
+        if activation_name in self._activation_memmaps:
+            return self._activation_memmaps[activation_name]
+
+        if self.activations_dir is None:
+            return None
+
+        layer, name = activation_name
+        filename = os.path.join(self.activations_dir, f"{layer}-{name}.npy")
+        if not os.path.exists(filename):
+            return None
+
+        activation_memmap = np.load(filename, mmap_mode="r")
+        self._activation_memmaps[activation_name] = activation_memmap
+
+        return activation_memmap
+
     def _read_activations(self, activation_name: ActivationName) -> Tensor:
-        """Reads the pickled activations of activation_name
+        """Reads the activations of activation_name into memory.
 
         Parameters
         ----------
@@ -206,6 +366,20 @@ class ActivationReader:
             Torch tensor of activation values
         """
         layer, name = activation_name
+        filename = os.path.join(self.activations_dir, f"{layer}-{name}.npy")
+
+        if not os.path.exists(filename):
+            return self._read_pickled_activations(activation_name)
+
+        activations = torch.from_numpy(np.load(filename))
+
+        return activations
+
+    def _read_pickled_activations(self, activation_name: ActivationName) -> Tensor:
+        """Reads activations that have been stored as a sequential
+        pickle dump, as was done by older versions of the library.
+        """
+        layer, name = activation_name
         filename = os.path.join(self.activations_dir, f"{layer}-{name}.pickle")
 
         activations = None
@@ -1,121 +1,391 @@
+import json
 import os
-import pickle
 import warnings
-from contextlib import ExitStack
-from typing import BinaryIO, Optional
+from queue import Queue
+from threading import Thread
+from time import perf_counter
+from typing import List, Optional, Tuple
 
 import dill
+import numpy as np
+import torch
+from torch import Tensor
 
+from diagnnose.activations.activation_index import ranges_to_runs
+from diagnnose.config import DTYPE
 from diagnnose.typedefs.activations import (
     ActivationDict,
     ActivationFiles,
     ActivationNames,
-    ActivationRanges,
+    ActivationOffsets,
     SelectionFunc,
+    SizeDict,
 )
-from diagnnose.utils.pickle import dump_pickle
 
-from .activation_reader import ActivationReader
+# Batch activations and sentence ids of a queued write.
+_WriteItem = Tuple[ActivationDict, List[int]]
 
 
 class ActivationWriter:
-    """Writes activations to file, using an ExitStack.
+    """Writes activations to a preallocated, memory-mapped store.
+
+    Each activation name is written to its own ``.npy`` file, of shape
+    ``num_items x nhid``. As the total number of extracted activations
+    is known in advance, each file is allocated up front and batches
+    are written directly to their offset in the file. The layout of the
+    store is described by a JSON manifest.
+
+    Writing can be performed by a background thread, that consumes
+    batches from a bounded queue. This allows the disk I/O of a batch
+    to overlap with the forward pass of the next batch.
 
     Parameters
     ----------
     activations_dir : str, optional
         Directory to which activations will be written
+    queue_size : int, optional
+        Maximum number of batches that can be queued for the background
+        writer. If set to 0 batches are written directly, without a
+        background thread. Defaults to 0.
 
     Attributes
     ----------
     activations_dir : str
     activation_names : List[tuple[int, str]]
         List of (layer, activation_name) tuples
+    activation_offsets : ActivationOffsets
+        Offsets of the activations of each sentence in the store.
     activation_files : ActivationFiles
-        Dict of files to which activations will be written.
+        Dict of memory-mapped arrays to which activations are written.
+    progress : np.memmap, optional
+        Memory-mapped array that marks the sentences of which the
+        activations have been committed to disk.
+    producer_stall_time : float
+        Total time in seconds the producer has been blocked on a full
+        queue, a large value indicates writing is the bottleneck.
+    consumer_stall_time : float
+        Total time in seconds the background writer has been waiting
+        on an empty queue, a large value indicates the forward pass is
+        the bottleneck.
     """
 
-    def __init__(self, activations_dir: str) -> None:
+    def __init__(self, activations_dir: str, queue_size: int = 0) -> None:
         self.activations_dir = activations_dir
+        self.queue_size = queue_size
 
         self.activation_names: ActivationNames = []
         self.activation_files: ActivationFiles = {}
-        self.activation_ranges_file: Optional[BinaryIO] = None
-        self.selection_func_file: Optional[BinaryIO] = None
+        self.activation_offsets: ActivationOffsets = torch.zeros(1, dtype=torch.long)
+        self.num_items: int = 0
+        self.dtype: torch.dtype = DTYPE
+        self.progress: Optional[np.memmap] = None
+
+        self.producer_stall_time: float = 0.0
+        self.consumer_stall_time: float = 0.0
+
+        self._queue: Optional["Queue[Optional[_WriteItem]]"] = None
+        self._writer_thread: Optional[Thread] = None
+        self._writer_error: Optional[BaseException] = None
 
     def create_output_files(
-        self, stack: ExitStack, activation_names: ActivationNames
+        self,
+        activation_names: ActivationNames,
+        sizes: SizeDict,
+        activation_offsets: ActivationOffsets,
+        dtype: torch.dtype = DTYPE,
+        resume: bool = False,
     ) -> None:
-        """ Opens a file for each to-be-extracted activation. """
+        """Allocates a memory-mapped file for each activation name.
+
+        The manifest, activation offsets and a per-sentence progress
+        file are written directly, which allows an interrupted run to
+        be resumed later on.
+
+        Parameters
+        ----------
+        activation_names : ActivationNames
+            List of (layer, name) tuples that will be extracted.
+        sizes : SizeDict
+            Dictionary mapping each activation name to its hidden size.
+        activation_offsets : ActivationOffsets
+            Offsets of the activations of each sentence in the store.
+        dtype : torch.dtype, optional
+            Dtype in which the activations are stored. Defaults to
+            ``DTYPE``.
+        resume : bool, optional
+            Reopen the files of an existing store, if these match the
+            current extraction setup. If the existing store can't be
+            resumed a fresh store is created. Defaults to False.
+        """
         self.activation_names = activation_names
+        self.activation_offsets = activation_offsets
+        self.num_items = int(activation_offsets[-1])
+        self.dtype = dtype
 
         if not os.path.exists(self.activations_dir):
             os.makedirs(self.activations_dir)
 
-        if os.listdir(self.activations_dir):
+        if resume:
+            if self._open_existing_files(sizes, activation_offsets):
+                return
+            warnings.warn(
+                "Unable to resume from %s, starting a new extraction"
+                % self.activations_dir
+            )
+        elif os.listdir(self.activations_dir):
             warnings.warn("Output directory %s is not empty" % self.activations_dir)
 
         self.activation_files = {
-            (layer, name): stack.enter_context(
-                open(os.path.join(self.activations_dir, f"{layer}-{name}.pickle"), "wb")
+            (layer, name): np.lib.format.open_memmap(
+                self._activation_path(layer, name),
+                mode="w+",
+                dtype=self._np_dtype,
+                shape=(self.num_items, sizes[layer, name]),
             )
             for (layer, name) in self.activation_names
         }
-
-        self.activation_ranges_file = stack.enter_context(
-            open(os.path.join(self.activations_dir, "activation_ranges.pickle"), "wb")
-        )
-        self.selection_func_file = stack.enter_context(
-            open(os.path.join(self.activations_dir, "selection_func.dill"), "wb")
+        self.progress = np.lib.format.open_memmap(
+            os.path.join(self.activations_dir, "progress.npy"),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(len(activation_offsets) - 1,),
         )
 
-    def dump_activations(self, activations: ActivationDict) -> None:
-        """Dumps the generated activations to a list of opened files
+        offsets_path = os.path.join(self.activations_dir, "activation_offsets.npy")
+        np.save(offsets_path, activation_offsets.numpy())
+
+        self._dump_manifest(complete=False)
+
+    def completed_sentences(self) -> Tensor:
+        """Returns a boolean mask of the sentences of which the
+        activations have been committed to the store.
+        """
+        if self.progress is None:
+            return torch.zeros(0, dtype=torch.bool)
+
+        return torch.from_numpy(self.progress.astype(bool))
+
+    @property
+    def queue_depth(self) -> int:
+        """ Returns the number of batches that are waiting to be written. """
+        if self._queue is None:
+            return 0
+        return self._queue.qsize()
+
+    def dump_activations(self, activations: ActivationDict, sen_ids: List[int]) -> None:
+        """Writes a batch of activations to their offsets in the store.
+
+        If a background writer is used the batch is put on the write
+        queue, blocking only if the queue is full.
 
         Parameters
         ----------
-        activations : PartialArrayDict
+        activations : ActivationDict
             The Tensors for each activation that was specifed by
             self.activation_names at initialization.
+        sen_ids : List[int]
+            Sentence ids of the batch, in the order of the batch
+            activations. Once the batch has been flushed to disk these
+            sentences are marked as completed.
+        """
+        if self.queue_size == 0:
+            self._write_activations(activations, sen_ids)
+            return
+
+        # The writer thread is started lazily, allowing forked extraction workers to start
+        # their own writer thread.
+        if self._queue is None:
+            self._queue = Queue(maxsize=self.queue_size)
+            self._writer_thread = Thread(target=self._write_queue, daemon=True)
+            self._writer_thread.start()
+
+        self._raise_writer_error()
+
+        put_start = perf_counter()
+        self._queue.put((activations, sen_ids))
+        self.producer_stall_time += perf_counter() - put_start
+
+    def close(self) -> None:
+        """Waits until all queued batches have been written and stops
+        the background writer.
+
+        Errors that occurred in the background writer are raised here.
+        """
+        if self._queue is not None:
+            self._queue.put(None)
+            self._writer_thread.join()
+
+            self._queue = None
+            self._writer_thread = None
+
+        self._raise_writer_error()
+
+    def flush(self) -> None:
+        """ Flushes the written activations to disk. """
+        for activation_file in self.activation_files.values():
+            activation_file.flush()
+
+    def _write_queue(self) -> None:
+        """ Writes the batches in the queue, until a None is received. """
+        while True:
+            get_start = perf_counter()
+            item = self._queue.get()
+            self.consumer_stall_time += perf_counter() - get_start
+
+            if item is None:
+                break
+
+            # After an error the queue is still emptied, to prevent the producer from blocking.
+            if self._writer_error is None:
+                try:
+                    self._write_activations(*item)
+                except BaseException as e:
+                    self._writer_error = e
+
+    def _raise_writer_error(self) -> None:
+        if self._writer_error is not None:
+            error, self._writer_error = self._writer_error, None
+            raise RuntimeError("Background activation writer failed") from error
+
+    def _write_activations(
+        self, activations: ActivationDict, sen_ids: List[int]
+    ) -> None:
+        """Writes a batch of activations to the memory-mapped files.
+
+        The progress of the batch sentences is only updated after the
+        activations have been flushed, a batch that is interrupted
+        halfway is therefore rewritten when the run is resumed.
         """
+        sen_ids_tensor = torch.tensor(sen_ids)
+        starts = self.activation_offsets[sen_ids_tensor]
+        stops = self.activation_offsets[sen_ids_tensor + 1]
+
+        runs = ranges_to_runs(starts, stops)
+
         for activation_name in self.activation_names:
             assert (
                 activation_name in self.activation_files.keys()
             ), "Activation file is not opened"
 
-            pickle.dump(
-                activations[activation_name], self.activation_files[activation_name]
-            )
+            batch_activations = activations[activation_name].to(self.dtype).numpy()
 
-    def dump_meta_info(
-        self, activation_ranges: ActivationRanges, selection_func: SelectionFunc
-    ) -> None:
-        """ Dumps activation_ranges and selection_func to disk. """
-        assert self.activation_ranges_file is not None
-        assert self.selection_func_file is not None
+            # Each run of adjacent ranges is written as a contiguous block.
+            batch_start = 0
+            for run in runs:
+                batch_stop = batch_start + run.stop - run.start
+                self.activation_files[activation_name][run] = batch_activations[
+                    batch_start:batch_stop
+                ]
+                batch_start = batch_stop
 
-        pickle.dump(activation_ranges, self.activation_ranges_file)
-        dill.dump(selection_func, self.selection_func_file, recurse=True)
+        self.flush()
+        self.progress[sen_ids] = 1
+        self.progress.flush()
 
-    def concat_pickle_dumps(self, overwrite: bool = True) -> None:
-        """Concatenates a sequential pickle dump and pickles to file .
+    def dump_meta_info(self, selection_func: SelectionFunc) -> None:
+        """Flushes the activation files, dumps the selection_func to
+        disk and marks the store as complete in the manifest.
+        """
+        self.close()
+        self.flush()
 
-        Note that this overwrites the sequential pickle dump by default.
+        selection_func_path = os.path.join(self.activations_dir, "selection_func.dill")
+        with open(selection_func_path, "wb") as f:
+            dill.dump(selection_func, f, recurse=True)
 
-        Parameters
-        ----------
-        overwrite : bool, optional
-            Set to True to overwrite the file containing the sequential
-            pickle dump, otherwise creates a new file. Defaults to True.
+        self._dump_manifest(complete=True)
+
+        self.activation_files = {}
+        self.progress = None
+
+    @property
+    def _np_dtype(self) -> np.dtype:
+        return torch.empty(0, dtype=self.dtype).numpy().dtype
+
+    def _activation_path(self, layer: int, name: str) -> str:
+        return os.path.join(self.activations_dir, f"{layer}-{name}.npy")
+
+    def _dump_manifest(self, complete: bool) -> None:
+        manifest = {
+            "num_items": self.num_items,
+            "dtype": str(self.dtype).replace("torch.", ""),
+            "complete": complete,
+            "activations": [
+                {
+                    "layer": layer,
+                    "name": name,
+                    "file": f"{layer}-{name}.npy",
+                    "nhid": self.activation_files[layer, name].shape[1],
+                }
+                for (layer, name) in self.activation_names
+            ],
+        }
+
+        with open(os.path.join(self.activations_dir, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def _open_existing_files(
+        self, sizes: SizeDict, activation_offsets: ActivationOffsets
+    ) -> bool:
+        """Reopens the files of an existing store for writing.
+
+        Returns False if the store does not match the current setup,
+        or if any of its files is missing or truncated.
         """
-        activation_reader = ActivationReader(
-            self.activations_dir, store_multiple_activations=False
-        )
+        manifest_path = os.path.join(self.activations_dir, "manifest.json")
+        offsets_path = os.path.join(self.activations_dir, "activation_offsets.npy")
+        progress_path = os.path.join(self.activations_dir, "progress.npy")
+
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+            stored_names = [
+                (a["layer"], a["name"], a["nhid"]) for a in manifest["activations"]
+            ]
+            current_names = [
+                (layer, name, sizes[layer, name])
+                for (layer, name) in self.activation_names
+            ]
+            if (
+                stored_names != current_names
+                or manifest["num_items"] != self.num_items
+                or manifest["dtype"] != str(self.dtype).replace("torch.", "")
+            ):
+                return False
+
+            stored_offsets = torch.from_numpy(np.load(offsets_path))
+            if not torch.equal(stored_offsets, activation_offsets):
+                return False
+
+            activation_files = {}
+            for (layer, name) in self.activation_names:
+                activation_file = self._load_memmap(self._activation_path(layer, name))
+                if activation_file.shape != (self.num_items, sizes[layer, name]):
+                    return False
+                if activation_file.dtype != self._np_dtype:
+                    return False
+                activation_files[layer, name] = activation_file
+
+            progress = self._load_memmap(progress_path)
+            if progress.shape != (len(activation_offsets) - 1,):
+                return False
+        except (OSError, ValueError, KeyError):
+            return False
+
+        self.activation_files = activation_files
+        self.progress = progress
+
+        return True
+
+    @staticmethod
+    def _load_memmap(path: str) -> np.memmap:
+        """Opens an existing ``.npy`` file for writing.
+
+        The file is first opened read-only, which raises a ValueError
+        if the file is truncated. Opening it directly in ``r+`` mode
+        would silently pad the file with zeros instead.
+        """
+        np.load(path, mmap_mode="r")
 
-        for (layer, name) in self.activation_names:
-            activations = activation_reader.activations((layer, name))
-            filename = os.path.join(self.activations_dir, f"{name}_l{layer}.pickle")
-            if not overwrite:
-                filename = filename.replace(".pickle", "_concat.pickle")
-            dump_pickle(activations, filename)
-            del activations
+        return np.load(path, mmap_mode="r+")
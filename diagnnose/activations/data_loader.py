@@ -42,6 +42,10 @@ class DataLoader:
     control_task: ControlTask, optional
         Control task function of Hewitt et al. (2019), mapping a corpus
         item to a random label.
+    cache_size : int, optional
+        Maximum number of bytes of activations that each
+        ActivationReader keeps in RAM. Defaults to 0, meaning that only
+        the most recently read activation type is kept.
     """
 
     # TODO: Move init logic to own method
@@ -54,6 +58,7 @@ class DataLoader:
         train_selection_func: SelectionFunc = lambda sen_id, pos, example: True,
         test_selection_func: Optional[SelectionFunc] = None,
         control_task: Optional[ControlTask] = None,
+        cache_size: Optional[int] = 0,
     ) -> None:
         assert corpus is not None, "`corpus`should be provided!"
 
@@ -71,7 +76,9 @@ class DataLoader:
         self.label_vocab: Vocab = corpus.fields["labels"].tokenizer
 
         if test_activations_dir is not None:
-            self.test_activation_reader = ActivationReader(test_activations_dir)
+            self.test_activation_reader = ActivationReader(
+                test_activations_dir, cache_size=cache_size
+            )
             test_selection_func = test_selection_func or (
                 lambda sen_id, pos, example: True
             )
@@ -99,7 +106,9 @@ class DataLoader:
                     control_task=control_task,
                 )
 
-        self.activation_reader = ActivationReader(activations_dir)
+        self.activation_reader = ActivationReader(
+            activations_dir, cache_size=cache_size
+        )
 
         orig_selection_func = self.activation_reader.selection_func
 
@@ -184,6 +193,12 @@ class DataLoader:
             "test_y_control": test_labels_control,
         }
 
+    def prefetch(self, activation_name: ActivationName) -> None:
+        """ Starts reading activation_name in the background. """
+        self.activation_reader.prefetch(activation_name)
+        if self.test_activation_reader is not None:
+            self.test_activation_reader.prefetch(activation_name)
+
     @staticmethod
     def _create_train_test_mask(
         corpus: Corpus,
@@ -79,23 +79,27 @@ class ShapleyDecomposer(Decomposer):
     def wrap_inputs_embeds(self, input_ids: Tensor) -> ShapleyTensor:
         # Shape: batch_size x max_sen_len x nhid
         inputs_embeds = self.model.create_inputs_embeds(input_ids)
+        batch_size, max_sen_len = inputs_embeds.shape[:2]
 
         # First contribution corresponds to contributions stemming from bias terms within the
         # model itself.
-        contributions = [torch.zeros_like(inputs_embeds)]
-
         # Each individual contribution is set to its corresponding input feature, and set to
         # zero on all other positions.
-        for w_idx in range(inputs_embeds.shape[1]):
-            contribution = torch.zeros_like(inputs_embeds)
-            contribution[:, w_idx] = inputs_embeds[:, w_idx]
-            contributions.append(contribution)
+        # Shape: (1 + max_sen_len) x max_sen_len
+        position_masks = torch.cat(
+            [torch.zeros(1, max_sen_len), torch.eye(max_sen_len)]
+        ).to(inputs_embeds)
+
+        # The contributions are defined implicitly by masks over the shared embeddings.
+        # Shape: (1 + max_sen_len) x batch_size x max_sen_len x 1
+        contribution_masks = position_masks.view(1 + max_sen_len, 1, max_sen_len, 1)
+        contribution_masks = contribution_masks.expand(-1, batch_size, -1, -1)
 
         shapley_in = self.tensor_type(
             inputs_embeds,
-            contributions=contributions,
             validate=True,
             num_samples=self.num_samples,
+            contribution_masks=contribution_masks,
         )
 
         return shapley_in
@@ -126,55 +130,118 @@ class ContextualDecomposer(Decomposer):
     \\begin{cases}X_j&i\\neq j\\\\0&\\textit{otherwise}\\end{cases}`
 
     This way of partitioning scales polynomially in the number of input
-    features, but requires a separate forward pass for each individual
-    feature contribution :math:`\\beta^i`.
+    features, but requires a separate decomposition for each individual
+    feature contribution :math:`\\beta^i`. These decompositions all
+    have the same shape, and are concatenated along the batch dimension
+    to be run through the model together.
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        Number of decompositions that are run through the model in a
+        single forward pass, to bound memory usage. Defaults to all
+        :math:`n+1` decompositions at once.
     """
 
+    def __init__(
+        self,
+        model: LanguageModel,
+        num_samples: Optional[int] = None,
+        tensor_type: str = "ShapleyTensor",
+        chunk_size: Optional[int] = None,
+    ):
+        super().__init__(model, num_samples=num_samples, tensor_type=tensor_type)
+
+        self.chunk_size = chunk_size
+
     def decompose(self, batch_encoding: BatchEncoding) -> ShapleyTensor:
         input_ids = torch.tensor(batch_encoding["input_ids"])
+        input_lengths = batch_encoding.data.get("length", None)
         shapley_tensors = self.wrap_inputs_embeds(input_ids)
 
+        batch_size = input_ids.size(0)
+        chunk_size = self.chunk_size or len(shapley_tensors)
+
         contributions = []
 
-        for w_idx, inputs_embeds in enumerate(shapley_tensors):
+        for chunk_start in range(0, len(shapley_tensors), chunk_size):
+            chunk = shapley_tensors[chunk_start : chunk_start + chunk_size]
+
+            if input_lengths is not None:
+                chunk_lengths = torch.as_tensor(input_lengths).repeat(len(chunk))
+            else:
+                chunk_lengths = None
+
             with torch.no_grad():
                 out, c = self.model(
-                    inputs_embeds=inputs_embeds,
-                    input_lengths=batch_encoding.data.get("length", None),
+                    inputs_embeds=self._concat_inputs(chunk),
+                    input_lengths=chunk_lengths,
                     compute_out=True,
                     only_return_top_embs=True,
                 )
-            beta = c[0] if w_idx == 0 else c[1]
-            contributions.append(beta)
 
-        return GCDTensor(out, contributions)
+            for chunk_idx in range(len(chunk)):
+                batch_ids = slice(chunk_idx * batch_size, (chunk_idx + 1) * batch_size)
+                beta = c[0] if chunk_start + chunk_idx == 0 else c[1]
+                contributions.append(beta[batch_ids])
+
+        return GCDTensor(out[:batch_size], contributions)
+
+    @staticmethod
+    def _concat_inputs(shapley_tensors: List[ShapleyTensor]) -> ShapleyTensor:
+        """ Concatenates the decompositions along the batch dimension. """
+        data = torch.cat([shapley_tensor.data for shapley_tensor in shapley_tensors])
+
+        # The contribution dimension precedes the batch dimension.
+        if all(st.contribution_masks is not None for st in shapley_tensors):
+            contributions = None
+            contribution_masks = torch.cat(
+                [st.contribution_masks for st in shapley_tensors], dim=1
+            )
+        else:
+            contributions = torch.cat(
+                [st.stacked_contributions for st in shapley_tensors], dim=1
+            )
+            contribution_masks = None
+
+        return GCDTensor(
+            data,
+            contributions=contributions,
+            validate=shapley_tensors[0].validate,
+            num_samples=shapley_tensors[0].num_samples,
+            contribution_masks=contribution_masks,
+        )
 
     def wrap_inputs_embeds(self, input_ids: Tensor) -> List[ShapleyTensor]:
         inputs_embeds = self.model.create_inputs_embeds(input_ids)
+        batch_size, max_sen_len = inputs_embeds.shape[:2]
+
+        # The beta/gamma pairs are defined implicitly by masks over the shared embeddings.
+        # Shape: 2 x batch_size x max_sen_len x 1
+        def expand_masks(gamma_mask: Tensor, beta_mask: Tensor) -> Tensor:
+            masks = torch.stack([gamma_mask, beta_mask]).to(inputs_embeds)
+            return masks.view(2, 1, max_sen_len, 1).expand(-1, batch_size, -1, -1)
 
         all_shapley_in = [
             GCDTensor(
                 inputs_embeds,
-                contributions=[torch.zeros_like(inputs_embeds), inputs_embeds],
                 validate=True,
                 num_samples=self.num_samples,
+                contribution_masks=expand_masks(
+                    torch.zeros(max_sen_len), torch.ones(max_sen_len)
+                ),
             )
         ]
 
-        for w_idx in range(inputs_embeds.shape[1]):
-            beta = torch.zeros_like(inputs_embeds)
-            gamma = inputs_embeds.clone()
-
-            beta[:, w_idx] = gamma[:, w_idx]
-            gamma[:, w_idx] = 0.0
-
-            contributions = [gamma, beta]
+        for w_idx in range(max_sen_len):
+            beta_mask = torch.zeros(max_sen_len)
+            beta_mask[w_idx] = 1.0
 
             shapley_in = GCDTensor(
                 inputs_embeds,
-                contributions=contributions,
                 validate=False,
                 num_samples=self.num_samples,
+                contribution_masks=expand_masks(1.0 - beta_mask, beta_mask),
             )
 
             all_shapley_in.append(shapley_in)
@@ -7,6 +7,14 @@ from torch import Tensor
 
 from . import utils
 
+# Ops that can be applied to contribution masks, mapped to the position of their dim arg.
+MASK_DIM_FNS = {"index_select": 1, "split": 2, "squeeze": 1, "unsqueeze": 1}
+
+
+def shift_dim(dim: int) -> int:
+    """ Shifts a dimension of the data past the feature dimension. """
+    return dim + 1 if dim >= 0 else dim
+
 
 class ShapleyTensor:
     """A ShapleyTensor wraps a torch Tensor. It allows the tensor to
@@ -22,8 +30,11 @@ class ShapleyTensor:
     ----------
     data : Tensor
         Input tensor that is decomposed into a sum of contributions.
-    contributions : List[Tensor]
-        List of contributions that should sum up to `data`.
+    contributions : Union[List[Tensor], Tensor]
+        List of contributions that should sum up to `data`. The
+        contributions are stored as a single stacked tensor of shape
+        ``(num_features, *data.shape)``, that can also be passed
+        directly.
     shapley_factors : List[Tuple[List[int], int]], optional
         Shapley factors that are calculated with `calc_shapley_factors`.
         To prevent unnecessary compute these factors are passed on to
@@ -31,22 +42,34 @@ class ShapleyTensor:
     validate : bool, optional
         Toggle to validate at each step whether `contributions` still
         sums up to `data`. Defaults to False.
+    contribution_masks : Tensor, optional
+        Defines the contributions implicitly, instead of `contributions`:
+        contribution :math:`i` is equal to ``contribution_masks[i] *
+        data``. The masks cover all dimensions of `data` but the last,
+        of shape ``(num_features, *data.shape[:-1], 1)``. Ops that
+        don't involve the last dimension, such as selecting the input
+        at a single time step, are applied to the masks directly. The
+        contributions are only computed explicitly once they are mixed
+        by any other op.
     """
 
     def __init__(
         self,
         data: Tensor,
-        contributions: Optional[List[Tensor]] = None,
+        contributions: Optional[Union[List[Tensor], Tensor]] = None,
         shapley_factors: Optional[List[Tuple[List[int], int]]] = None,
         num_samples: Optional[int] = None,
         validate: bool = False,
+        contribution_masks: Optional[Tensor] = None,
     ):
         if not utils.MONKEY_PATCH_PERFORMED:
             utils.monkey_patch()
             utils.MONKEY_PATCH_PERFORMED = True
 
         self.data = data
-        self.contributions = contributions or []
+        self._stacked_contributions: Optional[Tensor] = None
+        self.contributions = contributions
+        self.contribution_masks = contribution_masks
         self.shapley_factors = shapley_factors
         self.num_samples = num_samples
         self.validate = validate
@@ -54,7 +77,7 @@ class ShapleyTensor:
         self.current_fn: Optional[str] = None
         self.new_data_shape: Optional[torch.Size] = None
 
-        if len(self.contributions) > 0:
+        if self.num_features > 0:
             if validate:
                 self._validate_contributions()
 
@@ -69,15 +92,68 @@ class ShapleyTensor:
         data = fn(*map(utils.unwrap, args), **kwargs)
         self.new_data_shape = data.shape if isinstance(data, Tensor) else None
 
+        contribution_masks = self._calc_contribution_masks(fn, *args, **kwargs)
+        if contribution_masks is not None:
+            return self._pack_output(data, [], contribution_masks)
+
         contributions = self._calc_contributions(fn, *args, **kwargs)
 
         output = self._pack_output(data, contributions)
 
         return output
 
+    @property
+    def contributions(self) -> List[Tensor]:
+        """List view of the contributions, that are stored as a single
+        tensor in ``stacked_contributions``.
+        """
+        if self.stacked_contributions is None:
+            return []
+
+        return list(self.stacked_contributions)
+
+    @contributions.setter
+    def contributions(
+        self, contributions: Optional[Union[List[Tensor], Tensor]]
+    ) -> None:
+        if contributions is None or len(contributions) == 0:
+            self.stacked_contributions = None
+        elif isinstance(contributions, Tensor):
+            self.stacked_contributions = contributions
+        else:
+            self.stacked_contributions = torch.stack(contributions)
+
+    @property
+    def stacked_contributions(self) -> Optional[Tensor]:
+        """The contributions stacked into a single tensor.
+
+        Size: num_features x data.shape
+        """
+        self._densify_contributions()
+
+        return self._stacked_contributions
+
+    @stacked_contributions.setter
+    def stacked_contributions(self, stacked_contributions: Optional[Tensor]) -> None:
+        self._stacked_contributions = stacked_contributions
+        self.contribution_masks = None
+
     @property
     def num_features(self) -> int:
-        return len(self.contributions)
+        if self.contribution_masks is not None:
+            return self.contribution_masks.shape[0]
+        elif self._stacked_contributions is None:
+            return 0
+
+        return self._stacked_contributions.shape[0]
+
+    def _densify_contributions(self) -> None:
+        """Computes the contributions explicitly, if they are defined by
+        ``contribution_masks``.
+        """
+        if self.contribution_masks is not None:
+            self._stacked_contributions = self.contribution_masks * self.data
+            self.contribution_masks = None
 
     def size(self, *args, **kwargs):
         return self.data.size(*args, **kwargs)
@@ -118,10 +194,15 @@ class ShapleyTensor:
                     # Captures tensor functions that don't exist as a stand-alone torch method,
                     # such as tensor.view(*args). Applies the same function to all contributions.
                     output = attr(*args, **kwargs)
-                    contributions = [
-                        getattr(contribution, item)(*args, **kwargs)
-                        for contribution in self.contributions
-                    ]
+                    if item == "view" and self.num_features > 0:
+                        contributions = self.stacked_contributions.view(
+                            self.num_features, *output.shape
+                        )
+                    else:
+                        contributions = [
+                            getattr(contribution, item)(*args, **kwargs)
+                            for contribution in self.contributions
+                        ]
 
                     return self._pack_output(output, contributions)
 
@@ -134,9 +215,22 @@ class ShapleyTensor:
             data = self.data[index.data]
             contributions = [self.data[c] for c in index.contributions]
             self.validate = self.validate or index.validate
+        elif self._is_leading_index(index):
+            data = self.data[index]
+            contributions = []
+            index = index if isinstance(index, tuple) else (index,)
+            contribution_masks = self.contribution_masks[(slice(None), *index)]
+
+            return self._pack_output(data, contributions, contribution_masks)
         else:
             data = self.data[index]
-            contributions = [contribution[index] for contribution in self.contributions]
+            stacked_index = self._stacked_index(index)
+            if self.num_features == 0:
+                contributions = []
+            elif stacked_index is None:
+                contributions = [c[index] for c in self.contributions]
+            else:
+                contributions = self.stacked_contributions[stacked_index]
 
         # We return type(self) to allow a subclass that derives from ShapleyTensor to be preserved.
         tensor_type = type(self)
@@ -150,24 +244,102 @@ class ShapleyTensor:
         )
 
     def __setitem__(self, index, value):
+        # The implicit contributions would change along with the data.
+        self._densify_contributions()
+
         self.data[index] = value.data
 
         # We pad the current contributions if the value that is set contains more contributions
         # than the current ShapleyTensor.
-        if len(self.contributions) < len(value.contributions):
-            extra_contributions = len(value.contributions) - len(self.contributions)
-            for _ in range(extra_contributions):
-                self.contributions.append(torch.zeros_like(self.data))
+        if self.num_features < value.num_features:
+            extra_contributions = value.num_features - self.num_features
+            padding = self.data.new_zeros(extra_contributions, *self.data.shape)
+            if self.stacked_contributions is None:
+                self.stacked_contributions = padding
+            else:
+                self.stacked_contributions = torch.cat(
+                    [self.stacked_contributions, padding]
+                )
+
+        stacked_index = self._stacked_index(index)
+        if stacked_index is None:
+            for c_idx, contribution in enumerate(self.contributions):
+                contribution[index] = value.contributions[c_idx]
+        else:
+            self.stacked_contributions[stacked_index] = value.stacked_contributions
+
+    def _is_leading_index(self, index: Any) -> bool:
+        """Checks whether an index can be applied to the contribution
+        masks: it should only select from dimensions before the last,
+        without adding or moving any dimension.
+        """
+        if self.contribution_masks is None:
+            return False
 
-        for c_idx, contribution in enumerate(self.contributions):
-            contribution[index] = value.contributions[c_idx]
+        index = index if isinstance(index, tuple) else (index,)
+
+        if len(index) >= self.data.dim() or self._stacked_index(index) is None:
+            return False
+
+        return all(
+            isinstance(idx, (int, slice, list))
+            or (isinstance(idx, Tensor) and idx.dtype == torch.long)
+            for idx in index
+        )
+
+    @staticmethod
+    def _stacked_index(index: Any) -> Optional[Tuple[Any, ...]]:
+        """Prepends the feature dimension to an index of the data.
+
+        Returns None if the index contains non-adjacent tensor indices,
+        for which torch moves the indexed dimensions in front of the
+        feature dimension.
+        """
+        index = index if isinstance(index, tuple) else (index,)
+
+        tensor_dims = [
+            dim for dim, idx in enumerate(index) if isinstance(idx, (Tensor, list))
+        ]
+        num_tensor_dims = len(tensor_dims)
+        if num_tensor_dims > 1 and tensor_dims[-1] - tensor_dims[0] >= num_tensor_dims:
+            return None
+
+        return (slice(None), *index)
+
+    @staticmethod
+    def _expand_contributions(arg: Any, num_features: int, ndim: int) -> Tensor:
+        """Returns the stacked contributions of an arg, with dimensions
+        of size 1 inserted behind the feature dimension up to ``ndim``
+        data dimensions, so they broadcast against each other.
+
+        A non-ShapleyTensor only contributes to the default feature, and
+        is padded with 0s.
+        """
+        if isinstance(arg, ShapleyTensor):
+            contributions = arg.stacked_contributions
+        else:
+            arg = torch.as_tensor(arg)
+            contributions = torch.zeros(
+                num_features, *arg.shape, dtype=arg.dtype, device=arg.device
+            )
+            contributions[0] = arg
+
+        extra_dims = ndim - contributions.dim() + 1
+
+        return contributions.reshape(
+            num_features, *(extra_dims * [1]), *contributions.shape[1:]
+        )
 
     def _validate_contributions(self) -> None:
         """ Asserts whether the contributions sum up to the full tensor. """
-        diff = (self.data - sum(self.contributions)).float()
+        if self.contribution_masks is not None:
+            contributions_sum = self.contribution_masks.sum(dim=0) * self.data
+        else:
+            contributions_sum = self.stacked_contributions.sum(dim=0)
+        diff = (self.data - contributions_sum).float()
         mean_diff = torch.mean(diff)
         max_diff = torch.max(torch.abs(diff))
-        if not torch.allclose(self.data, sum(self.contributions), rtol=1e-3, atol=1e-3):
+        if not torch.allclose(self.data, contributions_sum, rtol=1e-3, atol=1e-3):
             warn(
                 f"Contributions don't sum up to the provided tensor, with a mean difference of "
                 f"{mean_diff:.3E} and a max difference of {max_diff:.3E}."
@@ -176,7 +348,10 @@ class ShapleyTensor:
     def _pack_output(
         self,
         data: Union[Tensor, Iterable[Tensor]],
-        contributions: Union[List[Tensor], Iterable[List[Tensor]]],
+        contributions: Union[
+            List[Tensor], Tensor, Iterable[Union[List[Tensor], Tensor]]
+        ],
+        contribution_masks: Optional[Union[Tensor, List[Tensor]]] = None,
     ) -> Any:
         """Packs the output and its corresponding contributions into a
         new ShapleyTensor.
@@ -192,13 +367,24 @@ class ShapleyTensor:
                 shapley_factors=self.shapley_factors,
                 num_samples=self.num_samples,
                 validate=self.validate,
+                contribution_masks=contribution_masks,
             )
         elif self.current_fn == "_pack_padded_sequence":
-            contributions = [c[0] for c in contributions]
-            return self._pack_output(data[0], contributions), data[1]
+            if contribution_masks is None:
+                contributions = [c[0] for c in contributions]
+            return (
+                self._pack_output(data[0], contributions, contribution_masks),
+                data[1],
+            )
         elif isinstance(data, (list, tuple)):
             iterable_type = type(data)
 
+            if contribution_masks is not None:
+                return iterable_type(
+                    self._pack_output(item, [], contribution_masks[idx])
+                    for idx, item in enumerate(data)
+                )
+
             if len(contributions) == 0:
                 return iterable_type(self._pack_output(item, []) for item in data)
 
@@ -209,7 +395,65 @@ class ShapleyTensor:
 
         return data
 
-    def _calc_contributions(self, fn, *args, **kwargs) -> List[Tensor]:
+    def _calc_contribution_masks(
+        self, fn, *args, **kwargs
+    ) -> Optional[Union[Tensor, List[Tensor]]]:
+        """Applies an op that doesn't involve the last dimension to the
+        contribution masks of its input, keeping the contributions
+        implicit.
+
+        Returns None if the input has no contribution masks, or if the
+        op can't be applied to them.
+        """
+        shapley_tensor = args[0]
+        if (
+            not isinstance(shapley_tensor, ShapleyTensor)
+            or shapley_tensor.contribution_masks is None
+            or len(utils.find_shapley_tensors(args[1:])) > 0
+        ):
+            return None
+
+        contribution_masks = shapley_tensor.contribution_masks
+        ndim = shapley_tensor.data.dim()
+
+        if fn.__name__ == "_pack_padded_sequence":
+            if ndim < 3:
+                return None
+            return torch.stack(
+                [fn(mask, *args[1:], **kwargs)[0] for mask in contribution_masks]
+            )
+        elif fn.__name__ not in MASK_DIM_FNS:
+            return None
+
+        dim_position = MASK_DIM_FNS[fn.__name__]
+        if len(args) > dim_position:
+            dim = args[dim_position]
+        elif "dim" in kwargs:
+            dim = kwargs["dim"]
+        elif fn.__name__ == "split":
+            dim = 0
+        else:
+            return None
+
+        # The op should not act on the last dimension, nor insert a dimension behind it.
+        output_ndim = ndim + 1 if fn.__name__ == "unsqueeze" else ndim
+        if not isinstance(dim, int) or dim % output_ndim == output_ndim - 1:
+            return None
+
+        args = [contribution_masks, *args[1:]]
+        if len(args) > dim_position:
+            args[dim_position] = shift_dim(dim)
+        else:
+            kwargs = {**kwargs, "dim": shift_dim(dim)}
+
+        output_masks = fn(*args, **kwargs)
+
+        if isinstance(output_masks, tuple):
+            return list(output_masks)
+
+        return output_masks
+
+    def _calc_contributions(self, fn, *args, **kwargs) -> Union[List[Tensor], Tensor]:
         """
         Some methods have custom behaviour for how the output is
         decomposed into a new set of contributions.
@@ -219,18 +463,24 @@ class ShapleyTensor:
         elif hasattr(self, f"{fn.__name__}_contributions"):
             fn = getattr(self, f"{fn.__name__}_contributions")
             return fn(*args, **kwargs)
-        elif fn.__name__ in [
-            "squeeze",
-            "unsqueeze",
-            "index_select",
-            "_pack_padded_sequence",
-        ]:
+        elif fn.__name__ in ["squeeze", "unsqueeze", "index_select"]:
+            # The dim argument is shifted past the feature dimension.
+            if len(args) > 1:
+                dim = args[1]
+                args = (args[0], shift_dim(dim), *args[2:])
+            elif "dim" in kwargs:
+                kwargs = {**kwargs, "dim": shift_dim(kwargs["dim"])}
+            else:
+                return [fn(c, *args[1:], **kwargs) for c in args[0].contributions]
+
+            return fn(args[0].stacked_contributions, *args[1:], **kwargs)
+        elif fn.__name__ == "_pack_padded_sequence":
             old_contributions = args[0].contributions
             return [fn(c, *args[1:], **kwargs) for c in old_contributions]
 
         return self._calc_shapley_contributions(fn, *args, **kwargs)
 
-    def _calc_shapley_contributions(self, fn, *args, **kwargs) -> List[Tensor]:
+    def _calc_shapley_contributions(self, fn, *args, **kwargs) -> Tensor:
         """ Calculates the Shapley decomposition of the current fn. """
         if self.num_samples is None:
             return utils.calc_exact_shapley_values(
@@ -254,75 +504,51 @@ class ShapleyTensor:
     def cat_contributions(self, *args, **kwargs):
         # A non-ShapleyTensor only contributes to the default feature, and is padded with 0s.
         all_contributions = [
-            arg.contributions
-            if hasattr(arg, "contributions")
-            else [arg] + (self.num_features - 1) * [torch.zeros_like(arg)]
+            self._expand_contributions(arg, self.num_features, utils.unwrap(arg).dim())
             for arg in args[0]
         ]
 
-        contributions = [
-            torch.cat(
-                [contribution[idx] for contribution in all_contributions], **kwargs
-            )
-            for idx in range(self.num_features)
-        ]
+        dim = shift_dim(kwargs.pop("dim", 0))
 
-        return contributions
+        return torch.cat(all_contributions, dim, **kwargs)
 
     @staticmethod
     def split_contributions(*args, **kwargs):
         shapley_tensor, split_size_or_sections = args
 
-        raw_splits = [
-            torch.split(contribution, split_size_or_sections, **kwargs)
-            for contribution in shapley_tensor.contributions
-        ]
-
-        num_splits = len(raw_splits[0])
+        dim = shift_dim(kwargs.pop("dim", 0))
 
-        contributions = [
-            [split[idx] for split in raw_splits] for idx in range(num_splits)
-        ]
-
-        return contributions
+        return list(
+            torch.split(
+                shapley_tensor.stacked_contributions,
+                split_size_or_sections,
+                dim,
+                **kwargs,
+            )
+        )
 
     @staticmethod
     def add_contributions(*args, **kwargs):
         """ Non-ShapleyTensors are added to the default partition. """
-        arg1, arg2 = args
-        if not isinstance(arg1, ShapleyTensor):
-            contributions = [
-                torch.add(arg1, arg2.contributions[0], **kwargs),
-                *(
-                    torch.add(torch.zeros_like(arg), arg, **kwargs)
-                    for arg in arg2.contributions[1:]
-                ),
-            ]
-        elif not isinstance(arg2, ShapleyTensor):
-            contributions = [
-                torch.add(arg1.contributions[0], arg2, **kwargs),
-                *arg1.contributions[1:],
-            ]
-        else:
-            contributions = [
-                torch.add(con1, con2, **kwargs)
-                for con1, con2 in zip(arg1.contributions, arg2.contributions)
-            ]
+        num_features = max(getattr(arg, "num_features", 0) for arg in args)
+        ndim = max(torch.as_tensor(utils.unwrap(arg)).dim() for arg in args)
 
-        return contributions
+        arg1, arg2 = [
+            ShapleyTensor._expand_contributions(arg, num_features, ndim) for arg in args
+        ]
+
+        return torch.add(arg1, arg2, **kwargs)
 
     def mul_contributions(self, *args, **kwargs):
         arg1, arg2 = args
-        if isinstance(arg1, torch.Tensor):
-            contributions = [
-                torch.mul(arg1, contribution, **kwargs)
-                for contribution in arg2.contributions
-            ]
-        elif isinstance(arg2, torch.Tensor):
-            contributions = [
-                torch.mul(contribution, arg2, **kwargs)
-                for contribution in arg1.contributions
-            ]
+        ndim = len(self.new_data_shape)
+
+        if not isinstance(arg1, ShapleyTensor):
+            arg2 = self._expand_contributions(arg2, self.num_features, ndim)
+            contributions = torch.mul(arg1, arg2, **kwargs)
+        elif not isinstance(arg2, ShapleyTensor):
+            arg1 = self._expand_contributions(arg1, self.num_features, ndim)
+            contributions = torch.mul(arg1, arg2, **kwargs)
         else:
             contributions = self._calc_shapley_contributions(torch.mul, *args, **kwargs)
 
@@ -330,23 +556,34 @@ class ShapleyTensor:
 
     def matmul_contributions(self, *args, **kwargs):
         arg1, arg2 = args
-        if isinstance(arg1, torch.Tensor):
-            contributions = [
-                torch.matmul(arg1, contribution, **kwargs)
-                for contribution in arg2.contributions
-            ]
-        elif isinstance(arg2, torch.Tensor):
-            contributions = [
-                torch.matmul(contribution, arg2, **kwargs)
-                for contribution in arg1.contributions
-            ]
-        else:
+        ndim = len(self.new_data_shape)
+
+        if isinstance(arg1, ShapleyTensor) and isinstance(arg2, ShapleyTensor):
             contributions = self._calc_shapley_contributions(
                 torch.matmul, *args, **kwargs
             )
+        elif any(
+            isinstance(arg, ShapleyTensor) and arg.data.dim() == 1 for arg in args
+        ):
+            # A 1-dimensional ShapleyTensor would be treated as a matrix once stacked.
+            contributions = [
+                torch.matmul(*utils.unwrap(args, "contributions", [c_idx]), **kwargs)
+                for c_idx in range(self.num_features)
+            ]
+        elif not isinstance(arg1, ShapleyTensor):
+            arg2 = self._expand_contributions(arg2, self.num_features, ndim)
+            contributions = torch.matmul(arg1, arg2, **kwargs)
+        else:
+            arg1 = self._expand_contributions(arg1, self.num_features, ndim)
+            contributions = torch.matmul(arg1, arg2, **kwargs)
 
         return contributions
 
+    def reshape_contributions(self, *args, **kwargs):
+        return args[0].stacked_contributions.reshape(
+            self.num_features, *self.new_data_shape
+        )
+
     def __add__(self, other):
         return torch.add(self, other)
 
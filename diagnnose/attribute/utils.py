@@ -1,7 +1,7 @@
 import itertools
 from functools import wraps
 from math import factorial
-from typing import Any, Callable, Iterable, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 import torch
 from torch import Tensor
@@ -80,6 +80,36 @@ def unwrap(args: Any, attr: str = "data", coalition: Optional[List[int]] = None)
     return args
 
 
+def find_shapley_tensors(args: Any) -> List[Any]:
+    """ Returns the ShapleyTensors that are contained in a list of args. """
+    if hasattr(args, "stacked_contributions"):
+        return [args]
+    elif isinstance(args, (list, tuple)):
+        shapley_tensors = []
+        for arg in args:
+            for shapley_tensor in find_shapley_tensors(arg):
+                if all(shapley_tensor is not st for st in shapley_tensors):
+                    shapley_tensors.append(shapley_tensor)
+        return shapley_tensors
+
+    return []
+
+
+def unwrap_sums(args: Any, coalition_sums: Dict[int, Tensor]) -> Any:
+    """Unwraps a list of args by replacing each ShapleyTensor with a
+    precomputed sum of its contributions, stored by the id of the
+    ShapleyTensor in ``coalition_sums``.
+    """
+    if hasattr(args, "stacked_contributions"):
+        return coalition_sums[id(args)]
+    elif isinstance(args, list):
+        return [unwrap_sums(arg, coalition_sums) for arg in args]
+    elif isinstance(args, tuple):
+        return tuple(unwrap_sums(arg, coalition_sums) for arg in args)
+
+    return args
+
+
 def sum_contributions(contributions: List[Tensor], coalition: List[int]) -> Tensor:
     """ Sums the contributions that are part of the provided coalition. """
     contributions_sum = sum([contributions[idx] for idx in coalition])
@@ -137,61 +167,244 @@ def calc_exact_shapley_values(
     data_shape: torch.Size,
     *args,
     **kwargs,
-) -> List[Tensor]:
-    contributions = []
-
-    for f_idx in range(num_features):
-        other_ids = torch.tensor([i for i in range(num_features) if i != f_idx])
+) -> Tensor:
+    """Computes the exact Shapley values of the output of ``fn``.
 
-        contribution = torch.zeros(data_shape)
+    ``fn`` is evaluated on each of the :math:`2^n` coalitions of
+    features, in a single batched call if ``fn`` permits so. The
+    Shapley value of each feature is then assembled from the outputs
+    of all coalitions in one weighted reduction.
+    """
+    num_coalitions = 2 ** num_features
+
+    # Shape: num_coalitions x num_features, coalition i contains feature j if bit j is set.
+    coalition_masks = (
+        torch.arange(num_coalitions).unsqueeze(1) >> torch.arange(num_features)
+    ) & 1
+
+    # Shape: num_coalitions x data_shape
+    coalition_outputs = calc_coalition_outputs(
+        fn, coalition_masks, data_shape, *args, **kwargs
+    )
+
+    # Normalization factor of a coalition of each size, padded with a 0 for the
+    # full coalition, that never lacks a feature.
+    size_factors = torch.zeros(num_features + 1, dtype=torch.float64)
+    for coalition, factor in shapley_factors:
+        size_factors[len(coalition)] = factor
+    size_factors /= factorial(num_features)
+
+    # A coalition adds its output to the features it contains, and subtracts it from
+    # those it lacks, weighted by the factor of the coalition without that feature.
+    # The empty coalition indexes the padding factor of -1, which its mask zeroes out.
+    coalition_sizes = coalition_masks.sum(dim=1, keepdim=True)
+    coalition_weights = torch.where(
+        coalition_masks.bool(),
+        size_factors[coalition_sizes - 1],
+        -size_factors[coalition_sizes],
+    )
+
+    contributions = torch.tensordot(
+        coalition_weights.t().to(coalition_outputs.dtype), coalition_outputs, dims=1
+    )
 
-        for coalition_ids, factor in shapley_factors:
-            coalition = list(other_ids[coalition_ids])
-            args_wo = unwrap(args, attr="contributions", coalition=coalition)
+    # Add baseline to default feature ([0]).
+    contributions[0] += coalition_outputs[0]
 
-            args_with = unwrap(
-                args, attr="contributions", coalition=(coalition + [f_idx])
-            )
+    return contributions
 
-            contribution += factor * (fn(*args_with, **kwargs) - fn(*args_wo, **kwargs))
 
-        contribution /= factorial(num_features)
-        contributions.append(contribution)
+def calc_sample_shapley_values(
+    fn: Callable,
+    num_features: int,
+    num_samples: int,
+    data_shape: torch.Size,
+    *args,
+    **kwargs,
+) -> Tensor:
+    """Approximates the Shapley values of the output of ``fn`` by
+    sampling feature permutations.
+
+    The contribution of a feature is the mean difference in output
+    between the prefix of a permutation that ends with the feature, and
+    the prefix without it. The prefixes of all permutations are
+    evaluated in a single batched call if ``fn`` permits so.
+    """
+    # Shape: num_samples x num_features, the rank of each feature within a permutation.
+    perm_ranks = torch.stack(
+        [torch.tensor(sample) for sample in perm_generator(num_features, num_samples)]
+    ).argsort(dim=1)
+
+    # Prefix k of a permutation contains the features with a rank up to k. The empty
+    # coalition is prepended to compute the baseline.
+    # Shape: (1 + num_samples * num_features) x num_features
+    prefix_masks = perm_ranks.unsqueeze(1) <= torch.arange(num_features).view(-1, 1)
+    coalition_masks = torch.cat(
+        [
+            torch.zeros(1, num_features, dtype=torch.long),
+            prefix_masks.view(-1, num_features).long(),
+        ]
+    )
+
+    coalition_outputs = calc_coalition_outputs(
+        fn, coalition_masks, data_shape, *args, **kwargs
+    )
+
+    baseline = coalition_outputs[0]
+
+    # Shape: num_samples x num_features x data_shape
+    prefix_outputs = coalition_outputs[1:].view(num_samples, num_features, *data_shape)
+    prev_outputs = torch.cat(
+        [baseline.expand(num_samples, 1, *data_shape), prefix_outputs[:, :-1]], dim=1
+    )
+    output_diffs = prefix_outputs - prev_outputs
+
+    # The difference that feature j adds in sample i is found at prefix rank[i, j].
+    sample_ids = torch.arange(num_samples).unsqueeze(1)
+    contributions = output_diffs[sample_ids, perm_ranks].sum(dim=0) / num_samples
 
-    # Add baseline to default feature ([0]).
-    zero_input_args = unwrap(args, attr="contributions", coalition=[])
-    baseline = fn(*zero_input_args, **kwargs)
     contributions[0] += baseline
 
     return contributions
 
 
-def calc_sample_shapley_values(
+# Functions that act independently on each slice along a new leading dimension, for
+# which all coalition inputs can be evaluated in a single call. Broadcasting
+# functions accept inputs of different shapes, softmax functions take a dim argument.
+BROADCAST_FNS = {
+    "abs",
+    "add",
+    "div",
+    "exp",
+    "gelu",
+    "layer_norm",
+    "log",
+    "mul",
+    "neg",
+    "pow",
+    "relu",
+    "rsqrt",
+    "sigmoid",
+    "sqrt",
+    "sub",
+    "tanh",
+    "true_divide",
+}
+SOFTMAX_FNS = {"log_softmax", "softmax"}
+
+
+def calc_coalition_outputs(
     fn: Callable,
-    num_features: int,
-    num_samples: int,
+    coalition_masks: Tensor,
     data_shape: torch.Size,
     *args,
     **kwargs,
-) -> List[Tensor]:
-    contributions = [torch.zeros(data_shape) for _ in range(num_features)]
+) -> Tensor:
+    """Evaluates ``fn`` on the summed contributions of each coalition.
 
-    generator = perm_generator(num_features, num_samples)
+    The summed contributions of all coalitions are stacked along a new
+    leading dimension. If ``fn`` acts independently on each slice of
+    that dimension it is called once on the stacked inputs, and
+    otherwise once for each coalition.
 
-    zero_input_args = unwrap(args, attr="contributions", coalition=[])
-    baseline = fn(*zero_input_args, **kwargs)
+    Parameters
+    ----------
+    fn : Callable
+        Function that is decomposed.
+    coalition_masks : Tensor
+        Binary mask of the features in each coalition.
+        Size: num_coalitions x num_features
+    data_shape : torch.Size
+        Shape of the output of ``fn``.
+    *args
+        Arguments of ``fn``, that might contain ShapleyTensors.
+    **kwargs
+        Keyword arguments of ``fn``.
 
-    for sample in generator:
-        prev_value = baseline
-        for sample_idx, feature_idx in enumerate(sample, start=1):
-            coalition = sample[:sample_idx]
-            coalition_args = unwrap(args, attr="contributions", coalition=coalition)
+    Returns
+    -------
+    coalition_outputs : Tensor
+        Size: num_coalitions x data_shape
+    """
+    num_coalitions = coalition_masks.shape[0]
+
+    # id(ShapleyTensor) -> num_coalitions x shape
+    coalition_sums = {
+        id(arg): sum_coalitions(arg.stacked_contributions, coalition_masks)
+        for arg in find_shapley_tensors(args)
+    }
+
+    batched_call = batch_args(fn, args, kwargs, coalition_sums)
+    if batched_call is not None:
+        coalition_outputs = fn(*batched_call[0], **batched_call[1])
+        if coalition_outputs.shape == (num_coalitions, *data_shape):
+            return coalition_outputs
+
+    return torch.stack(
+        [
+            fn(
+                *unwrap_sums(args, {k: v[idx] for k, v in coalition_sums.items()}),
+                **kwargs,
+            )
+            for idx in range(num_coalitions)
+        ]
+    )
 
-            new_value = fn(*coalition_args, **kwargs)
-            contributions[feature_idx] += new_value - prev_value
-            prev_value = new_value
 
-    contributions = [c / num_samples for c in contributions]
-    contributions[0] += baseline
+def sum_coalitions(stacked_contributions: Tensor, coalition_masks: Tensor) -> Tensor:
+    """Sums the contributions of each coalition of features.
 
-    return contributions
+    Size: num_coalitions x contribution_shape
+    """
+    num_features, *shape = stacked_contributions.shape
+
+    coalition_sums = coalition_masks.to(stacked_contributions.dtype) @ (
+        stacked_contributions.reshape(num_features, -1)
+    )
+
+    return coalition_sums.view(-1, *shape)
+
+
+def batch_args(
+    fn: Callable, args: Any, kwargs: Dict[str, Any], coalition_sums: Dict[int, Tensor]
+) -> Optional[Tuple[List[Any], Dict[str, Any]]]:
+    """Creates the args of a single call of ``fn`` on the stacked
+    coalition sums, or returns None if ``fn`` can't be batched.
+
+    The stacked sums are padded to the largest number of dimensions of
+    the tensor args, so they still broadcast against each other behind
+    the leading coalition dimension. A positive softmax dim is shifted
+    by the dimensions that are prepended to its input.
+    """
+    fn_name = getattr(fn, "__name__", None)
+    if fn_name not in BROADCAST_FNS and fn_name not in SOFTMAX_FNS:
+        return None
+
+    # Both Tensors and ShapleyTensors have a data attribute.
+    max_ndim = max(arg.data.dim() for arg in args if hasattr(arg, "data"))
+
+    batched_args = []
+    for arg in args:
+        if hasattr(arg, "stacked_contributions"):
+            ndim = arg.data.dim()
+            arg_sums = coalition_sums[id(arg)]
+            arg = arg_sums.view(-1, *([1] * (max_ndim - ndim)), *arg_sums.shape[1:])
+        elif len(find_shapley_tensors(arg)) > 0:
+            return None
+        batched_args.append(arg)
+
+    if fn_name in SOFTMAX_FNS:
+        if len(args) > 1:
+            dim = batched_args[1]
+        else:
+            dim = kwargs.get("dim", None)
+        if not isinstance(dim, int) or not hasattr(args[0], "stacked_contributions"):
+            return None
+        if dim >= 0:
+            dim += 1 + max_ndim - args[0].data.dim()
+        if len(args) > 1:
+            batched_args[1] = dim
+        else:
+            kwargs = {**kwargs, "dim": dim}
+
+    return batched_args, kwargs
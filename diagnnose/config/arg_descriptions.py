@@ -112,10 +112,31 @@ arg_descriptions["extract"] = {
         "Higher batch size increases extraction speed, but should "
         "be done accordingly to the amount of available RAM. Defaults to 1.",
     },
+    "max_tokens": {
+        "type": int,
+        "help": "(optional) Maximum number of padded tokens per forward step. "
+        "Replaces batch_size as the cap on the size of a batch.",
+    },
+    "memory_budget": {
+        "type": int,
+        "help": "(optional) Maximum number of bytes the activations of a single "
+        "forward step may occupy, based on which the size of each batch is picked.",
+    },
+    "out_vocab_ids": {
+        "nargs": "*",
+        "type": int,
+        "help": "(optional) Vocabulary ids to which the decoder projection of the "
+        "out activations is restricted. Defaults to the full vocabulary.",
+    },
     "dtype": {
         "help": "(optional) Activation dtype, should be one of float32 or float64. "
         "Defaults to float32."
     },
+    "resume": {
+        "type": bool,
+        "help": "(optional) Resume an interrupted extraction to activations_dir, "
+        "skipping the sentences that have already been written. Defaults to False.",
+    },
 }
 
 arg_descriptions["init_dc"] = {
@@ -185,7 +185,8 @@ class Corpus(Dataset):
             A new Corpus instance containing the filtered list of
             Examples.
         """
-        examples = [ex for ex in self.examples if ex.sen_idx in sen_ids]
+        sen_id_set = set(sen_ids)
+        examples = [ex for ex in self.examples if ex.sen_idx in sen_id_set]
 
         subcorpus = Corpus(
             examples,
@@ -1,12 +1,16 @@
 from typing import Callable, Optional
 
-from torchtext.data import Iterator
+from torchtext.data import Example, Iterator
 
 from diagnnose.corpus import Corpus
 
 
 def create_iterator(
-    corpus: Corpus, batch_size: int = 1, device: str = "cpu", sort: bool = False
+    corpus: Corpus,
+    batch_size: int = 1,
+    device: str = "cpu",
+    sort: bool = False,
+    max_tokens: Optional[int] = None,
 ) -> Iterator:
     """Transforms a Corpus into an :class:`torchtext.data.Iterator`.
 
@@ -23,22 +27,37 @@ def create_iterator(
         Torch device on which forward passes will be run.
         Defaults to cpu.
     sort : bool, optional
-        Toggle to sort the corpus based on sentence length. Defaults to
-        ``False``.
+        Toggle to sort the corpus based on sentence length. Sentences
+        of similar length then end up in the same batch, which reduces
+        the amount of padding in a batch. Defaults to ``False``.
+    max_tokens : int, optional
+        If provided, batches are capped on their number of padded
+        tokens (``batch_size x max_sen_len``) instead of on their
+        number of sentences, and ``batch_size`` is ignored. A sentence
+        that is longer than ``max_tokens`` is put in a batch of its
+        own. Defaults to ``None``.
 
     Returns
     -------
     iterator : Iterator
         Iterator containing the batchified Corpus.
     """
-    if sort is not None:
-        sort_key: Optional[Callable] = lambda ex: len(getattr(ex, corpus.sen_column))
+
+    def sen_len(ex: Example) -> int:
+        return len(getattr(ex, corpus.sen_column))
+
+    sort_key: Optional[Callable] = sen_len if sort else None
+
+    if max_tokens is not None:
+        batch_size = max_tokens
+        batch_size_fn: Optional[Callable] = _padded_tokens_fn(sen_len, max_tokens)
     else:
-        sort_key = None
+        batch_size_fn = None
 
     iterator = Iterator(
         dataset=corpus,
         batch_size=batch_size,
+        batch_size_fn=batch_size_fn,
         device=device,
         shuffle=False,
         sort=sort,
@@ -47,3 +66,28 @@ def create_iterator(
     )
 
     return iterator
+
+
+def _padded_tokens_fn(
+    sen_len: Callable[[Example], int], max_tokens: int
+) -> Callable[[Example, int, int], int]:
+    """Creates a ``batch_size_fn`` that computes the number of padded
+    tokens of a batch, after ``ex`` has been added to it.
+
+    The torchtext batcher resets a batch by calling the function with
+    a count of 1, at which point the running max length is reset.
+    """
+    max_len = 0
+
+    def padded_tokens(ex: Example, count: int, _size_so_far: int) -> int:
+        nonlocal max_len
+        if count == 1:
+            max_len = sen_len(ex)
+            # Overly long sentences are yielded as a batch of their own.
+            return min(max_len, max_tokens)
+
+        max_len = max(max_len, sen_len(ex))
+
+        return count * max_len
+
+    return padded_tokens
@@ -1,2 +1,5 @@
-from .extractor import Extractor, BATCH_SIZE
+from .extractor import Extractor, BATCH_SIZE, MEMORY_BUDGET
+from .prefix_extractor import PrefixTrieExtractor
 from .simple_extract import simple_extract
+from .streaming_extractor import StreamingExtractor
+from .surprisal_extractor import SurprisalExtractor
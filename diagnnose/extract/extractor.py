@@ -1,31 +1,39 @@
-from contextlib import ExitStack
-from typing import Optional, Union
+import multiprocessing
+from typing import Dict, List, Optional, Tuple, Union
 
 import torch
-from torchtext.data import Batch
+from torch import Tensor
+from torchtext.data import Batch, Iterator
 from tqdm import tqdm
 
 import diagnnose.activations.selection_funcs as selection_funcs
 from diagnnose.activations import ActivationReader, ActivationWriter
+from diagnnose.activations.activation_index import (
+    ranges_to_row_ids,
+    ranges_to_row_index,
+)
 from diagnnose.activations.selection_funcs import return_all
 from diagnnose.corpus import Corpus
 from diagnnose.corpus.create_iterator import create_iterator
 from diagnnose.models import LanguageModel
+from diagnnose.models.recurrent_lm import RecurrentLM
 from diagnnose.typedefs.activations import (
     ActivationDict,
+    ActivationName,
     ActivationNames,
-    ActivationRanges,
+    ActivationOffsets,
     SelectionFunc,
 )
 
 BATCH_SIZE = 1024
+MEMORY_BUDGET = 2 ** 30
 
 
 class Extractor:
     """Extracts all intermediate activations of a LM from a corpus.
 
     Only activations that are provided in activation_names will be
-    stored in a pickle file. Each activation is written to its own file.
+    stored. Each activation is written to its own file.
 
     Parameters
     ----------
@@ -51,9 +59,44 @@ class Extractor:
         Amount of sentences processed per forward step. Higher batch
         size increases extraction speed, but should be done
         accordingly to the amount of available RAM. Defaults to 1.
+    max_tokens : int, optional
+        Maximum number of padded tokens (``batch_size x max_sen_len``)
+        per forward step. If provided this replaces ``batch_size`` as
+        the cap on the size of a batch. Sentences are always batched
+        in order of length to reduce padding, the activations are
+        stored in corpus order regardless. Defaults to None.
+    memory_budget : int, optional
+        Maximum number of bytes the activations of a single forward
+        step may occupy. The size of each batch is then picked based on
+        its padded sentence length, the hidden size of each of the
+        ``activation_names`` and the size of the default dtype. If
+        ``max_tokens`` is provided as well the smallest of the two caps
+        is used. A ValueError is raised if the longest sentence does not
+        fit within the budget. Defaults to None.
+    out_vocab_ids : List[int], optional
+        Vocabulary ids to which the decoder projection of the ``out``
+        activations is restricted. If not provided the logits of the
+        full vocabulary are extracted.
     sen_column : str, optional
         Corpus column that will be tokenized and extracted. Defaults
         to the ``sen_column`` of ``corpus``.
+    write_queue_size : int, optional
+        Number of extracted batches that can be queued for the
+        background thread that writes them to ``activations_dir``,
+        allowing disk I/O to overlap with the forward passes. Set to 0
+        to write each batch directly. Defaults to 2.
+    num_workers : int, optional
+        Number of worker processes among which the corpus is split into
+        contiguous shards. Each worker runs the model on its own shard,
+        and writes its activations at the precomputed offsets of the
+        shared output. Requires the ``fork`` start method and a model
+        that runs on cpu. Defaults to 1.
+    resume : bool, optional
+        Resume an interrupted extraction to ``activations_dir``. The
+        sentences that have already been committed to the existing
+        store are skipped, and partially written batches are extracted
+        again. If the existing store doesn't match the current setup a
+        new extraction is started instead. Defaults to False.
     """
 
     def __init__(
@@ -64,7 +107,13 @@ class Extractor:
         activations_dir: Optional[str] = None,
         selection_func: Union[SelectionFunc, str] = return_all,
         batch_size: int = BATCH_SIZE,
+        max_tokens: Optional[int] = None,
+        memory_budget: Optional[int] = None,
+        out_vocab_ids: Optional[List[int]] = None,
         sen_column: Optional[str] = None,
+        write_queue_size: int = 2,
+        num_workers: int = 1,
+        resume: bool = False,
     ) -> None:
         self.model = model
         self.corpus = corpus
@@ -74,20 +123,34 @@ class Extractor:
         else:
             self.selection_func = selection_func
         self.batch_size = batch_size
+        if out_vocab_ids is not None:
+            self.out_vocab_ids: Optional[Tensor] = torch.tensor(out_vocab_ids)
+        else:
+            self.out_vocab_ids = None
+
         self.sen_column = sen_column or corpus.sen_column
+        self.model_activation_names = self._create_model_activation_names()
+        self.max_tokens = self._calc_max_tokens(max_tokens, memory_budget)
+        self.num_workers = num_workers
+        self.resume = resume
 
-        self.activation_ranges = self._create_activation_ranges()
+        self.activation_offsets, self.selected_positions = (
+            self._create_activation_offsets()
+        )
 
         if activations_dir is None:
             self.activation_writer: Optional[ActivationWriter] = None
         else:
-            self.activation_writer = ActivationWriter(activations_dir)
+            self.activation_writer = ActivationWriter(
+                activations_dir, queue_size=write_queue_size
+            )
 
     def extract(self) -> ActivationReader:
         """Extracts embeddings from a corpus.
 
-        Uses :class:`contextlib.ExitStack` to write to multiple files
-        simultaneously.
+        If an ``activations_dir`` has been provided the activations are
+        written to a preallocated store on disk, otherwise they are
+        returned in memory.
 
         Returns
         -------
@@ -98,14 +161,19 @@ class Extractor:
         print(f"\nStarting extraction of {len(self.corpus)} sentences...")
 
         if self.activation_writer is not None:
-            with ExitStack() as stack:
-                self.activation_writer.create_output_files(stack, self.activation_names)
+            self.activation_writer.create_output_files(
+                self.activation_names,
+                {a_name: self._nhid(a_name) for a_name in self.activation_names},
+                self.activation_offsets,
+                resume=self.resume,
+            )
 
+            try:
                 self._extract_corpus(dump=True)
+            finally:
+                self.activation_writer.close()
 
-                self.activation_writer.dump_meta_info(
-                    self.activation_ranges, self.selection_func
-                )
+            self.activation_writer.dump_meta_info(self.selection_func)
 
             activation_reader = ActivationReader(
                 activations_dir=self.activation_writer.activations_dir,
@@ -117,61 +185,257 @@ class Extractor:
             activation_reader = ActivationReader(
                 activation_dict=corpus_activations,
                 activation_names=self.activation_names,
-                activation_ranges=self.activation_ranges,
+                activation_offsets=self.activation_offsets,
                 selection_func=self.selection_func,
             )
 
-        n_extracted = self.activation_ranges[-1][-1]
+        n_extracted = len(self.selected_positions)
         print(f"Extraction finished, {n_extracted} activations have been extracted.")
 
         return activation_reader
 
     def _extract_corpus(self, dump: bool = True) -> ActivationDict:
-        tot_extracted = self.activation_ranges[-1][1]
+        tot_extracted = len(self.selected_positions)
         corpus_activations: ActivationDict = self._init_activation_dict(
             tot_extracted, dump=dump
         )
 
-        corpus = self._filter_corpus()
+        corpus = self._filter_corpus(dump=dump)
 
-        iterator = create_iterator(
-            corpus, batch_size=self.batch_size, device=self.model.device
-        )
+        if len(corpus) == 0:
+            return corpus_activations
+
+        if self.num_workers > 1:
+            self._extract_shards(corpus, corpus_activations, dump)
+        else:
+            self._extract_batches(corpus, corpus_activations, dump)
 
-        for batch in tqdm(iterator, unit="batch"):
+        return corpus_activations
+
+    def _extract_batches(
+        self,
+        corpus: Corpus,
+        corpus_activations: ActivationDict,
+        dump: bool,
+        desc: Optional[str] = None,
+    ) -> None:
+        """Extracts the activations of a corpus batch by batch, and
+        either dumps them or inserts them into ``corpus_activations``.
+        """
+        iterator = self._create_iterator(corpus)
+
+        # The length of an iterator with a token budget is not known up front.
+        iterator.create_batches()
+        num_batches = sum(1 for _ in iterator.batches)
+
+        for batch in tqdm(iterator, total=num_batches, unit="batch", desc=desc):
             batch_activations = self._extract_batch(batch)
 
             if dump:
-                self.activation_writer.dump_activations(batch_activations)
+                self.activation_writer.dump_activations(
+                    batch_activations, batch.sen_idx
+                )
             else:
+                sen_ids = torch.tensor(batch.sen_idx)
+                rows = ranges_to_row_index(
+                    self.activation_offsets[sen_ids],
+                    self.activation_offsets[sen_ids + 1],
+                )
+
                 # Insert extracted batch activations into full corpus activations dict.
-                batch_start = self.activation_ranges[batch.sen_idx[0]][0]
-                batch_stop = self.activation_ranges[batch.sen_idx[-1]][1]
                 for a_name, activations in batch_activations.items():
-                    corpus_activations[a_name][batch_start:batch_stop] = activations
+                    corpus_activations[a_name][rows] = activations
 
-        return corpus_activations
+    def _extract_shards(
+        self, corpus: Corpus, corpus_activations: ActivationDict, dump: bool
+    ) -> None:
+        """Splits the corpus into contiguous shards that are extracted
+        by separate worker processes.
 
-    def _filter_corpus(self) -> Corpus:
-        """ Skip items for which selection_func yields 0 activations. """
-        sen_ids = [
-            idx
-            for idx, (start, stop) in enumerate(self.activation_ranges)
-            if start != stop
+        Workers are forked, so the model, corpus and selection_func
+        don't need to be pickled. Activations are written to the
+        memory-mapped output files or to shared memory tensors, at the
+        same offsets as a single-process extraction.
+        """
+        assert (
+            str(self.model.device) == "cpu"
+        ), "Multi-process extraction is only supported on cpu"
+        assert (
+            "fork" in multiprocessing.get_all_start_methods()
+        ), "Multi-process extraction requires the `fork` start method"
+
+        for activations in corpus_activations.values():
+            activations.share_memory_()
+
+        shards = self._create_shards(corpus)
+        num_threads = max(1, torch.get_num_threads() // len(shards))
+
+        mp_context = multiprocessing.get_context("fork")
+        workers = [
+            mp_context.Process(
+                target=self._extract_shard,
+                args=(shard, corpus_activations, dump, num_threads, f"shard {idx}"),
+            )
+            for idx, shard in enumerate(shards)
         ]
 
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        for idx, worker in enumerate(workers):
+            if worker.exitcode != 0:
+                raise RuntimeError(
+                    f"Extraction of shard {idx} failed with exit code {worker.exitcode}"
+                )
+
+    def _extract_shard(
+        self,
+        shard: Corpus,
+        corpus_activations: ActivationDict,
+        dump: bool,
+        num_threads: int,
+        desc: str,
+    ) -> None:
+        """ Entry point of an extraction worker process. """
+        torch.set_num_threads(num_threads)
+
+        self._extract_batches(shard, corpus_activations, dump, desc=desc)
+
+        if dump:
+            self.activation_writer.close()
+            self.activation_writer.flush()
+
+    def _create_shards(self, corpus: Corpus) -> List[Corpus]:
+        """Splits a corpus into ``num_workers`` shards that contain a
+        roughly equal number of tokens.
+
+        Each shard consists of a consecutive run of the batches of a
+        single-process extraction. As the iterator of a shard then
+        yields these same batches, each batch is computed exactly as it
+        would have been without sharding.
+        """
+        iterator = self._create_iterator(corpus)
+        iterator.create_batches()
+        batches = [[ex.sen_idx for ex in batch] for batch in iterator.batches]
+
+        return self._shard_batches(corpus, batches)
+
+    def _shard_batches(self, corpus: Corpus, batches: List[List[int]]) -> List[Corpus]:
+        """Splits a list of batches of sentence ids into ``num_workers``
+        consecutive runs of batches, that contain a roughly equal number
+        of tokens.
+        """
+        sen_lens = {ex.sen_idx: len(getattr(ex, self.sen_column)) for ex in corpus}
+        batch_lens = torch.tensor(
+            [sum(sen_lens[sen_idx] for sen_idx in batch) for batch in batches]
+        )
+        cum_batch_lens = torch.cumsum(batch_lens, dim=0)
+
+        num_shards = min(self.num_workers, len(batches))
+        shard_bounds = torch.arange(1, num_shards) * cum_batch_lens[-1] / num_shards
+        shard_starts = (torch.searchsorted(cum_batch_lens, shard_bounds) + 1).tolist()
+
+        shard_starts = [0, *shard_starts]
+        shard_stops = [*shard_starts[1:], len(batches)]
+
+        shards = [
+            corpus.slice(
+                [sen_idx for batch in batches[start:stop] for sen_idx in batch]
+            )
+            for start, stop in zip(shard_starts, shard_stops)
+            if start < stop
+        ]
+
+        return shards
+
+    def _filter_corpus(self, dump: bool = False) -> Corpus:
+        """Skip items for which selection_func yields 0 activations,
+        and items that have already been committed to the store.
+        """
+        sen_lengths = self.activation_offsets[1:] - self.activation_offsets[:-1]
+        sen_mask = sen_lengths > 0
+        if dump:
+            sen_mask &= ~self.activation_writer.completed_sentences()
+
+            n_completed = int((sen_lengths > 0).sum() - sen_mask.sum())
+            if n_completed > 0:
+                print(f"Resuming extraction, skipping {n_completed} sentences.")
+
+        sen_ids = torch.nonzero(sen_mask).squeeze(1).tolist()
+
         if len(sen_ids) != len(self.corpus):
             return self.corpus.slice(sen_ids)
 
         return self.corpus
 
+    def _calc_max_tokens(
+        self, max_tokens: Optional[int], memory_budget: Optional[int]
+    ) -> Optional[int]:
+        """Converts a memory budget into a cap on the number of padded
+        tokens in a batch.
+        """
+        if memory_budget is None:
+            return max_tokens
+
+        element_size = torch.empty(0).element_size()
+        token_size = element_size * sum(
+            self.model.nhid(a_name) for a_name in self.model_activation_names
+        )
+        budget_tokens = max(1, memory_budget // token_size)
+
+        self._check_memory_budget(budget_tokens, token_size)
+
+        if max_tokens is None:
+            return budget_tokens
+
+        return min(max_tokens, budget_tokens)
+
+    def _check_memory_budget(self, budget_tokens: int, token_size: int) -> None:
+        """Raises a ValueError if the longest sentence of the corpus does
+        not fit within the token budget of a memory budget.
+        """
+        max_sen_len = max(
+            (len(getattr(ex, self.sen_column)) for ex in self.corpus), default=0
+        )
+
+        if budget_tokens < max_sen_len:
+            raise ValueError(
+                f"memory_budget is too small for the longest sentence of "
+                f"{max_sen_len} tokens, which requires {max_sen_len * token_size} bytes"
+            )
+
+    def _sen_token_ids(self, corpus: Corpus) -> Dict[int, List[int]]:
+        """ Maps the sentence index of each item to its token ids. """
+        stoi = corpus.fields[self.sen_column].vocab.stoi
+
+        return {
+            ex.sen_idx: [stoi[token] for token in getattr(ex, self.sen_column)]
+            for ex in corpus
+        }
+
+    def _create_iterator(self, corpus: Corpus) -> Iterator:
+        """Creates an iterator that batches sentences of similar length.
+
+        Activations are scattered back to their position in the corpus,
+        so the order in which sentences are processed is irrelevant.
+        """
+        return create_iterator(
+            corpus,
+            batch_size=self.batch_size,
+            device=self.model.device,
+            sort=True,
+            max_tokens=self.max_tokens,
+        )
+
     def _extract_batch(self, batch: Batch) -> ActivationDict:
         """Processes the items in `batch` and selects the activations
         that should should be extracted according to selection_func.
         """
         sens, sen_lens = getattr(batch, self.sen_column)
 
-        compute_out = any("out" in a_name for a_name in self.activation_names)
+        compute_out = any("out" in a_name for a_name in self.model_activation_names)
         with torch.no_grad():
             # a_name -> batch_size x max_sen_len x nhid
             all_activations: ActivationDict = self.model(
@@ -179,6 +443,7 @@ class Extractor:
                 input_lengths=sen_lens,
                 compute_out=compute_out,
                 only_return_top_embs=False,
+                activation_names=self.model_activation_names,
             )
 
         # a_name -> n_items_in_batch x nhid
@@ -191,40 +456,120 @@ class Extractor:
         all_activations: ActivationDict,
         batch: Batch,
     ) -> ActivationDict:
-        """ Selects only the activations that pass selection_func. """
-        batch_start = self.activation_ranges[batch.sen_idx[0]][0]
-        batch_end = self.activation_ranges[batch.sen_idx[-1]][1]
-        n_items_in_batch = batch_end - batch_start
-        batch_activations: ActivationDict = self._init_activation_dict(n_items_in_batch)
+        """Selects only the activations that pass selection_func.
 
-        a_idx = 0
+        The selection_func has already been compiled into a flat index
+        of token positions by ``_create_activation_offsets``, so all
+        selected activations of an activation name are gathered in a
+        single indexed copy.
+        """
+        batch_ids, positions = self._selected_batch_positions(batch)
 
-        for b_idx, sen_idx in enumerate(batch.sen_idx):
-            item = self.corpus[sen_idx]
-            sen_len = len(getattr(item, self.sen_column))
-            for w_idx in range(sen_len):
-                if self.selection_func(w_idx, item):
-                    for a_name in batch_activations:
-                        selected_activation = all_activations[a_name][b_idx][w_idx]
-                        batch_activations[a_name][a_idx] = selected_activation
-                    a_idx += 1
+        # a_name -> n_items_in_batch x nhid
+        batch_activations: ActivationDict = {
+            a_name: all_activations[a_name][batch_ids, positions]
+            for a_name in self.model_activation_names
+        }
 
-        return batch_activations
+        return self._finalize_activations(batch_activations)
+
+    def _finalize_activations(
+        self, batch_activations: ActivationDict
+    ) -> ActivationDict:
+        """Applies the deferred decoder projection to the selected
+        activations, and moves the requested activations to cpu.
+        """
+        # The decoder projection is only applied to the selected activations.
+        if self.deferred_out_name in self.activation_names:
+            top_hx = batch_activations[self.model.top_layer, "hx"]
+            batch_activations[self.deferred_out_name] = self.model.decode(
+                top_hx, vocab_ids=self.out_vocab_ids
+            )
+
+        return {
+            a_name: batch_activations[a_name].cpu() for a_name in self.activation_names
+        }
+
+    def _selected_batch_positions(self, batch: Batch) -> Tuple[Tensor, Tensor]:
+        """Returns the batch item and token position of each activation
+        in a batch that passes selection_func.
+        """
+        sen_ids = torch.tensor(batch.sen_idx, dtype=torch.long)
+        starts = self.activation_offsets[sen_ids]
+        stops = self.activation_offsets[sen_ids + 1]
+
+        # Maps each selected activation to the batch item it belongs to.
+        batch_ids = torch.repeat_interleave(torch.arange(len(sen_ids)), stops - starts)
+        positions = self.selected_positions[ranges_to_row_ids(starts, stops)]
+
+        return batch_ids, positions
+
+    @property
+    def deferred_out_name(self) -> Optional[ActivationName]:
+        """The name of the decoder activations of a recurrent model,
+        which are computed after the activations have been selected.
+        """
+        if isinstance(self.model, RecurrentLM):
+            return self.model.top_layer, "out"
+
+        return None
+
+    def _create_model_activation_names(self) -> ActivationNames:
+        """Returns the activation names that are computed by the model.
 
-    def _create_activation_ranges(self) -> ActivationRanges:
-        activation_ranges: ActivationRanges = []
-        tot_extracted = 0
+        The decoder projection of a recurrent model is deferred until
+        after selection, so instead of the ``out`` activations the top
+        layer hidden state is computed.
+        """
+        if self.deferred_out_name not in self.activation_names:
+            return self.activation_names
+
+        top_hx_name = (self.model.top_layer, "hx")
+        model_activation_names = [
+            a_name
+            for a_name in self.activation_names
+            if a_name != self.deferred_out_name
+        ]
+        if top_hx_name not in model_activation_names:
+            model_activation_names.append(top_hx_name)
+
+        return model_activation_names
+
+    def _nhid(self, activation_name: ActivationName) -> int:
+        """ Returns the size of an extracted activation. """
+        if activation_name == self.deferred_out_name and self.out_vocab_ids is not None:
+            return len(self.out_vocab_ids)
+
+        return self.model.nhid(activation_name)
+
+    def _create_activation_offsets(self) -> Tuple[ActivationOffsets, Tensor]:
+        """Compiles the selection_func into activation offsets.
+
+        Returns
+        -------
+        activation_offsets : ActivationOffsets
+            Tensor of size ``len(corpus) + 1``: the activations of
+            sentence ``i`` are stored at rows
+            ``activation_offsets[i]:activation_offsets[i+1]``.
+        selected_positions : Tensor
+            Flat tensor containing the token position of each extracted
+            activation within its sentence.
+        """
+        activation_offsets: List[int] = [0]
+        selected_positions: List[int] = []
 
         for item in self.corpus:
-            start = tot_extracted
             sen_len = len(getattr(item, self.sen_column))
             for w_idx in range(sen_len):
                 if self.selection_func(w_idx, item):
-                    tot_extracted += 1
+                    selected_positions.append(w_idx)
 
-            activation_ranges.append((start, tot_extracted))
+            activation_offsets.append(len(selected_positions))
 
-        return activation_ranges
+        return (
+            torch.tensor(activation_offsets, dtype=torch.long),
+            torch.tensor(selected_positions, dtype=torch.long),
+        )
 
     def _init_activation_dict(self, n_items: int, dump: bool = False) -> ActivationDict:
         # If activations are dumped we don't keep track of the full activation dictionary,
@@ -233,7 +578,7 @@ class Extractor:
             return {}
 
         corpus_activations = {
-            a_name: torch.zeros(n_items, self.model.nhid(a_name))
+            a_name: torch.zeros(n_items, self._nhid(a_name))
             for a_name in self.activation_names
         }
 
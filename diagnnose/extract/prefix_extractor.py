@@ -0,0 +1,240 @@
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from torch import Tensor
+from tqdm import tqdm
+
+from diagnnose.activations.activation_index import (
+    ranges_to_row_ids,
+    ranges_to_row_index,
+)
+from diagnnose.corpus import Corpus
+from diagnnose.models import LanguageModel
+from diagnnose.models.recurrent_lm import RecurrentLM
+from diagnnose.typedefs.activations import ActivationDict
+
+from .extractor import Extractor
+
+# Per depth: token id and parent node of each trie node at that depth
+TrieLevels = List[Tuple[Tensor, Tensor]]
+
+
+class PrefixTrieExtractor(Extractor):
+    """Extracts the activations of a recurrent LM, running each unique
+    sentence prefix of a corpus only once.
+
+    The sentences of the corpus are merged into a prefix trie, which is
+    then processed depth by depth: all trie nodes at the same depth are
+    passed through a single ``forward_step`` of the model, starting
+    from the hidden and cell states of their parent node. Sentences
+    that share a prefix, such as the minimal pairs of the syntactic
+    evaluation tasks, therefore share the forward steps of that prefix.
+    The selected activations are gathered from the trie nodes that the
+    selected token positions of a sentence end up in.
+
+    Sentences are sorted lexicographically and split into tries of at
+    most ``batch_size`` sentences, and at most ``max_tokens`` tokens if
+    a token or memory budget is provided, so sentences that share a
+    prefix end up in the same trie.
+
+    The activations are computed by the same LSTM cell as a regular
+    extraction with ``fused_lstm`` disabled. The model should provide a
+    ``forward_step`` method, like :class:`ForwardLSTM`. All arguments
+    are passed on to :class:`Extractor`.
+    """
+
+    def __init__(self, model: LanguageModel, *args, **kwargs) -> None:
+        assert self.supports_model(
+            model
+        ), "Prefix trie extraction requires a recurrent model with a forward_step"
+
+        super().__init__(model, *args, **kwargs)
+
+    @staticmethod
+    def supports_model(model: LanguageModel) -> bool:
+        """ Returns whether a model can be stepped through a prefix trie. """
+        return isinstance(model, RecurrentLM) and hasattr(model, "forward_step")
+
+    def _extract_batches(
+        self,
+        corpus: Corpus,
+        corpus_activations: ActivationDict,
+        dump: bool,
+        desc: Optional[str] = None,
+    ) -> None:
+        """Extracts the activations of a corpus trie by trie, and either
+        dumps them or inserts them into ``corpus_activations``.
+        """
+        sen_tokens = self._sen_token_ids(corpus)
+
+        trie_batches = self._create_trie_batches(sen_tokens)
+
+        for sen_ids in tqdm(trie_batches, unit="trie", desc=desc):
+            batch_activations = self._extract_trie(
+                [sen_tokens[sen_idx] for sen_idx in sen_ids],
+                torch.tensor(sen_ids, dtype=torch.long),
+            )
+
+            if dump:
+                self.activation_writer.dump_activations(batch_activations, sen_ids)
+            else:
+                sen_ids = torch.tensor(sen_ids)
+                rows = ranges_to_row_index(
+                    self.activation_offsets[sen_ids],
+                    self.activation_offsets[sen_ids + 1],
+                )
+
+                for a_name, activations in batch_activations.items():
+                    corpus_activations[a_name][rows] = activations
+
+    def _create_shards(self, corpus: Corpus) -> List[Corpus]:
+        """Splits a corpus into ``num_workers`` shards of consecutive
+        trie batches.
+
+        Sentences that share a prefix are therefore extracted by the
+        same worker, which builds the same tries as a single-process
+        extraction.
+        """
+        trie_batches = self._create_trie_batches(self._sen_token_ids(corpus))
+
+        return self._shard_batches(corpus, trie_batches)
+
+    def _create_trie_batches(self, sen_tokens: Dict[int, List[int]]) -> List[List[int]]:
+        """Splits the sentences into batches from which a single trie
+        is built.
+
+        Sentences are sorted on their tokens, so sentences that share a
+        prefix are placed next to each other. The sentence ids within a
+        batch are returned in ascending order.
+        """
+        sorted_sen_ids = sorted(sen_tokens, key=lambda sen_idx: sen_tokens[sen_idx])
+
+        batches: List[List[int]] = []
+        batch: List[int] = []
+        batch_tokens = 0
+
+        for sen_idx in sorted_sen_ids:
+            sen_len = len(sen_tokens[sen_idx])
+            batch_full = len(batch) == self.batch_size or (
+                self.max_tokens is not None and batch_tokens + sen_len > self.max_tokens
+            )
+            if len(batch) > 0 and batch_full:
+                batches.append(sorted(batch))
+                batch, batch_tokens = [], 0
+
+            batch.append(sen_idx)
+            batch_tokens += sen_len
+
+        if len(batch) > 0:
+            batches.append(sorted(batch))
+
+        return batches
+
+    @staticmethod
+    def _create_trie(sens: List[List[int]]) -> Tuple[TrieLevels, List[List[int]]]:
+        """Merges a list of token id sequences into a prefix trie.
+
+        Returns
+        -------
+        trie_levels : TrieLevels
+            For each depth a tensor with the token id of each trie node
+            at that depth, and a tensor with the index of its parent
+            node at the previous depth. Nodes at depth 0 have the root
+            as parent, which has index 0.
+        sen_nodes : List[List[int]]
+            For each sentence the index of the node at each depth that
+            its prefix up to that depth ends in.
+        """
+        # Per depth: (parent node, token id) -> node
+        depth_nodes: List[Dict[Tuple[int, int], int]] = []
+        sen_nodes: List[List[int]] = []
+
+        for sen in sens:
+            node = 0
+            nodes: List[int] = []
+            for depth, token in enumerate(sen):
+                if depth == len(depth_nodes):
+                    depth_nodes.append({})
+                node = depth_nodes[depth].setdefault(
+                    (node, token), len(depth_nodes[depth])
+                )
+                nodes.append(node)
+            sen_nodes.append(nodes)
+
+        trie_levels = [
+            (
+                torch.tensor([token for _parent, token in nodes], dtype=torch.long),
+                torch.tensor([parent for parent, _token in nodes], dtype=torch.long),
+            )
+            for nodes in depth_nodes
+        ]
+
+        return trie_levels, sen_nodes
+
+    def _extract_trie(self, sens: List[List[int]], sen_ids: Tensor) -> ActivationDict:
+        """Runs the model over the prefix trie of a batch of sentences,
+        and selects the activations that pass selection_func.
+
+        Parameters
+        ----------
+        sens : List[List[int]]
+            Token ids of each sentence in the batch.
+        sen_ids : Tensor
+            Sentence index of each sentence in the batch, in ascending
+            order.
+
+        Returns
+        -------
+        batch_activations : ActivationDict
+            Dictionary mapping activation names to the selected
+            activations, in the order of ``sen_ids``.
+            Size: a_name -> n_items_in_batch x nhid
+        """
+        trie_levels, sen_nodes = self._create_trie(sens)
+
+        starts = self.activation_offsets[sen_ids]
+        stops = self.activation_offsets[sen_ids + 1]
+        batch_ids = torch.repeat_interleave(torch.arange(len(sen_ids)), stops - starts)
+        positions = self.selected_positions[ranges_to_row_ids(starts, stops)]
+
+        # The trie node of each selected activation, at the depth of its position
+        nodes = torch.tensor(
+            [
+                sen_nodes[batch_idx][position]
+                for batch_idx, position in zip(batch_ids.tolist(), positions.tolist())
+            ],
+            dtype=torch.long,
+        )
+
+        device = self.model.device
+        positions, nodes = positions.to(device), nodes.to(device)
+        max_layer = max(layer for layer, _name in self.model_activation_names)
+
+        batch_activations: ActivationDict = {
+            a_name: torch.zeros(len(positions), self.model.nhid(a_name), device=device)
+            for a_name in self.model_activation_names
+        }
+
+        # The root of the trie holds the initial states.
+        cur_activations = self.model.init_hidden(1)
+
+        with torch.no_grad():
+            for depth, (tokens, parents) in enumerate(trie_levels):
+                prev_activations = {
+                    (layer, hc): cur_activations[layer, hc][parents.to(device)]
+                    for layer in range(max_layer + 1)
+                    for hc in ["hx", "cx"]
+                }
+                token_embeds = self.model.create_inputs_embeds(tokens.to(device))
+
+                cur_activations = self.model.forward_step(
+                    token_embeds, prev_activations, max_layer=max_layer
+                )
+
+                depth_mask = positions == depth
+                if depth_mask.any():
+                    depth_nodes = nodes[depth_mask]
+                    for a_name, activations in batch_activations.items():
+                        activations[depth_mask] = cur_activations[a_name][depth_nodes]
+
+        return self._finalize_activations(batch_activations)
@@ -4,7 +4,7 @@ from typing import Optional, Tuple
 from diagnnose.activations import ActivationReader
 from diagnnose.activations.selection_funcs import return_all
 from diagnnose.corpus import Corpus
-from diagnnose.extract import BATCH_SIZE, Extractor
+from diagnnose.extract import BATCH_SIZE, Extractor, PrefixTrieExtractor
 from diagnnose.models import LanguageModel
 from diagnnose.typedefs.activations import (
     ActivationNames,
@@ -21,8 +21,10 @@ def simple_extract(
     activation_names: ActivationNames,
     activations_dir: Optional[str] = None,
     batch_size: int = BATCH_SIZE,
+    memory_budget: Optional[int] = None,
     selection_func: SelectionFunc = return_all,
     sen_column: Optional[str] = None,
+    prefix_trie: bool = False,
 ) -> Tuple[ActivationReader, RemoveCallback]:
     """Basic extraction method.
 
@@ -45,9 +47,18 @@ def simple_extract(
         Amount of sentences processed per forward step. Higher batch
         size increases extraction speed, but should be done
         accordingly to the amount of available RAM. Defaults to 1.
+    memory_budget : int, optional
+        Maximum number of bytes the activations of a single forward
+        step may occupy, which caps the size of each batch. Defaults
+        to None.
     sen_column : str, optional
         Corpus column that will be tokenized and extracted. Defaults to
         ``corpus.sen_column``.
+    prefix_trie : bool, optional
+        Toggle to extract the activations with a
+        :class:`PrefixTrieExtractor`, which runs each unique prefix of
+        the corpus only once. Requires a recurrent model with a
+        ``forward_step`` method. Defaults to False.
 
     Returns
     -------
@@ -58,13 +69,15 @@ def simple_extract(
         that depends on the extracted activations. Removes all the
         activations that have been extracted. Takes no arguments.
     """
-    extractor = Extractor(
+    extractor_type = PrefixTrieExtractor if prefix_trie else Extractor
+    extractor = extractor_type(
         model,
         corpus,
         activation_names,
         activations_dir=activations_dir,
         selection_func=selection_func,
         batch_size=batch_size,
+        memory_budget=memory_budget,
         sen_column=sen_column or corpus.sen_column,
     )
 
@@ -0,0 +1,155 @@
+from typing import Any, List, Optional
+
+import torch
+from tqdm import tqdm
+
+from diagnnose.activations.activation_index import (
+    ranges_to_row_ids,
+    ranges_to_row_index,
+)
+from diagnnose.corpus import Corpus
+from diagnnose.models.lm_session import LMSession
+from diagnnose.models.recurrent_lm import RecurrentLM
+from diagnnose.typedefs.activations import ActivationDict
+
+from .extractor import Extractor
+
+
+class StreamingExtractor(Extractor):
+    """Extracts the activations of a continuous corpus, in which each
+    item continues the text of the previous item.
+
+    The corpus is fed to an :class:`LMSession` in chunks of consecutive
+    items, carrying the hidden and cell states of the model across
+    chunks. The activations of an item are therefore conditioned on
+    all preceding items, while only the activations of a single chunk
+    are kept in memory. Chunks contain at most ``batch_size`` items,
+    and at most ``max_tokens`` tokens if a token or memory budget is
+    provided.
+
+    As the items depend on each other the corpus is processed in order
+    by a single process, and on ``resume`` the items that have already
+    been stored are run again to rebuild their context. The model
+    should accept ``init_states`` in its forward pass, like
+    :class:`ForwardLSTM`. All arguments are passed on to
+    :class:`Extractor`.
+    """
+
+    def __init__(self, model: RecurrentLM, *args: Any, **kwargs: Any) -> None:
+        assert isinstance(
+            model, RecurrentLM
+        ), "Streaming extraction requires a recurrent model"
+
+        super().__init__(model, *args, **kwargs)
+
+        assert self.num_workers == 1, "Streaming extraction runs in a single process"
+
+    def _check_memory_budget(self, budget_tokens: int, token_size: int) -> None:
+        """ Items that exceed the budget are passed on in pieces. """
+
+    def _filter_corpus(self, dump: bool = False) -> Corpus:
+        """ Every item provides context for the next, so none are skipped. """
+        return self.corpus
+
+    def _extract_batches(
+        self,
+        corpus: Corpus,
+        corpus_activations: ActivationDict,
+        dump: bool,
+        desc: Optional[str] = None,
+    ) -> None:
+        """Extracts the activations of a corpus chunk by chunk, and
+        either dumps them or inserts them into ``corpus_activations``.
+        """
+        sen_tokens = self._sen_token_ids(corpus)
+        session = LMSession(self.model, self.model_activation_names)
+
+        for sen_ids in tqdm(self._create_chunks(corpus), unit="chunk", desc=desc):
+            batch_activations = self._extract_chunk(
+                session, [sen_tokens[sen_idx] for sen_idx in sen_ids], sen_ids
+            )
+
+            if dump:
+                self.activation_writer.dump_activations(batch_activations, sen_ids)
+            else:
+                sen_ids = torch.tensor(sen_ids)
+                rows = ranges_to_row_index(
+                    self.activation_offsets[sen_ids],
+                    self.activation_offsets[sen_ids + 1],
+                )
+
+                for a_name, activations in batch_activations.items():
+                    corpus_activations[a_name][rows] = activations
+
+    def _extract_chunk(
+        self, session: LMSession, sens: List[List[int]], sen_ids: List[int]
+    ) -> ActivationDict:
+        """Runs the session over a chunk of consecutive items, and
+        selects the activations that pass selection_func.
+
+        An item that is longer than ``max_tokens`` forms a chunk of its
+        own, which is passed to the session in pieces of ``max_tokens``
+        tokens.
+        """
+        chunk_tokens = [token for sen in sens for token in sen]
+
+        sen_ids = torch.tensor(sen_ids, dtype=torch.long)
+        starts = self.activation_offsets[sen_ids]
+        stops = self.activation_offsets[sen_ids + 1]
+
+        # Position of the first token of each item within the chunk
+        sen_lens = torch.tensor([len(sen) for sen in sens], dtype=torch.long)
+        sen_starts = torch.cumsum(sen_lens, dim=0) - sen_lens
+
+        positions = self.selected_positions[ranges_to_row_ids(starts, stops)]
+        positions += torch.repeat_interleave(sen_starts, stops - starts)
+        positions = positions.to(self.model.device)
+
+        batch_activations: ActivationDict = {
+            a_name: torch.zeros(
+                len(positions), self.model.nhid(a_name), device=self.model.device
+            )
+            for a_name in self.model_activation_names
+        }
+
+        piece_size = max(1, self.max_tokens or len(chunk_tokens))
+        for piece_start in range(0, len(chunk_tokens), piece_size):
+            piece_tokens = chunk_tokens[piece_start : piece_start + piece_size]
+
+            with torch.no_grad():
+                # a_name -> piece_len x nhid
+                piece_activations = session.step(
+                    torch.tensor(piece_tokens, dtype=torch.long)
+                )
+
+            piece_mask = (positions >= piece_start) & (
+                positions < piece_start + len(piece_tokens)
+            )
+            piece_positions = positions[piece_mask] - piece_start
+            for a_name, activations in batch_activations.items():
+                activations[piece_mask] = piece_activations[a_name][piece_positions]
+
+        return self._finalize_activations(batch_activations)
+
+    def _create_chunks(self, corpus: Corpus) -> List[List[int]]:
+        """ Splits the corpus into chunks of consecutive items. """
+        chunks: List[List[int]] = []
+        chunk: List[int] = []
+        chunk_tokens = 0
+
+        for ex in corpus:
+            sen_len = len(getattr(ex, self.sen_column))
+            chunk_full = len(chunk) == self.batch_size or (
+                self.max_tokens is not None and chunk_tokens + sen_len > self.max_tokens
+            )
+            if len(chunk) > 0 and chunk_full:
+                chunks.append(chunk)
+                chunk, chunk_tokens = [], 0
+
+            chunk.append(ex.sen_idx)
+            chunk_tokens += sen_len
+
+        if len(chunk) > 0:
+            chunks.append(chunk)
+
+        return chunks
@@ -0,0 +1,214 @@
+from typing import Any, Union
+
+import torch
+from torch import Tensor
+from torchtext.data import Batch
+
+from diagnnose.activations.selection_funcs import return_all
+from diagnnose.corpus import Corpus
+from diagnnose.models.recurrent_lm import RecurrentLM
+from diagnnose.typedefs.activations import (
+    ActivationDict,
+    ActivationName,
+    ActivationNames,
+    SelectionFunc,
+)
+
+from .extractor import Extractor
+
+VOCAB_CHUNK_SIZE = 8192
+
+
+class SurprisalExtractor(Extractor):
+    """Extracts the log-probability of each next token of a corpus.
+
+    For each token position that passes ``selection_func`` only the
+    log-probability that the model assigns to the actual next token is
+    stored, optionally together with the entropy of the next token
+    distribution and the ids of the k most likely next tokens. The
+    decoder is applied to the selected hidden states in chunks of the
+    vocabulary, using a running log-sum-exp, so the full
+    ``batch x max_sen_len x vocab_size`` logits are never materialized.
+
+    The statistics are stored as activations of the top layer, named
+    ``log_prob``, ``entropy`` and ``top_k``, and are aligned with the
+    ``activation_ranges`` of the extraction. The surprisal of a token
+    is the negated ``log_prob`` at the preceding position. Positions
+    without a next token, i.e. the final token of a sentence, have a
+    NaN ``log_prob``. The ``top_k`` ids are stored in the dtype of the
+    store and should be cast to ``long`` before indexing.
+
+    All other arguments, such as ``activations_dir`` and
+    ``batch_size``, are passed on to :class:`Extractor`.
+
+    Parameters
+    ----------
+    model : RecurrentLM
+        Recurrent language model with a decoder projection.
+    corpus : Corpus
+        Corpus containing sentences to be extracted.
+    selection_func : Union[SelectionFunc, str]
+        Function which determines for which tokens the next token
+        statistics are extracted. Defaults to all tokens.
+    top_k : int, optional
+        Number of most likely next token ids that are stored for each
+        position. Defaults to 0.
+    compute_entropy : bool, optional
+        Toggle to store the entropy of the next token distribution.
+        Defaults to False.
+    vocab_chunk_size : int, optional
+        Number of decoder rows that are projected onto at once.
+        Defaults to 8192.
+    """
+
+    def __init__(
+        self,
+        model: RecurrentLM,
+        corpus: Corpus,
+        selection_func: Union[SelectionFunc, str] = return_all,
+        top_k: int = 0,
+        compute_entropy: bool = False,
+        vocab_chunk_size: int = VOCAB_CHUNK_SIZE,
+        **kwargs: Any,
+    ) -> None:
+        assert (
+            getattr(model, "decoder_w", None) is not None
+        ), "Surprisal extraction requires a model with a decoder projection"
+        assert top_k <= model.decoder_w.size(0), "top_k exceeds the vocabulary size"
+
+        self.top_k = top_k
+        self.compute_entropy = compute_entropy
+        self.vocab_chunk_size = vocab_chunk_size
+
+        activation_names: ActivationNames = [(model.top_layer, "log_prob")]
+        if compute_entropy:
+            activation_names.append((model.top_layer, "entropy"))
+        if top_k > 0:
+            activation_names.append((model.top_layer, "top_k"))
+
+        super().__init__(
+            model,
+            corpus,
+            activation_names=activation_names,
+            selection_func=selection_func,
+            **kwargs,
+        )
+
+    def _create_model_activation_names(self) -> ActivationNames:
+        """ Only the top layer hidden state is computed by the model. """
+        return [(self.model.top_layer, "hx")]
+
+    def _nhid(self, activation_name: ActivationName) -> int:
+        if activation_name[1] == "top_k":
+            return self.top_k
+
+        return 1
+
+    def _select_activations(
+        self,
+        all_activations: ActivationDict,
+        batch: Batch,
+    ) -> ActivationDict:
+        """Computes the next token statistics of the hidden states that
+        pass selection_func.
+        """
+        batch_ids, positions = self._selected_batch_positions(batch)
+
+        # Shape: n_items_in_batch x nhid
+        hidden = all_activations[self.model.top_layer, "hx"][batch_ids, positions]
+
+        sens, sen_lens = getattr(batch, self.sen_column)
+        sen_lens = torch.as_tensor(sen_lens, device=sens.device)
+
+        # Shape: n_items_in_batch, -1 if a position has no next token
+        has_next = positions + 1 < sen_lens[batch_ids]
+        next_positions = torch.where(has_next, positions + 1, positions)
+        next_ids = torch.where(has_next, sens[batch_ids, next_positions], -1)
+
+        statistics = self._next_token_statistics(hidden, next_ids)
+
+        return {
+            (self.model.top_layer, name): activations.cpu()
+            for name, activations in statistics.items()
+        }
+
+    def _next_token_statistics(
+        self, hidden: Tensor, next_ids: Tensor
+    ) -> ActivationDict:
+        """Computes the log-probability of the next token, and the
+        optional entropy and top-k ids, from a batch of hidden states.
+
+        The vocabulary is processed in chunks: for each chunk the
+        running maximum logit, the sum of the exponentiated logits and
+        the sum of the exponentiated logits weighted by the logits are
+        updated. The log partition function and the entropy then follow
+        from these running sums.
+
+        Parameters
+        ----------
+        hidden : Tensor
+            Top layer hidden states. Size: n_items x nhid
+        next_ids : Tensor
+            Id of the next token of each hidden state, -1 if there is
+            no next token. Size: n_items
+
+        Returns
+        -------
+        statistics : Dict[str, Tensor]
+            Dictionary mapping each statistic name to a tensor of shape
+            n_items x 1, or n_items x top_k for the top-k ids.
+        """
+        decoder_w: Tensor = self.model.decoder_w
+        decoder_b: Tensor = self.model.decoder_b
+        vocab_size = decoder_w.size(0)
+        n_items = hidden.size(0)
+
+        running_max = torch.full((n_items,), -float("inf"), device=hidden.device)
+        sum_exp = torch.zeros(n_items, device=hidden.device)
+        sum_exp_logits = torch.zeros(n_items, device=hidden.device)
+
+        top_logits = hidden.new_empty(n_items, 0)
+        top_ids = torch.empty(n_items, 0, dtype=torch.long, device=hidden.device)
+
+        for start in range(0, vocab_size, self.vocab_chunk_size):
+            stop = min(start + self.vocab_chunk_size, vocab_size)
+
+            # Shape: n_items x chunk_size
+            logits = hidden @ decoder_w[start:stop].t() + decoder_b[start:stop]
+
+            chunk_max = logits.max(dim=1).values
+            new_max = torch.max(running_max, chunk_max)
+            scale = torch.exp(running_max - new_max)
+            exp_logits = torch.exp(logits - new_max.unsqueeze(1))
+
+            sum_exp = sum_exp * scale + exp_logits.sum(dim=1)
+            if self.compute_entropy:
+                sum_exp_logits = sum_exp_logits * scale + (exp_logits * logits).sum(1)
+            running_max = new_max
+
+            if self.top_k > 0:
+                chunk_ids = torch.arange(start, stop, device=hidden.device)
+                top_logits = torch.cat((top_logits, logits), dim=1)
+                top_ids = torch.cat((top_ids, chunk_ids.expand(n_items, -1)), dim=1)
+
+                k = min(self.top_k, top_logits.size(1))
+                top_logits, top_indices = top_logits.topk(k, dim=1)
+                top_ids = top_ids.gather(1, top_indices)
+
+        log_norm = running_max + torch.log(sum_exp)
+
+        has_next = next_ids >= 0
+        next_ids = next_ids.clamp(min=0)
+        next_logits = (hidden * decoder_w[next_ids]).sum(dim=1) + decoder_b[next_ids]
+        log_prob = torch.where(
+            has_next, next_logits - log_norm, torch.full_like(log_norm, float("nan"))
+        )
+
+        statistics = {"log_prob": log_prob.unsqueeze(1)}
+        if self.compute_entropy:
+            entropy = log_norm - sum_exp_logits / sum_exp
+            statistics["entropy"] = entropy.unsqueeze(1)
+        if self.top_k > 0:
+            statistics["top_k"] = top_ids.to(hidden.dtype)
+
+        return statistics
@@ -28,6 +28,7 @@ class LanguageModel(ABC, nn.Module):
         input_lengths: Optional[Tensor] = None,
         compute_out: bool = False,
         only_return_top_embs: bool = False,
+        activation_names: Optional[ActivationNames] = None,
     ) -> Union[ActivationDict, Tensor]:
         """Performs a single forward pass across all LM layers.
 
@@ -55,6 +56,11 @@ class LanguageModel(ABC, nn.Module):
             Toggle to only return the tensor of the hidden state of the
             top layer of the network, instead of the full activation
             dictionary. Defaults to False.
+        activation_names : ActivationNames, optional
+            The activation names that should be returned. Models can
+            use this to skip the storage and computation of activations
+            that are not needed. Defaults to all activation names of
+            the model.
 
         Returns
         -------
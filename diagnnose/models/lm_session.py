@@ -0,0 +1,90 @@
+from typing import Iterable, Iterator, Optional
+
+import torch
+from torch import Tensor
+
+from diagnnose.models.recurrent_lm import RecurrentLM
+from diagnnose.typedefs.activations import ActivationDict, ActivationNames
+
+
+class LMSession:
+    """Runs a recurrent LM incrementally over a stream of token chunks.
+
+    The hidden and cell states at the end of a chunk are carried over
+    to the start of the next chunk, so a long document can be fed to
+    the model chunk by chunk without losing its context, while only the
+    activations of a single chunk are kept in memory. The carried
+    states are detached from the graph of the previous chunk.
+
+    The model should accept ``init_states`` in its forward pass, like
+    :class:`ForwardLSTM`.
+
+    Parameters
+    ----------
+    model : RecurrentLM
+        Recurrent language model that is run over the token stream.
+    activation_names : ActivationNames, optional
+        The activation names that are returned for each chunk.
+        Defaults to all activation names of the model.
+    """
+
+    def __init__(
+        self, model: RecurrentLM, activation_names: Optional[ActivationNames] = None
+    ) -> None:
+        self.model = model
+        self.activation_names = activation_names or model.activation_names()
+
+        self.state_names: ActivationNames = [
+            (layer, hc) for layer in range(model.num_layers) for hc in ["hx", "cx"]
+        ]
+
+        self.states: ActivationDict = {}
+        self.reset()
+
+    def reset(self) -> None:
+        """ Resets the carried states to the initial states of the model. """
+        self.states = self.model.init_hidden(1)
+
+    def step(self, input_ids: Tensor) -> ActivationDict:
+        """Runs the model over the next chunk of the token stream.
+
+        Parameters
+        ----------
+        input_ids : Tensor
+            Token ids of the chunk. Size: chunk_len
+
+        Returns
+        -------
+        activations : ActivationDict
+            Dictionary mapping activation names to the activations of
+            the chunk. Size: a_name -> chunk_len x nhid
+        """
+        if len(input_ids) == 0:
+            return {
+                a_name: torch.zeros(0, self.model.nhid(a_name))
+                for a_name in self.activation_names
+            }
+
+        activation_names = [*self.activation_names]
+        for a_name in self.state_names:
+            if a_name not in activation_names:
+                activation_names.append(a_name)
+
+        # a_name -> 1 x chunk_len x nhid
+        all_activations: ActivationDict = self.model(
+            input_ids=input_ids.unsqueeze(0).to(self.model.device),
+            activation_names=activation_names,
+            init_states=self.states,
+        )
+
+        self.states = {
+            a_name: all_activations[a_name][:, -1].detach()
+            for a_name in self.state_names
+        }
+
+        return {a_name: all_activations[a_name][0] for a_name in self.activation_names}
+
+    def stream(self, chunks: Iterable[Tensor]) -> Iterator[ActivationDict]:
+        """ Yields the activations of each chunk of a token stream. """
+        for chunk in chunks:
+            yield self.step(chunk)
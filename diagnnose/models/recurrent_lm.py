@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from torch import Tensor
 
@@ -14,6 +14,8 @@ class RecurrentLM(LanguageModel):
     split_order: List[str]
     use_char_embs: bool = False
     init_states: ActivationDict = {}
+    decoder_w: Optional[Tensor] = None
+    decoder_b: Optional[Tensor] = None
 
     @property
     def num_layers(self) -> int:
@@ -65,6 +67,29 @@ class RecurrentLM(LanguageModel):
         """
         return hidden[self.top_layer, "hx"].squeeze()
 
+    def decode(self, hidden: Tensor, vocab_ids: Optional[Tensor] = None) -> Tensor:
+        """Applies the decoder projection to a batch of hidden states.
+
+        Parameters
+        ----------
+        hidden : Tensor
+            Top layer hidden states. Size: batch_size x nhid
+        vocab_ids : Tensor, optional
+            Vocabulary ids to which the projection is restricted. If
+            not provided the full vocabulary is projected onto.
+
+        Returns
+        -------
+        out : Tensor
+            Decoder logits. Size: batch_size x vocab_size
+        """
+        decoder_w, decoder_b = self.decoder_w, self.decoder_b
+        if vocab_ids is not None:
+            decoder_w = decoder_w[vocab_ids]
+            decoder_b = decoder_b[vocab_ids]
+
+        return hidden @ decoder_w.t() + decoder_b
+
     def nhid(self, activation_name: ActivationName) -> int:
         """Returns number of hidden units for a (layer, name) tuple.
 
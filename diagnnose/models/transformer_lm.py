@@ -60,6 +60,7 @@ class TransformerLM(LanguageModel):
         attention_mask: Optional[Tensor] = None,
         compute_out: bool = True,
         only_return_top_embs: bool = True,
+        activation_names: Optional[ActivationNames] = None,
     ) -> Union[ActivationDict, Tensor]:
         if input_ids is not None and inputs_embeds is not None:
             raise ValueError(
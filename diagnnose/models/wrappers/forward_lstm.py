@@ -1,10 +1,15 @@
 import os
 from itertools import product
-from typing import Dict, Optional, Tuple, Union
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
 import torch
+import torch.nn as nn
 from torch import Tensor
-from torch.nn.utils.rnn import PackedSequence, pack_padded_sequence
+from torch.nn.utils.rnn import (
+    PackedSequence,
+    pack_padded_sequence,
+    pad_packed_sequence,
+)
 
 from diagnnose.attribute import ShapleyTensor
 from diagnnose.models.recurrent_lm import RecurrentLM
@@ -12,8 +17,12 @@ from diagnnose.typedefs.activations import (
     ActivationDict,
     ActivationNames,
     LayeredTensors,
+    SizeDict,
 )
 
+# Weights of a torch LSTM with their version counter, and the gate order.
+LSTMSource = Tuple[List[Tuple[Tensor, int]], Tuple[str, ...]]
+
 
 class ForwardLSTM(RecurrentLM):
     """Defines a default uni-directional n-layer LSTM.
@@ -35,6 +44,15 @@ class ForwardLSTM(RecurrentLM):
     decoder_name : str, optional
         Name of the linear decoder in the model state_dict.
         Defaults to `decoder`.
+    fused_lstm : bool, optional
+        Toggle to run the recurrence of each layer through the fused
+        kernel of a :class:`torch.nn.LSTM`, instead of stepping through
+        the LSTM cell in Python. The gates and cell states that are
+        requested are then reconstructed afterwards, in a single
+        batched pass per layer. ShapleyTensor inputs always pass
+        through the Python cell. If not provided the fused kernel is
+        only used when no gates or cell states are requested.
+        Defaults to None.
     """
 
     ih_concat_order = ["h", "i"]
@@ -47,6 +65,7 @@ class ForwardLSTM(RecurrentLM):
         rnn_name: str = "rnn",
         encoder_name: str = "encoder",
         decoder_name: str = "decoder",
+        fused_lstm: Optional[bool] = None,
     ) -> None:
         super().__init__()
         print("Loading pretrained model...")
@@ -57,6 +76,13 @@ class ForwardLSTM(RecurrentLM):
         self.device: str = device
         self.weight: LayeredTensors = {}
         self.bias: LayeredTensors = {}
+        # Instance dict, the class-level default would be shared between models
+        self.sizes: SizeDict = {}
+
+        self.fused_lstm = fused_lstm
+        # Torch LSTMs are cached along with the weights they are built from.
+        self._fused_lstms: Dict[int, Tuple[nn.LSTM, LSTMSource]] = {}
+        self._stacked_lstm: Optional[Tuple[nn.LSTM, LSTMSource]] = None
 
         self._set_lstm_weights(params, rnn_name)
 
@@ -76,7 +102,25 @@ class ForwardLSTM(RecurrentLM):
         input_lengths: Optional[Tensor] = None,
         compute_out: bool = False,
         only_return_top_embs: bool = False,
+        activation_names: Optional[ActivationNames] = None,
+        init_states: Optional[ActivationDict] = None,
     ) -> Union[ActivationDict, Tensor]:
+        """Performs a forward pass across all LSTM layers.
+
+        Only the activations in ``activation_names`` are stored, and
+        layers above the highest requested layer are not computed. If
+        no activation names are provided all activations are returned,
+        or only the top layer activations if ``only_return_top_embs``
+        is set.
+
+        The recurrence starts from ``init_states`` if provided, a dict
+        mapping the ``hx`` and ``cx`` of each layer to a tensor of
+        shape batch_size x nhid, and from the model's initial states
+        otherwise.
+
+        See :meth:`LanguageModel.forward` for a description of the
+        other parameters.
+        """
         if input_ids is not None and inputs_embeds is not None:
             raise ValueError(
                 "You cannot specify both input_ids and inputs_embeds at the same time"
@@ -88,10 +132,69 @@ class ForwardLSTM(RecurrentLM):
         if len(inputs_embeds.shape) == 2:
             inputs_embeds = inputs_embeds.unsqueeze(0)
 
+        if only_return_top_embs:
+            top_name = "out" if compute_out else "hx"
+            activation_names = [(self.top_layer, top_name)]
+        elif activation_names is None:
+            activation_names = self.activation_names(compute_out)
+
+        if init_states is None:
+            init_states = self.init_hidden(inputs_embeds.size(0))
+
+        if self._use_fused_lstm(inputs_embeds, activation_names):
+            all_activations = self._forward_fused(
+                inputs_embeds, input_lengths, activation_names, init_states
+            )
+        else:
+            all_activations = self._forward_cells(
+                inputs_embeds, input_lengths, activation_names, init_states
+            )
+
+        if only_return_top_embs and compute_out:
+            return all_activations[self.top_layer, "out"]
+        elif only_return_top_embs:
+            return all_activations[self.top_layer, "hx"]
+
+        return all_activations
+
+    def _use_fused_lstm(
+        self,
+        inputs_embeds: Union[Tensor, ShapleyTensor],
+        activation_names: ActivationNames,
+    ) -> bool:
+        """Determines whether the forward pass is run through the fused
+        LSTM kernel.
+
+        If ``fused_lstm`` is not set the fused kernel is only used when
+        the activations don't need to be reconstructed afterwards.
+        """
+        if isinstance(inputs_embeds, ShapleyTensor):
+            return False
+
+        if self.fused_lstm is None:
+            return all(name in ["emb", "hx", "out"] for _, name in activation_names)
+
+        return self.fused_lstm
+
+    def _forward_cells(
+        self,
+        inputs_embeds: Union[Tensor, ShapleyTensor],
+        input_lengths: Optional[Tensor],
+        activation_names: ActivationNames,
+        init_states: ActivationDict,
+    ) -> ActivationDict:
+        """ Steps through the LSTM cell of each layer in Python. """
+        compute_out = (self.top_layer, "out") in activation_names
+        max_layer = max(layer for layer, _name in activation_names)
+
         iterator, unsorted_indices = self._create_iterator(inputs_embeds, input_lengths)
 
-        all_activations = self._init_activations(inputs_embeds, compute_out)
-        cur_activations = self.init_hidden(inputs_embeds.size(0))
+        all_activations = self._init_activations(inputs_embeds, activation_names)
+        # The initial states follow the batch items into their sorted order
+        sorted_indices = torch.argsort(unsorted_indices)
+        cur_activations = {
+            a_name: states[sorted_indices] for a_name, states in init_states.items()
+        }
 
         for w_idx, input_ in enumerate(iterator):
             num_input = input_.size(0)
@@ -99,7 +202,7 @@ class ForwardLSTM(RecurrentLM):
                 cur_activations[a_name] = cur_activations[a_name][:num_input]
 
             cur_activations = self.forward_step(
-                input_, cur_activations, compute_out=compute_out
+                input_, cur_activations, compute_out=compute_out, max_layer=max_layer
             )
 
             for a_name in all_activations:
@@ -109,13 +212,345 @@ class ForwardLSTM(RecurrentLM):
         for a_name, activations in all_activations.items():
             all_activations[a_name] = activations[unsorted_indices]
 
-        if only_return_top_embs and compute_out:
-            return all_activations[self.top_layer, "out"]
-        elif only_return_top_embs:
-            return all_activations[self.top_layer, "hx"]
-
         return all_activations
 
+    def _forward_fused(
+        self,
+        inputs_embeds: Tensor,
+        input_lengths: Optional[Tensor],
+        activation_names: ActivationNames,
+        init_states: ActivationDict,
+    ) -> ActivationDict:
+        """Runs the recurrence of each layer through a fused LSTM, and
+        reconstructs the requested gates and cell states afterwards.
+
+        Activations at padded positions are set to 0, as in the
+        activations that are returned by ``_forward_cells``.
+        """
+        batch_size, max_sen_len = inputs_embeds.shape[:2]
+        if input_lengths is None:
+            input_lengths = torch.tensor(batch_size * [max_sen_len])
+        input_lengths = torch.as_tensor(input_lengths).cpu()
+
+        # Shape: batch_size x max_sen_len x 1
+        mask = torch.arange(max_sen_len) < input_lengths.unsqueeze(1)
+        mask = mask.unsqueeze(2).to(inputs_embeds)
+
+        # The embeddings don't require any layer to be run.
+        max_layer = max(
+            (layer for layer, name in activation_names if name != "emb"), default=-1
+        )
+
+        top_names = {(self.top_layer, "hx"), (self.top_layer, "out")}
+        if set(activation_names) <= top_names and self._can_stack_layers():
+            return self._forward_stacked(
+                inputs_embeds, input_lengths, activation_names, init_states, mask
+            )
+
+        all_activations: ActivationDict = {}
+        if (0, "emb") in activation_names:
+            all_activations[0, "emb"] = inputs_embeds * mask
+
+        input_ = inputs_embeds
+        for layer in range(max_layer + 1):
+            prev_hx = init_states[layer, "hx"]
+            prev_cx = init_states[layer, "cx"]
+
+            packed_input = pack_padded_sequence(
+                input_, input_lengths, batch_first=True, enforce_sorted=False
+            )
+            packed_hx, _ = self._get_fused_lstm(layer)(
+                packed_input, (prev_hx.unsqueeze(0), prev_cx.unsqueeze(0))
+            )
+            # Shape: batch_size x max_sen_len x nhid
+            hx, _ = pad_packed_sequence(
+                packed_hx, batch_first=True, total_length=max_sen_len
+            )
+
+            gate_names = {
+                name
+                for (a_layer, name) in activation_names
+                if a_layer == layer and name not in ["emb", "hx", "out"]
+            }
+            if len(gate_names) > 0:
+                layer_activations = self._reconstruct_gates(
+                    layer, input_, hx, prev_hx, prev_cx, gate_names
+                )
+                for a_name, activations in layer_activations.items():
+                    all_activations[a_name] = activations * mask
+
+            all_activations[layer, "hx"] = hx
+            input_ = hx
+
+        if (self.top_layer, "out") in activation_names:
+            out = input_ @ self.decoder_w.t()
+            out += self.decoder_b
+            all_activations[self.top_layer, "out"] = out * mask
+
+        return {a_name: all_activations[a_name] for a_name in activation_names}
+
+    def _forward_stacked(
+        self,
+        inputs_embeds: Tensor,
+        input_lengths: Tensor,
+        activation_names: ActivationNames,
+        init_states: ActivationDict,
+        mask: Tensor,
+    ) -> ActivationDict:
+        """Runs all layers at once through a multi-layer LSTM, if only
+        the top layer activations are requested.
+        """
+        max_sen_len = inputs_embeds.size(1)
+        layers = range(self.num_layers)
+
+        # Shape: num_layers x batch_size x nhid
+        init_hx = torch.stack([init_states[layer, "hx"] for layer in layers])
+        init_cx = torch.stack([init_states[layer, "cx"] for layer in layers])
+
+        packed_input = pack_padded_sequence(
+            inputs_embeds, input_lengths, batch_first=True, enforce_sorted=False
+        )
+        packed_hx, _ = self._get_stacked_lstm()(packed_input, (init_hx, init_cx))
+        # Shape: batch_size x max_sen_len x nhid
+        hx, _ = pad_packed_sequence(
+            packed_hx, batch_first=True, total_length=max_sen_len
+        )
+
+        all_activations: ActivationDict = {(self.top_layer, "hx"): hx}
+
+        if (self.top_layer, "out") in activation_names:
+            out = hx @ self.decoder_w.t()
+            out += self.decoder_b
+            all_activations[self.top_layer, "out"] = out * mask
+
+        return {a_name: all_activations[a_name] for a_name in activation_names}
+
+    def _reconstruct_gates(
+        self,
+        layer: int,
+        input_: Tensor,
+        hx: Tensor,
+        init_hx: Tensor,
+        init_cx: Tensor,
+        gate_names: Set[str],
+    ) -> ActivationDict:
+        """Reconstructs the gate activations of a layer from its input
+        and hidden state sequences.
+
+        The gates only depend on the input and the previous hidden
+        state, so these are computed for all time steps in one batched
+        projection. The cell state is reconstructed by an elementwise
+        recurrence over the forget and input gates.
+
+        Parameters
+        ----------
+        layer : int
+            Current RNN layer.
+        input_ : Tensor
+            Input sequence of the layer.
+            Size: batch_size x max_sen_len x nhid_i
+        hx : Tensor
+            Hidden state sequence of the layer.
+            Size: batch_size x max_sen_len x nhid
+        init_hx : Tensor
+            Initial hidden state. Size: batch_size x nhid
+        init_cx : Tensor
+            Initial cell state. Size: batch_size x nhid
+        gate_names : Set[str]
+            Names of the activations that are reconstructed, a subset
+            of the gate names and ``cx``.
+
+        Returns
+        -------
+        gate_activations : ActivationDict
+            Dictionary mapping the requested activation names to
+            tensors of shape batch_size x max_sen_len x nhid.
+        """
+        # Shape: batch_size x max_sen_len x nhid
+        prev_hx = torch.cat((init_hx.unsqueeze(1), hx[:, :-1]), dim=1)
+
+        if self.ih_concat_order == ["h", "i"]:
+            ih_concat = torch.cat((prev_hx, input_), dim=2)
+        else:
+            ih_concat = torch.cat((input_, prev_hx), dim=2)
+
+        # Shape: batch_size x max_sen_len x 4*nhid
+        proj = ih_concat @ self.weight[layer]
+        if layer in self.bias:
+            proj += self.bias[layer]
+
+        split_proj: Dict[str, Tensor] = dict(
+            zip(self.split_order, torch.split(proj, self.sizes[layer, "cx"], dim=2))
+        )
+
+        gates = {
+            "f_g": torch.sigmoid(split_proj["f"]),
+            "i_g": torch.sigmoid(split_proj["i"]),
+            "o_g": torch.sigmoid(split_proj["o"]),
+            "c_tilde_g": torch.tanh(split_proj["g"]),
+        }
+
+        gate_activations: ActivationDict = {
+            (layer, name): gates[name] for name in gate_names if name in gates
+        }
+
+        if "cx" in gate_names:
+            f_g, i_g, c_tilde_g = gates["f_g"], gates["i_g"], gates["c_tilde_g"]
+            cx = torch.empty_like(f_g)
+            cur_cx = init_cx
+            for w_idx in range(cx.size(1)):
+                cur_cx = f_g[:, w_idx] * cur_cx + i_g[:, w_idx] * c_tilde_g[:, w_idx]
+                cx[:, w_idx] = cur_cx
+            gate_activations[layer, "cx"] = cx
+
+        return gate_activations
+
+    def _get_fused_lstm(self, layer: int) -> nn.LSTM:
+        """Returns a single layer :class:`torch.nn.LSTM` with the
+        weights of ``layer``, which is created on its first use and
+        rebuilt if the weights of the layer have changed.
+        """
+        source = self._lstm_source([layer])
+        cached_lstm = self._fused_lstms.get(layer, None)
+
+        if cached_lstm is None or self._is_stale(cached_lstm[1], source):
+            w_i, w_h, bias = self._fused_lstm_params(layer)
+
+            lstm = self._create_torch_lstm(
+                w_i.size(1), w_h.size(1), 1, bias is not None
+            )
+            self._set_torch_lstm_params(lstm, 0, w_i, w_h, bias)
+
+            self._fused_lstms[layer] = (lstm, source)
+
+        return self._fused_lstms[layer][0]
+
+    def _get_stacked_lstm(self) -> nn.LSTM:
+        """Returns a multi-layer :class:`torch.nn.LSTM` with the weights
+        of all layers, which is created on its first use and rebuilt if
+        the weights of any layer have changed.
+        """
+        source = self._lstm_source(range(self.num_layers))
+
+        if self._stacked_lstm is None or self._is_stale(self._stacked_lstm[1], source):
+            params = [
+                self._fused_lstm_params(layer) for layer in range(self.num_layers)
+            ]
+            w_i, w_h, bias = params[0]
+
+            lstm = self._create_torch_lstm(
+                w_i.size(1), w_h.size(1), self.num_layers, bias is not None
+            )
+            for layer, layer_params in enumerate(params):
+                self._set_torch_lstm_params(lstm, layer, *layer_params)
+
+            self._stacked_lstm = (lstm, source)
+
+        return self._stacked_lstm[0]
+
+    def _lstm_source(self, layers: Iterable[int]) -> LSTMSource:
+        """Returns the weights that a torch LSTM of ``layers`` is built
+        from, together with their version counter and the gate order.
+
+        The version counter of a tensor is incremented by any in-place
+        update, such as loading new weights into it.
+        """
+        params = [self.weight[layer] for layer in layers]
+        params += [self.bias[layer] for layer in layers if layer in self.bias]
+
+        gate_order = tuple(self.split_order) + tuple(self.ih_concat_order)
+
+        return [(param, param._version) for param in params], gate_order
+
+    @staticmethod
+    def _is_stale(cached_source: LSTMSource, source: LSTMSource) -> bool:
+        """ Checks whether the weights of a cached torch LSTM have changed. """
+        (cached_params, cached_gate_order), (params, gate_order) = cached_source, source
+
+        return (
+            cached_gate_order != gate_order
+            or len(cached_params) != len(params)
+            or any(
+                cached_param is not param or cached_version != version
+                for (cached_param, cached_version), (param, version) in zip(
+                    cached_params, params
+                )
+            )
+        )
+
+    def _can_stack_layers(self) -> bool:
+        """A multi-layer :class:`torch.nn.LSTM` requires all layers to
+        have the same hidden size, and to either all have a bias or not.
+        """
+        nhid = self.sizes[0, "hx"]
+        equal_sizes = all(
+            self.sizes[layer, "hx"] == nhid and self.sizes[layer, "emb"] == nhid
+            for layer in range(1, self.num_layers)
+        )
+        bias_layers = {layer in self.bias for layer in range(self.num_layers)}
+
+        return equal_sizes and len(bias_layers) == 1
+
+    def _create_torch_lstm(
+        self, input_size: int, hidden_size: int, num_layers: int, bias: bool
+    ) -> nn.LSTM:
+        weight = self.weight[0]
+        lstm = nn.LSTM(input_size, hidden_size, num_layers, bias=bias, batch_first=True)
+        lstm.to(device=weight.device, dtype=weight.dtype)
+        lstm.requires_grad_(False)
+
+        return lstm
+
+    @staticmethod
+    def _set_torch_lstm_params(
+        lstm: nn.LSTM, layer: int, w_i: Tensor, w_h: Tensor, bias: Optional[Tensor]
+    ) -> None:
+        getattr(lstm, f"weight_ih_l{layer}").copy_(w_i)
+        getattr(lstm, f"weight_hh_l{layer}").copy_(w_h)
+
+        if bias is not None:
+            getattr(lstm, f"bias_ih_l{layer}").copy_(bias)
+            getattr(lstm, f"bias_hh_l{layer}").zero_()
+
+    def _fused_lstm_params(self, layer: int) -> Tuple[Tensor, Tensor, Optional[Tensor]]:
+        """Converts the weights of ``layer`` to the format of a
+        :class:`torch.nn.LSTM`.
+
+        PyTorch expects the gate weights in i, f, g, o order and the
+        input and hidden weights as separate matrices, so the weights
+        are reordered based on ``split_order`` and ``ih_concat_order``.
+
+        Returns
+        -------
+        w_i : Tensor
+            Input weights. Size: 4*nhid x nhid_i
+        w_h : Tensor
+            Hidden weights. Size: 4*nhid x nhid
+        bias : Tensor, optional
+            Combined input and hidden bias, if the layer has a bias.
+            Size: 4*nhid
+        """
+        nhid = self.sizes[layer, "hx"]
+        gate_order = ["i", "f", "g", "o"]
+
+        # Shape: (4*nhid, emb_size+nhid_h)
+        weight = self.weight[layer].t()
+        gate_weights = dict(zip(self.split_order, torch.split(weight, nhid, dim=0)))
+        weight = torch.cat([gate_weights[gate] for gate in gate_order], dim=0)
+
+        if self.ih_concat_order == ["h", "i"]:
+            w_h, w_i = weight[:, :nhid], weight[:, nhid:]
+        else:
+            w_i, w_h = weight[:, :-nhid], weight[:, -nhid:]
+
+        if layer not in self.bias:
+            return w_i, w_h, None
+
+        gate_biases = dict(zip(self.split_order, torch.split(self.bias[layer], nhid)))
+        bias = torch.cat([gate_biases[gate] for gate in gate_order])
+
+        return w_i, w_h, bias
+
     def create_inputs_embeds(self, input_ids: Tensor) -> Tensor:
         return self.word_embeddings[input_ids]
 
@@ -148,9 +583,10 @@ class ForwardLSTM(RecurrentLM):
         return iterator, packed_batch.unsorted_indices
 
     def _init_activations(
-        self, inputs_embeds: Tensor, compute_out: bool
+        self, inputs_embeds: Tensor, activation_names: ActivationNames
     ) -> ActivationDict:
-        """Returns a dictionary mapping activation names to tensors.
+        """Returns a dictionary mapping the requested activation names
+        to tensors.
 
         If the input is a ShapleyTensor this dict will store the
         ShapleyTensors as well.
@@ -164,7 +600,7 @@ class ForwardLSTM(RecurrentLM):
         batch_size, max_sen_len = inputs_embeds.shape[:2]
         all_activations: ActivationDict = {
             a_name: torch.zeros(batch_size, max_sen_len, self.nhid(a_name))
-            for a_name in self.activation_names(compute_out)
+            for a_name in activation_names
         }
 
         if isinstance(inputs_embeds, ShapleyTensor):
@@ -178,6 +614,7 @@ class ForwardLSTM(RecurrentLM):
         token_embeds: Tensor,
         prev_activations: ActivationDict,
         compute_out: bool = False,
+        max_layer: Optional[int] = None,
     ) -> ActivationDict:
         """Performs a forward pass of one step across all layers.
 
@@ -192,6 +629,10 @@ class ForwardLSTM(RecurrentLM):
             Toggles the computation of the final decoder projection.
             If set to False this projection is not calculated.
             Defaults to True.
+        max_layer : int, optional
+            Highest layer that is computed, layers above it are
+            skipped. The decoder projection is only computed if this
+            is the top layer. Defaults to the top layer.
 
         Returns
         -------
@@ -199,10 +640,13 @@ class ForwardLSTM(RecurrentLM):
             Dictionary mapping activation names to tensors of shape:
             batch_size x max_sen_len x nhid.
         """
+        if max_layer is None:
+            max_layer = self.top_layer
+
         cur_activations: ActivationDict = {}
         input_ = token_embeds
 
-        for layer in range(self.num_layers):
+        for layer in range(max_layer + 1):
             prev_hx = prev_activations[layer, "hx"]
             prev_cx = prev_activations[layer, "cx"]
 
@@ -211,7 +655,7 @@ class ForwardLSTM(RecurrentLM):
 
             input_ = cur_activations[layer, "hx"]
 
-        if compute_out:
+        if compute_out and max_layer == self.top_layer:
             out = input_ @ self.decoder_w.t()
             out += self.decoder_b
             cur_activations[self.top_layer, "out"] = out
@@ -144,6 +144,7 @@ class DCTrainer:
         rank: Optional[int] = None,
         max_epochs: int = 10,
         classifier_name: Optional[str] = None,
+        prefetch: bool = False,
     ) -> Dict[ActivationName, Any]:
         """Trains DCs on multiple activation names.
 
@@ -171,11 +172,18 @@ class DCTrainer:
         classifier_name : str, optional
             Name for the trained classifier that is saved. If not
             provided `{name}_l{layer}.pt` will be used.
+        prefetch : bool, optional
+            Toggle to read the activations of the next activation name
+            in the background while the current DC is trained.
+            Defaults to False.
         """
 
         full_results_dict = {}
 
-        for activation_name in self.activation_names:
+        for idx, activation_name in enumerate(self.activation_names):
+            if prefetch and idx + 1 < len(self.activation_names):
+                self.data_loader.prefetch(self.activation_names[idx + 1])
+
             results_dict = self._train(
                 activation_name,
                 calc_class_weights,
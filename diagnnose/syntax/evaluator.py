@@ -1,4 +1,4 @@
-from typing import Any, Dict, List, Optional, Type
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Type
 
 from transformers import PreTrainedTokenizer
 
@@ -30,9 +30,15 @@ class SyntacticEvaluator:
 
     Initialisation is performed separately from the tasks themselves,
     in order to allow multiple LMs to be ran on the same set of tasks.
+    The task corpora only depend on the tokenizer, so they are created
+    and tokenized once, after which ``run_models`` can evaluate a
+    sequence of models, such as the checkpoints of a training run.
 
     Parameters
     ----------
+    model : LanguageModel, optional
+        Language model on which the tasks are run. Can be left out if
+        the models are passed to ``run`` or ``run_models`` instead.
     tokenizer : PreTrainedTokenizer
         Tokenizer that converts tokens to their index within the LM.
     config : Dict[str, Any]
@@ -46,7 +52,7 @@ class SyntacticEvaluator:
 
     def __init__(
         self,
-        model: LanguageModel,
+        model: Optional[LanguageModel],
         tokenizer: PreTrainedTokenizer,
         config: Dict[str, Any],
         ignore_unk: bool = False,
@@ -70,12 +76,84 @@ class SyntacticEvaluator:
 
         print("Syntactic evaluation task initialization finished")
 
-    def run(self) -> Dict[str, Any]:
+    def run(self, model: Optional[LanguageModel] = None) -> Dict[str, Any]:
+        """Runs all initialised tasks.
+
+        The corpora of all tasks, subtasks and conditions are flattened
+        into a single work list, and their final hidden states are
+        computed in one shared extraction. The model is then only
+        called on large batches, instead of on the small corpus of each
+        condition separately.
+
+        Parameters
+        ----------
+        model : LanguageModel, optional
+            Language model on which the tasks are run. If not provided
+            the tasks are run on the model that has been set before.
+
+        Returns
+        -------
+        results : Dict[str, ResultsDict]
+            Dictionary mapping a task name to the results of the task.
+        """
+        if model is not None:
+            for task in self.tasks.values():
+                task.set_model(model)
+
+        if len(self.tasks) == 0:
+            return {}
+        assert all(
+            task.model is not None for task in self.tasks.values()
+        ), "No model has been provided to run the tasks on"
+
+        flat_corpora = {
+            task_name: task.flat_corpora() for task_name, task in self.tasks.items()
+        }
+        sen_columns = {
+            task_name: task.sen_columns(flat_corpora[task_name])
+            for task_name, task in self.tasks.items()
+        }
+
+        # All tasks share the model and tokenizer, so any task can run the extraction.
+        task = next(iter(self.tasks.values()))
+        final_hidden = iter(
+            task.calc_joint_final_hidden(
+                [column for columns in sen_columns.values() for column in columns]
+            )
+        )
+
         results: Dict[str, ResultsDict] = {}
 
         for task_name, task in self.tasks.items():
             print(f"\n--=={task_name.upper()}==--")
 
-            results[task_name] = task.run()
+            task_final_hidden = [next(final_hidden) for _ in sen_columns[task_name]]
+            results[task_name] = task.calc_results(
+                flat_corpora[task_name], task_final_hidden
+            )
 
         return results
+
+    def run_models(
+        self, models: Iterable[LanguageModel]
+    ) -> Iterator[Dict[str, ResultsDict]]:
+        """Runs all initialised tasks on a sequence of models.
+
+        The task corpora are reused for each model, and the results of
+        a model are yielded as soon as it has been evaluated. Passing a
+        generator that loads each checkpoint on demand keeps only a
+        single model in memory.
+
+        Parameters
+        ----------
+        models : Iterable[LanguageModel]
+            Language models on which the tasks are run.
+
+        Yields
+        ------
+        results : Dict[str, ResultsDict]
+            Dictionary mapping a task name to the results of the task,
+            for each model in ``models``.
+        """
+        for model in models:
+            yield self.run(model)
@@ -1,15 +1,16 @@
 import glob
 import os
 import warnings
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import torch
 from torch import Tensor
+from torchtext.data import Example
 from transformers import PreTrainedTokenizer
 
 from diagnnose.activations.selection_funcs import final_token, only_mask_token
 from diagnnose.corpus import Corpus
-from diagnnose.extract import simple_extract
+from diagnnose.extract import MEMORY_BUDGET, PrefixTrieExtractor, simple_extract
 from diagnnose.models import LanguageModel
 from diagnnose.typedefs.activations import SelectionFunc
 
@@ -17,6 +18,10 @@ from diagnnose.typedefs.activations import SelectionFunc
 SyntaxEvalCorpora = Dict[str, Union[Corpus, Dict[str, Corpus]]]
 # subtask -> accuracy | (condition -> accuracy)
 ResultsDict = Dict[str, Union[float, Dict[str, float]]]
+# (subtask, condition) -> Corpus, condition is None for subtasks without conditions
+FlatCorpora = Dict[Tuple[str, Optional[str]], Corpus]
+# List of (corpus, sen_column) tuples
+SenColumns = List[Tuple[Corpus, str]]
 
 
 class SyntaxEvalTask:
@@ -25,8 +30,10 @@ class SyntaxEvalTask:
 
     Parameters
     ----------
-    model : LanguageModel
-        Language model for which the accuracy is calculated.
+    model : LanguageModel, optional
+        Language model for which the accuracy is calculated. Can be set
+        later with ``set_model``, allowing the corpora of a task to be
+        reused for multiple models.
     tokenizer : PreTrainedTokenizer
         The model tokenizer that converts tokens into indices.
     config : Dict[str, Any]
@@ -44,14 +51,15 @@ class SyntaxEvalTask:
 
     def __init__(
         self,
-        model: LanguageModel,
+        model: Optional[LanguageModel],
         tokenizer: PreTrainedTokenizer,
         ignore_unk: bool,
         use_full_model_probs: bool,
         **config: Dict[str, Any],
     ):
-        model.eval()
-        self.model = model
+        self.model: Optional[LanguageModel] = None
+        if model is not None:
+            self.set_model(model)
         self.tokenizer = tokenizer
 
         self.ignore_unk = ignore_unk
@@ -89,58 +97,164 @@ class SyntaxEvalTask:
 
         return corpora
 
+    def set_model(self, model: LanguageModel) -> None:
+        """ Sets the model on which the task is run. """
+        model.eval()
+        self.model = model
+
     def run(self) -> ResultsDict:
         """Performs the syntactic evaluation task that is initialised.
 
+        The final hidden states of all corpora of the task are computed
+        in a single extraction.
+
         Returns
         -------
         results : ResultsDict
             Dictionary mapping a task to a task condition to the model
             accuracy.
         """
-        results: ResultsDict = {}
+        assert self.model is not None, "No model has been set for the task"
+
+        flat_corpora = self.flat_corpora()
+
+        sen_columns = self.sen_columns(flat_corpora)
+        final_hidden = self.calc_joint_final_hidden(sen_columns)
+
+        return self.calc_results(flat_corpora, final_hidden)
+
+    def flat_corpora(self) -> FlatCorpora:
+        """ Returns the corpus of each (subtask, condition) of the task. """
+        flat_corpora: FlatCorpora = {}
 
         for subtask, subtask_corpora in self.corpora.items():
             if isinstance(subtask_corpora, Corpus):
-                accuracy = self._run_corpus(subtask_corpora)
-                results[subtask] = accuracy
+                flat_corpora[subtask, None] = subtask_corpora
             else:
                 for condition, corpus in subtask_corpora.items():
-                    accuracy = self._run_corpus(corpus)
+                    flat_corpora[subtask, condition] = corpus
 
-                    results.setdefault(subtask, {})[condition] = accuracy
+        return flat_corpora
 
-        return results
+    @staticmethod
+    def sen_columns(flat_corpora: FlatCorpora) -> SenColumns:
+        """Returns the sentence columns of each corpus for which the
+        final hidden state is computed: ``sen``, followed by
+        ``counter_sen`` if a corpus contains counter sentences.
+        """
+        sen_columns: SenColumns = []
 
-    def _run_corpus(self, corpus: Corpus) -> float:
-        mask_token = self.tokenizer.mask_token
+        for corpus in flat_corpora.values():
+            sen_columns.append((corpus, "sen"))
+            if "counter_sen" in corpus.fields:
+                sen_columns.append((corpus, "counter_sen"))
 
-        if mask_token is not None:
-            selection_func = only_mask_token(mask_token, "sen")
-        else:
-            selection_func = final_token("sen")
+        return sen_columns
+
+    def calc_results(
+        self, flat_corpora: FlatCorpora, final_hidden: List[Tensor]
+    ) -> ResultsDict:
+        """Computes the accuracy of each corpus of the task.
 
-        activations = self._calc_final_hidden(corpus, selection_func)
+        Parameters
+        ----------
+        flat_corpora : FlatCorpora
+            Corpora of the task, as returned by ``flat_corpora``.
+        final_hidden : List[Tensor]
+            The final hidden states of each of the ``sen_columns`` of
+            ``flat_corpora``, in the same order.
 
-        if "counter_sen" in corpus.fields:
-            if mask_token is not None:
-                selection_func = only_mask_token(mask_token, "counter_sen")
+        Returns
+        -------
+        results : ResultsDict
+            Dictionary mapping a task to a task condition to the model
+            accuracy.
+        """
+        results: ResultsDict = {}
+        final_hidden_iter = iter(final_hidden)
+
+        for (subtask, condition), corpus in flat_corpora.items():
+            activations = next(final_hidden_iter)
+            if "counter_sen" in corpus.fields:
+                counter_activations: Optional[Tensor] = next(final_hidden_iter)
             else:
-                selection_func = final_token("counter_sen")
+                counter_activations = None
 
-            counter_activations = self._calc_final_hidden(
-                corpus, selection_func, sen_column="counter_sen"
+            accuracy = self._calc_accuracy(
+                corpus,
+                activations,
+                counter_activations=counter_activations,
             )
-        else:
-            counter_activations = None
 
-        accuracy = self._calc_accuracy(
-            corpus,
-            activations,
-            counter_activations=counter_activations,
+            if condition is None:
+                results[subtask] = accuracy
+            else:
+                results.setdefault(subtask, {})[condition] = accuracy
+
+        return results
+
+    def calc_joint_final_hidden(self, sen_columns: SenColumns) -> List[Tensor]:
+        """Computes the final hidden states of multiple sentence columns
+        in a single extraction.
+
+        The columns are stacked into one corpus, so the sentences of all
+        columns are batched through the model together. Each sentence
+        should yield a single final hidden state.
+
+        Parameters
+        ----------
+        sen_columns : SenColumns
+            List of (corpus, sen_column) tuples. The corpora may belong
+            to different tasks, as long as they share the tokenizer.
+
+        Returns
+        -------
+        final_hidden : List[Tensor]
+            The final hidden states of each column, in the order of
+            ``sen_columns``.
+        """
+        if len(sen_columns) == 0:
+            return []
+
+        stacked_corpus = self._stack_columns(sen_columns)
+
+        stacked_activations = self._calc_final_hidden(
+            stacked_corpus, self._create_selection_func("sen")
         )
 
-        return accuracy
+        column_sizes = [len(corpus) for corpus, _sen_column in sen_columns]
+        assert stacked_activations.size(0) == sum(
+            column_sizes
+        ), "Each sentence should yield a single final hidden state"
+
+        return list(torch.split(stacked_activations, column_sizes))
+
+    def _create_selection_func(self, sen_column: str) -> SelectionFunc:
+        """Selects the mask token of a masked LM, and the final token of
+        a sentence otherwise.
+        """
+        mask_token = self.tokenizer.mask_token
+
+        if mask_token is not None:
+            return only_mask_token(mask_token, sen_column)
+
+        return final_token(sen_column)
+
+    @staticmethod
+    def _stack_columns(sen_columns: SenColumns) -> Corpus:
+        """Creates a corpus with a single ``sen`` column, that contains
+        the sentences of each of the ``sen_columns`` after another.
+        """
+        examples = []
+        for corpus, sen_column in sen_columns:
+            for item in corpus:
+                example = Example()
+                setattr(example, "sen", getattr(item, sen_column))
+                examples.append(example)
+
+        corpus, sen_column = sen_columns[0]
+
+        return Corpus(examples, [("sen", corpus.fields[sen_column])])
 
     def _calc_final_hidden(
         self,
@@ -155,8 +269,10 @@ class SyntaxEvalTask:
             corpus,
             [activation_name],
             batch_size=len(corpus),
+            memory_budget=MEMORY_BUDGET,
             selection_func=selection_func,
             sen_column=sen_column,
+            prefix_trie=PrefixTrieExtractor.supports_model(self.model),
         )
 
         activations = torch.cat(activation_reader[:, activation_name], dim=0)
@@ -1,6 +1,6 @@
-from typing import BinaryIO, Callable, Dict, List, Tuple, Union
+from typing import Callable, Dict, List, Tuple, Union
 
-from numpy import ndarray
+from numpy import memmap, ndarray
 from torch import Tensor
 from torchtext.data import Example
 
@@ -20,13 +20,16 @@ NamedTensors = Dict[str, Tensor]
 
 
 # EXTRACTION
-ActivationFiles = Dict[ActivationName, BinaryIO]
+ActivationFiles = Dict[ActivationName, memmap]
 
 # token index, corpus item -> bool
 SelectionFunc = Callable[[int, Example], bool]
 
 # [(start, stop)]
 ActivationRanges = List[Tuple[int, int]]
+# [start_0, start_1, ..., start_n, stop_n], activations of sentence i
+# are stored in rows offsets[i]:offsets[i+1].
+ActivationOffsets = Tensor
 
 RemoveCallback = Callable[[], None]
 
@@ -1,19 +1,30 @@
+import json
 import os
 import shutil
 import unittest
-from typing import List, Sequence
 
-from torch import Tensor
+import numpy as np
+import torch
 
-from diagnnose.activations.activation_reader import ActivationReader
+from diagnnose.activations import ActivationReader, ActivationWriter
+from diagnnose.activations.activation_cache import ActivationCache
+from diagnnose.activations.activation_index import ranges_to_row_index, ranges_to_runs
+from diagnnose.activations.selection_funcs import nth_token
+from diagnnose.extract import Extractor
+from diagnnose.utils.misc import suppress_print
 
-from .test_utils import create_and_dump_dummy_activations
+from .test_utils import (
+    DummyTokenizer,
+    create_and_dump_dummy_activations,
+    create_dummy_corpus,
+    create_dummy_model,
+)
 
 # GLOBALS
 ACTIVATIONS_DIM = 10
 ACTIVATIONS_DIR = "test/test_data"
-ACTIVATIONS_NAME = "hx_l0"
-NUM_TEST_SENTENCES = 5
+ACTIVATION_NAMES = [(0, "hx"), (1, "cx")]
+NUM_TEST_SENTENCES = 12
 
 
 class TestActivationReader(unittest.TestCase):
@@ -25,86 +36,280 @@ class TestActivationReader(unittest.TestCase):
         if not os.path.exists(ACTIVATIONS_DIR):
             os.makedirs(ACTIVATIONS_DIR)
 
-        create_and_dump_dummy_activations(
-            num_sentences=NUM_TEST_SENTENCES,
-            activations_dim=ACTIVATIONS_DIM,
-            max_sen_len=5,
-            activations_dir=ACTIVATIONS_DIR,
-            activations_name=ACTIVATIONS_NAME,
-            num_classes=2,
+        torch.manual_seed(0)
+
+        cls.model = create_dummy_model(ACTIVATIONS_DIR, [8, 5])
+        cls.corpus = create_dummy_corpus(
+            ACTIVATIONS_DIR, DummyTokenizer(), NUM_TEST_SENTENCES, max_sen_len=7
         )
-        cls.activation_reader = ActivationReader(activations_dir=ACTIVATIONS_DIR)
+
+        cls.ref_reader = cls._extract()
+        cls.store_dir = os.path.join(ACTIVATIONS_DIR, "store")
+        cls.extractor, cls.activation_reader = cls._extract_to_disk(cls.store_dir)
 
     @classmethod
     def tearDownClass(cls) -> None:
         # Remove files from previous tests
-        if os.listdir(ACTIVATIONS_DIR):
+        if os.path.exists(ACTIVATIONS_DIR):
             shutil.rmtree(ACTIVATIONS_DIR)
 
+    @classmethod
+    @suppress_print
+    def _extract(cls, **kwargs) -> ActivationReader:
+        extractor = Extractor(
+            cls.model, cls.corpus, ACTIVATION_NAMES, batch_size=4, **kwargs
+        )
+        return extractor.extract()
+
+    @classmethod
+    @suppress_print
+    def _extract_to_disk(cls, activations_dir: str, **kwargs):
+        extractor = Extractor(
+            cls.model,
+            cls.corpus,
+            ACTIVATION_NAMES,
+            activations_dir=activations_dir,
+            batch_size=4,
+            **kwargs,
+        )
+        return extractor, extractor.extract()
+
     def test_read_activations(self) -> None:
-        """ Test reading activations from a pickle file. """
-        activations = self.activation_reader.read_activations((0, "hx"))
+        """ Test reading the activations of each sentence from disk. """
+        for a_name in ACTIVATION_NAMES:
+            for sen_idx in range(NUM_TEST_SENTENCES):
+                (activations,) = self.activation_reader[sen_idx, a_name]
+                (ref_activations,) = self.ref_reader[sen_idx, a_name]
+
+                self.assertEqual(activations.shape, ref_activations.shape)
+                self.assertTrue(
+                    torch.allclose(activations, ref_activations),
+                    f"Activations of sentence {sen_idx} differ from in-memory extraction",
+                )
+
+    def test_activation_indexing(self) -> None:
+        """ Test indexing activations by slices, lists and negative indices. """
+        a_name = (1, "cx")
+        indices = [slice(None), slice(2, 7), slice(1, None, 3), [5, 0, 9], -1]
+        # Runs of adjacent sentences mixed with scattered sentences
+        indices += [[2, 3, 4, 9, 10, 0], [7, 8, 1, 2]]
+        for index in indices:
+            activations = self.activation_reader[index, a_name]
+            ref_activations = self.ref_reader[index, a_name]
+
+            self.assertEqual(len(activations), len(ref_activations))
+            for sen_activations, ref_sen_activations in zip(
+                activations, ref_activations
+            ):
+                self.assertTrue(torch.allclose(sen_activations, ref_sen_activations))
+
+        self.activation_reader.cat_activations = True
+        try:
+            activations = self.activation_reader[:, a_name]
+        finally:
+            self.activation_reader.cat_activations = False
 
-        # Check if the amount of read data is correct
         self.assertEqual(
-            self.activation_reader.data_len,
-            activations.shape[0],
-            "Number of read activations is wrong.",
+            activations.shape,
+            (len(self.activation_reader), self.model.nhid(a_name)),
+            "Concatenated activations have the wrong shape",
+        )
+        self.assertTrue(
+            torch.allclose(activations, torch.cat(self.ref_reader[:, a_name]))
         )
 
-        # Check how many sentences were processed
-        # The first activation of a dummy sentence is a vector of ones
-        start_of_sentences = activations[:, 0] == 1
-        num_read_sentences = start_of_sentences.sum()
+    def test_ranges_to_runs(self) -> None:
+        """ Test that adjacent ranges are merged into contiguous runs. """
+        starts = torch.tensor([0, 2, 5, 9, 3, 4])
+        stops = torch.tensor([2, 5, 6, 10, 4, 4])
 
         self.assertEqual(
-            NUM_TEST_SENTENCES, num_read_sentences, "Number of read sentences is wrong"
+            ranges_to_runs(starts, stops), [slice(0, 6), slice(9, 10), slice(3, 4)]
         )
+        self.assertEqual(ranges_to_runs(starts[:3], stops[:3]), [slice(0, 6)])
+        self.assertEqual(ranges_to_runs(starts[:0], stops[:0]), [])
 
-    def test_activation_indexing(self) -> None:
-        first_idx = list(self.activation_reader.activation_ranges.keys())[0]
-
-        def seq_shapes(tensors: Sequence[Tensor]) -> List[Sequence[int]]:
-            shapes = map(lambda t: tuple(t.shape), tensors)
-            return list(shapes)
+        self.assertEqual(ranges_to_row_index(starts[:3], stops[:3]), slice(0, 6))
+        self.assertEqual(
+            ranges_to_row_index(starts, stops).tolist(), [0, 1, 2, 3, 4, 5, 9, 3]
+        )
 
+    def test_activation_ranges(self) -> None:
         self.assertEqual(
-            seq_shapes(
-                self.activation_reader[0, {"indextype": "pos", "a_name": (0, "hx")}]
-            ),
-            seq_shapes(
-                self.activation_reader[
-                    first_idx, {"indextype": "key", "a_name": (0, "hx")}
-                ]
-            ),
-            "Activation shape of first sentence not equal by position/key indexing",
+            self.activation_reader.activation_ranges,
+            self.ref_reader.activation_ranges,
+            "Activation ranges differ from in-memory extraction",
         )
         self.assertEqual(
-            seq_shapes(self.activation_reader[0:]),
-            seq_shapes(
-                self.activation_reader[slice(0, None, None), {"indextype": "key"}]
-            ),
-            "Indexing all activations by key and position yields different results",
+            sum(ma - mi for mi, ma in self.activation_reader.activation_ranges),
+            len(self.activation_reader),
+            "Length mismatch activation ranges and number of activations",
         )
+
+    def test_store_files(self) -> None:
+        """ Test the manifest and offsets that are written to the store. """
+        with open(os.path.join(self.store_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+
+        self.assertTrue(manifest["complete"])
+        self.assertEqual(manifest["num_items"], len(self.activation_reader))
+        self.assertEqual(manifest["dtype"], "float32")
         self.assertEqual(
-            seq_shapes(self.activation_reader[0]),
-            seq_shapes(self.activation_reader[first_idx, {"indextype": "key"}]),
-            "Activation shape of first sentence not equal by position/key indexing",
+            [
+                (a["layer"], a["name"], a["file"], a["nhid"])
+                for a in manifest["activations"]
+            ],
+            [(0, "hx", "0-hx.npy", 8), (1, "cx", "1-cx.npy", 5)],
         )
-        data_len = self.activation_reader.data_len
-        ashape = self.activation_reader[
-            slice(0, data_len // 2, None), {"indextype": "all"}
-        ][0].shape
+
+        offsets = np.load(os.path.join(self.store_dir, "activation_offsets.npy"))
         self.assertTrue(
-            ashape == (data_len // 2, ACTIVATIONS_DIM),
-            f"Indexing by all activations is not working: {ashape}",
+            torch.equal(torch.from_numpy(offsets), self.extractor.activation_offsets)
         )
 
-    def test_activation_ranges(self) -> None:
+        # The activation names can be inferred from the manifest.
+        reader = ActivationReader(self.store_dir)
+        self.assertEqual(reader.activation_names, ACTIVATION_NAMES)
+
+    def test_selection_func(self) -> None:
+        """ Test reading a store with a subset of the token positions. """
+        activations_dir = os.path.join(ACTIVATIONS_DIR, "nth_token")
+        _, reader = self._extract_to_disk(activations_dir, selection_func=nth_token(2))
+        ref_reader = self._extract(selection_func=nth_token(2))
+
+        self.assertEqual(reader.activation_ranges, ref_reader.activation_ranges)
+        for a_name in ACTIVATION_NAMES:
+            self.assertTrue(
+                torch.allclose(
+                    torch.cat(reader[:, a_name]), torch.cat(ref_reader[:, a_name])
+                )
+            )
+
+        # Sentences shorter than 3 tokens yield no activations.
+        sen_lens = [len(reader[i, (0, "hx")][0]) for i in range(reader.num_sentences)]
+        self.assertEqual(sen_lens, [int(len(ex.sen) > 2) for ex in self.corpus])
+
+    def test_write_activations(self) -> None:
+        """ Test writing batches out of corpus order to a new store. """
+        activations_dir = os.path.join(ACTIVATIONS_DIR, "writer")
+        a_name = (0, "hx")
+
+        activation_offsets = torch.tensor([0, 2, 5, 6, 10])
+        activations = torch.randn(10, ACTIVATIONS_DIM)
+
+        writer = ActivationWriter(activations_dir)
+        writer.create_output_files(
+            [a_name], {a_name: ACTIVATIONS_DIM}, activation_offsets
+        )
+        self.assertFalse(writer.completed_sentences().any())
+
+        writer._write_activations({a_name: activations[[2, 3, 4, 6, 7, 8, 9]]}, [1, 3])
         self.assertEqual(
-            sum(
-                ma - mi for mi, ma in self.activation_reader.activation_ranges.values()
-            ),
-            self.activation_reader.data_len,
-            "Length mismatch activation ranges and label length of ActivationReader",
+            writer.completed_sentences().tolist(), [False, True, False, True]
+        )
+
+        writer._write_activations({a_name: activations[[0, 1, 5]]}, [0, 2])
+        writer._write_activations({a_name: activations[[2, 3, 4, 5]]}, [1, 2])
+        writer.dump_meta_info(nth_token(0))
+
+        reader = ActivationReader(activations_dir, cat_activations=True)
+        self.assertTrue(torch.equal(reader[:], activations))
+        self.assertTrue(torch.equal(reader[[3, 1]], activations[[6, 7, 8, 9, 2, 3, 4]]))
+
+    def test_activation_cache(self) -> None:
+        """ Test that cached activations are evicted once the budget is exceeded. """
+        hx, cx = torch.zeros(4, 8), torch.zeros(4, 5)
+        cache = ActivationCache(max_bytes=hx.nelement() * 4 + cx.nelement() * 4)
+
+        cache.put((0, "hx"), hx)
+        cache.put((1, "cx"), cx)
+        self.assertEqual(len(cache), 2, "Activations within budget were evicted")
+
+        # Using hx makes cx the least recently used entry.
+        self.assertIs(cache.get((0, "hx")), hx)
+        cache.put((1, "hx"), torch.zeros(2, 8))
+        self.assertNotIn((1, "cx"), cache)
+        self.assertIn((0, "hx"), cache)
+        self.assertLessEqual(cache.nbytes, cache.max_bytes)
+
+        # The most recent activations are kept even if they exceed the budget.
+        cache.put((2, "hx"), torch.zeros(100, 8))
+        self.assertEqual(len(cache), 1)
+        self.assertIn((2, "hx"), cache)
+
+        unbounded_cache = ActivationCache(max_bytes=None)
+        for layer in range(5):
+            unbounded_cache.put((layer, "hx"), torch.zeros(100, 8))
+        self.assertEqual(len(unbounded_cache), 5)
+
+    def test_reader_cache(self) -> None:
+        """ Test the cache of the reader when reading full activation matrices. """
+        reader = ActivationReader(self.store_dir, cache_size=0)
+        for a_name in ACTIVATION_NAMES:
+            activations = reader.activations(a_name)
+            self.assertTrue(
+                torch.allclose(activations, torch.cat(self.ref_reader[:, a_name]))
+            )
+            self.assertEqual(list(reader.cache._cache.keys()), [a_name])
+
+        reader = ActivationReader(self.store_dir, cache_size=None)
+        for a_name in ACTIVATION_NAMES:
+            reader.activations(a_name)
+        self.assertEqual(len(reader.cache), len(ACTIVATION_NAMES))
+
+    def test_prefetch(self) -> None:
+        """ Test that prefetched activations are equal to direct reads. """
+        reader = ActivationReader(self.store_dir, cache_size=None)
+        direct_reader = ActivationReader(self.store_dir)
+
+        for a_name in ACTIVATION_NAMES:
+            reader.prefetch(a_name)
+        self.assertEqual(len(reader.cache), 0, "Prefetches are cached before use")
+
+        for a_name in ACTIVATION_NAMES:
+            prefetched = reader.activations(a_name)
+            self.assertIn(a_name, reader.cache)
+            self.assertTrue(torch.equal(prefetched, direct_reader.activations(a_name)))
+            self.assertTrue(
+                torch.equal(
+                    torch.cat(reader[:, a_name]), torch.cat(direct_reader[:, a_name])
+                )
+            )
+
+        # Activations that are already cached are not read again.
+        reader.prefetch(ACTIVATION_NAMES[0])
+        self.assertEqual(len(reader._prefetches), 0)
+
+    def test_pickled_ranges_fallback(self) -> None:
+        """ Test reading a store that was created as a series of pickle dumps. """
+        activations_dir = os.path.join(ACTIVATIONS_DIR, "pickled")
+        os.makedirs(activations_dir)
+
+        num_labels = create_and_dump_dummy_activations(
+            num_sentences=5,
+            activations_dim=ACTIVATIONS_DIM,
+            max_sen_len=5,
+            activations_dir=activations_dir,
+            activations_name="0-hx",
+            num_classes=2,
         )
+        reader = ActivationReader(activations_dir, activation_names=[(0, "hx")])
+
+        self.assertEqual(len(reader), num_labels)
+        self.assertEqual(reader.num_sentences, 5)
+
+        activations = torch.cat(reader[:])
+        self.assertEqual(activations.shape, (num_labels, ACTIVATIONS_DIM))
+
+        # The first activation of a dummy sentence is a vector of ones, and the last
+        # dimension of each activation holds a global identifier.
+        for (start, stop), sen_activations in zip(reader.activation_ranges, reader[:]):
+            self.assertEqual(len(sen_activations), stop - start)
+            self.assertTrue((sen_activations[0, :-1] == 1).all())
+        self.assertTrue(
+            torch.equal(activations[:, -1], torch.arange(num_labels).float())
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,76 +1,30 @@
-import itertools
+import json
+import multiprocessing
 import os
+import shutil
+import time
 import unittest
-from typing import Any, List, Tuple
+from typing import Any, Dict, List, Optional, Tuple, Union
 from unittest.mock import MagicMock, patch
 
+import numpy as np
 import torch
 from torch import Tensor
-from torchtext.data import Example
+from torchtext.data import Batch, Example
 
-import diagnnose.typedefs.config as config
-from diagnnose.corpus import import_corpus
+from diagnnose.activations import ActivationReader, ActivationWriter
+from diagnnose.corpus import Corpus
 from diagnnose.corpus.create_iterator import create_iterator
-from diagnnose.corpus.create_labels import create_labels_from_corpus
 from diagnnose.extract import Extractor
-from diagnnose.models.rnn import RecurrentLM
-from diagnnose.typedefs.activations import ActivationDict, SelectionFunc
+from diagnnose.typedefs.activations import ActivationName, SelectionFunc
 from diagnnose.utils.misc import suppress_print
 
-from .test_utils import create_sentence_dummy_activations
+from .test_utils import VOCAB, DummyTokenizer, create_dummy_corpus, create_dummy_model
 
 # GLOBALS
-ACTIVATION_DIM = 10
-ACTIVATION_NAMES = [(0, "hx"), (0, "cx")]
+ACTIVATION_NAMES = [(0, "hx"), (1, "cx")]
 ACTIVATIONS_DIR = "test/test_data"
-
-
-class MockLanguageModel(RecurrentLM):
-    """
-    Create a Mock version of the LanguageModel class which returns pre-defined dummy activations.
-    """
-
-    def __init__(
-        self,
-        num_layers: int,
-        hidden_size: int,
-        all_tokens: List[str],
-        all_activations: Tensor,
-    ) -> None:
-        self.all_tokens = all_tokens
-        self.all_activations = all_activations
-        self.all_pairs = None
-
-        self.sizes = {
-            l: {"h": hidden_size, "c": hidden_size, "x": hidden_size}
-            for l in range(num_layers)
-        }
-        self.split_order = ["f", "i", "g", "o"]
-        self.array_type = "torch"
-
-        self.reset()
-
-        super().__init__()
-
-    @overrides
-    def forward(
-        self,
-        token: torch.Tensor,
-        _activations: ActivationDict,
-        compute_out: bool = False,
-    ) -> Tuple[None, ActivationDict]:
-        # Consume next activation, make sure it's the right token
-        next_token, next_activation = next(self.all_pairs)
-        assert token.item() == next_token
-
-        if len(next_activation.shape) == 1:
-            next_activation = next_activation.unsqueeze(dim=0)
-
-        return None, {(0, "hx"): next_activation, (0, "cx"): next_activation}
-
-    def reset(self) -> None:
-        """ Reset the activations for next test. """
-        self.all_pairs = zip(self.all_tokens, self.all_activations)
+NUM_DUMMY_SENTENCES = 20
 
 
 class TestExtractor(unittest.TestCase):
@@ -82,234 +36,400 @@ class TestExtractor(unittest.TestCase):
         if not os.path.exists(ACTIVATIONS_DIR):
             os.makedirs(ACTIVATIONS_DIR)
 
-        test_corpus = """The ripe taste improves .\t0 0 1 0 0\tdelicious
-        The hog crawled .\t0 1 0 0\thairy
-        Move the vat .\t0 0 1 0\tok"""
+        test_corpus = """the big dog runs .\t0 0 1 0 0\tdelicious
+        a cat sees .\t0 1 0 0\thairy
+        no small cats run ever .\t0 0 1 0 0 0\tok"""
 
         corpus_path = os.path.join(ACTIVATIONS_DIR, "corpus.tsv")
         with open(corpus_path, "w") as f:
             f.write(test_corpus)
 
-        cls.corpus = import_corpus(
-            corpus_path, header=["sen", "labels", "quality"], vocab_from_corpus=True
+        cls.corpus = Corpus.create(
+            corpus_path,
+            header=["sen", "tags", "quality"],
+            tokenizer=DummyTokenizer(),
         )
-        cls.iterator = create_iterator(cls.corpus, batch_size=1)
 
-        # Mock the activations the model produces
-        cls.all_words = list(itertools.chain(*[item.sen for item in cls.corpus]))
-        cls.all_tokens = [cls.corpus.vocab.stoi[w] for w in cls.all_words]
-        cls.all_labels = torch.tensor(
-            [label for batch in cls.iterator for label in batch.labels]
-        )
+        torch.manual_seed(0)
+        cls.model = create_dummy_model(ACTIVATIONS_DIR, [8, 8])
 
-        test_sentence_activations = []
-        identifier_value = 0
-        for example in cls.corpus:
-            test_sentence_activations.append(
-                create_sentence_dummy_activations(
-                    len(example.sen), ACTIVATION_DIM, identifier_value
-                )
-            )
-            identifier_value += len(example.sen)
+        # Activations of all tokens, against which the selected activations are compared
+        cls.all_activations = cls._extract_activations(lambda _w_idx, _item: True)
 
-        cls.all_activations = torch.cat(test_sentence_activations)
-
-        # Prepare Mock Model
-        cls.model = MockLanguageModel(
-            num_layers=1,
-            hidden_size=ACTIVATION_DIM,
-            all_tokens=cls.all_tokens,
-            all_activations=cls.all_activations,
-        )
-        cls.model.set_init_states()
-
-        # Init extractor
-        cls.extractor = Extractor(
-            cls.model, cls.corpus, ACTIVATION_NAMES, activations_dir=ACTIVATIONS_DIR
+        # Larger corpus that is split over multiple batches
+        cls.dummy_corpus = create_dummy_corpus(
+            ACTIVATIONS_DIR, DummyTokenizer(), NUM_DUMMY_SENTENCES, max_sen_len=9
         )
+        cls.dummy_activations = cls._extract_dummy_corpus().activation_dict
 
     @classmethod
     def tearDownClass(cls) -> None:
         # Delete activations after tests
-        if os.listdir(ACTIVATIONS_DIR):
-            os.remove(f"{ACTIVATIONS_DIR}/hx_l0.pickle")
-            os.remove(f"{ACTIVATIONS_DIR}/cx_l0.pickle")
-            os.remove(f"{ACTIVATIONS_DIR}/ranges.pickle")
-            os.remove(f"{ACTIVATIONS_DIR}/corpus.tsv")
+        if os.path.exists(ACTIVATIONS_DIR):
+            shutil.rmtree(ACTIVATIONS_DIR)
 
     def test_extract_sentence(self) -> None:
-        """ Test _extract_sentence for extracting the activations of whole sentences. """
+        """ Test extracting the activations of whole sentences. """
 
-        def selection_func(_sen_id: int, _pos: int, _example: Example) -> bool:
+        def selection_func(_w_idx: int, _item: Example) -> bool:
             return True
 
-        extracted_activations, extracted_labels = self._base_extract(selection_func)
-
-        self.assertTrue(
-            (extracted_activations == self.all_activations).all(),
-            "Selection function didn't extract all activations",
-        )
-        self.assertTrue(
-            (extracted_labels == self.all_labels).all(),
-            "Selection function didn't extract all labels",
+        self._assert_selected(
+            selection_func, [list(range(len(item.sen))) for item in self.corpus]
         )
 
     def test_activation_extraction_by_pos(self) -> None:
-        """ Test the _extract_sentence function for extracting activations based on position. """
+        """ Test extracting activations based on position. """
+
+        def selection_func(w_idx: int, _item: Example) -> bool:
+            return w_idx == 2
+
+        self._assert_selected(selection_func, [[2], [2], [2]])
+
+    def test_activation_extraction_by_label(self) -> None:
+        """ Test extracting the activations based on label. """
+
+        def selection_func(w_idx: int, item: Example) -> bool:
+            return item.tags.split()[w_idx] == "1"
+
+        self._assert_selected(selection_func, [[2], [1], [2]])
 
-        def selection_func(_sen_id: int, pos: int, _example: Example) -> bool:
-            return pos == 2
+    def test_activation_extraction_by_token(self) -> None:
+        """ Test extracting the activations based on token. """
+
+        def selection_func(w_idx: int, item: Example) -> bool:
+            return item.sen[w_idx] == "cat"
 
-        extracted_activations, extracted_labels = self._base_extract(selection_func)
+        self._assert_selected(selection_func, [[], [1], []])
+
+    def test_activation_extraction_by_misc_info(self) -> None:
+        """ Test extracting activations based on misc info. """
 
-        # Confirm that only one activation per sentence was extracted
+        def selection_func(_w_idx: int, item: Example) -> bool:
+            return getattr(item, "quality", "") == "delicious"
+
+        self._assert_selected(selection_func, [[0, 1, 2, 3, 4], [], []])
+
+    @suppress_print
+    @patch("diagnnose.activations.activation_writer.ActivationWriter.dump_meta_info")
+    @patch("diagnnose.activations.activation_writer.ActivationWriter.dump_activations")
+    def test_extraction_dumping_args(
+        self, dump_activations_mock: MagicMock, dump_meta_info_mock: MagicMock
+    ) -> None:
+        """
+        Test whether functions used to dump activations during extraction are called
+        with the right arguments.
+        """
+        # Stop the reader from opening the store that is never finalized by the mocks.
+        with patch("diagnnose.extract.extractor.ActivationReader"):
+            extractor = Extractor(
+                self.model,
+                self.corpus,
+                ACTIVATION_NAMES,
+                activations_dir=os.path.join(ACTIVATIONS_DIR, "dump"),
+                batch_size=1,
+                write_queue_size=0,
+            )
+            extractor.extract()
+
+        call_arg = dump_activations_mock.call_args[0][0]
+
+        # Validate function calls
         self.assertEqual(
-            extracted_activations.shape[0],
+            dump_activations_mock.call_count,
             3,
-            "More than one sentence was extracted based on position",
+            "Function was called the wrong number of times.",
         )
-
-        # Confirm that all extracted activations come from position 2
-        # Due to the way the dummy activations are created, all their values (except for their
-        # unique id value) will be 3
         self.assertTrue(
-            (extracted_activations[:, 0] == 3).all(),
-            "Sentence was extracted from the wrong position",
+            self.is_tensor_dict(call_arg),
+            "Function was called with wrong type of variable, expected ActivationDict.",
+        )
+        self.assertEqual(
+            sorted(call[0][1][0] for call in dump_activations_mock.call_args_list),
+            [0, 1, 2],
+            "Each sentence should be dumped exactly once.",
         )
+        dump_meta_info_mock.assert_called_once_with(extractor.selection_func)
+
+    def test_writer_error(self) -> None:
+        """ Test that an error of the background writer stops the extraction. """
+        with patch(
+            "diagnnose.activations.activation_writer.ActivationWriter._write_activations",
+            side_effect=OSError("disk full"),
+        ):
+            with self.assertRaises(RuntimeError) as context:
+                self._extract_dummy_corpus("writer_error", write_queue_size=2)
+
+        self.assertIsInstance(context.exception.__cause__, OSError)
+
+    def test_write_queue(self) -> None:
+        """ Test that the write queue is bounded and its stall times are tracked. """
+        queue_depths = []
+        write_activations = ActivationWriter._write_activations
+
+        def slow_write(writer: ActivationWriter, *args: Any) -> None:
+            queue_depths.append(writer.queue_depth)
+            time.sleep(0.01)
+            write_activations(writer, *args)
+
+        with patch.object(ActivationWriter, "_write_activations", slow_write):
+            extractor, activation_reader = self._extract_dummy_corpus(
+                "write_queue", write_queue_size=1
+            )
 
-        # Confirm the right labels were extracted
-        self.assertTrue(
-            (extracted_labels == self.all_labels[[2, 7, 11]]).all(),
-            "Wrong labels were extracted based on position.",
+        writer = extractor.activation_writer
+        self.assertGreater(len(queue_depths), 1)
+        self.assertLessEqual(max(queue_depths), 1, "Write queue exceeds its size")
+        self.assertGreater(writer.producer_stall_time, 0)
+        self.assertGreater(writer.consumer_stall_time, 0)
+        self.assertEqual(writer.queue_depth, 0)
+
+        self._assert_equal_activations(activation_reader)
+
+    @unittest.skipUnless(
+        "fork" in multiprocessing.get_all_start_methods(),
+        "Multi-process extraction requires the fork start method",
+    )
+    def test_multi_process_extraction(self) -> None:
+        """ Test that sharded extraction yields the same activations. """
+        activation_reader = self._extract_dummy_corpus(num_workers=3)
+        self._assert_equal_activations(activation_reader)
+
+        extractor, activation_reader = self._extract_dummy_corpus(
+            "multi_process", num_workers=3
         )
+        self.assertGreater(len(extractor._create_shards(self.dummy_corpus)), 1)
+        self._assert_equal_activations(activation_reader)
 
-    def test_activation_extraction_by_label(self) -> None:
-        """ Test the _extract_sentence function for extracting the activations based on label. """
+    def test_resume_extraction(self) -> None:
+        """ Test resuming an extraction that was interrupted after 2 batches. """
+        extract_batch = Extractor._extract_batch
+        extracted_sen_ids: List[int] = []
+
+        def interrupted_extract_batch(extractor: Extractor, batch: Batch) -> Any:
+            if len(extracted_sen_ids) == 8:
+                raise InterruptedError
+            extracted_sen_ids.extend(batch.sen_idx)
+            return extract_batch(extractor, batch)
+
+        with patch.object(Extractor, "_extract_batch", interrupted_extract_batch):
+            with self.assertRaises(InterruptedError):
+                self._extract_dummy_corpus("resume")
+
+        resume_dir = os.path.join(ACTIVATIONS_DIR, "resume")
+        with open(os.path.join(resume_dir, "manifest.json")) as f:
+            self.assertFalse(json.load(f)["complete"])
 
-        def selection_func(_sen_id: int, pos: int, example: Example) -> bool:
-            return example.labels[pos] == 1
+        completed = np.load(os.path.join(resume_dir, "progress.npy")).astype(bool)
+        self.assertEqual(sorted(np.nonzero(completed)[0]), sorted(extracted_sen_ids))
 
-        extracted_activations, extracted_labels = self._base_extract(selection_func)
+        resumed_sen_ids: List[int] = []
+
+        def resumed_extract_batch(extractor: Extractor, batch: Batch) -> Any:
+            resumed_sen_ids.extend(batch.sen_idx)
+            return extract_batch(extractor, batch)
+
+        with patch.object(Extractor, "_extract_batch", resumed_extract_batch):
+            _, activation_reader = self._extract_dummy_corpus("resume", resume=True)
 
-        # Confirm that only one activation per sentence was extracted
         self.assertEqual(
-            extracted_activations.shape[0],
-            3,
-            "More than one sentence was extracted based on label",
-        )
-        extracted_positions = extracted_activations[:, 0] - 1
-        label_positions = torch.tensor(
-            [example.labels.index(1) for example in self.corpus], dtype=config.DTYPE
-        )
-        # Confirm that activations are from the position of the specified label
-        self.assertTrue(
-            (extracted_positions == label_positions).all(),
-            "Wrong activations extracted based on label",
+            sorted(resumed_sen_ids),
+            sorted(set(range(NUM_DUMMY_SENTENCES)) - set(extracted_sen_ids)),
+            "Only sentences that were not completed should be extracted",
         )
+        with open(os.path.join(resume_dir, "manifest.json")) as f:
+            self.assertTrue(json.load(f)["complete"])
+        self._assert_equal_activations(activation_reader)
+
+    def test_resume_complete_extraction(self) -> None:
+        """ Test that resuming a completed extraction leaves its store unchanged. """
+        self._extract_dummy_corpus("resume_complete")
+
+        complete_dir = os.path.join(ACTIVATIONS_DIR, "resume_complete")
+        store_files = sorted(os.listdir(complete_dir))
+        store_contents = {}
+        for filename in store_files:
+            with open(os.path.join(complete_dir, filename), "rb") as f:
+                store_contents[filename] = f.read()
+
+        with patch.object(Extractor, "_extract_batch") as extract_batch_mock:
+            _, activation_reader = self._extract_dummy_corpus(
+                "resume_complete", resume=True
+            )
 
-    def test_activation_extraction_by_token(self) -> None:
-        """ Test the _extract_sentence function for extracting the activations based on token. """
+        extract_batch_mock.assert_not_called()
+        self.assertEqual(sorted(os.listdir(complete_dir)), store_files)
+        for filename, contents in store_contents.items():
+            with open(os.path.join(complete_dir, filename), "rb") as f:
+                self.assertEqual(f.read(), contents, f"{filename} has been modified")
+        self._assert_equal_activations(activation_reader)
+
+    def test_max_tokens_batching(self) -> None:
+        """ Test that batches are capped on their number of padded tokens. """
+        max_sen_len = max(len(ex.sen) for ex in self.dummy_corpus)
+
+        for max_tokens in [max_sen_len, 12, 25]:
+            for sort in [True, False]:
+                iterator = create_iterator(
+                    self.dummy_corpus, sort=sort, max_tokens=max_tokens
+                )
 
-        def selection_func(_sen_id: int, pos: int, example: Example) -> bool:
-            return example.sen[pos] == "hog"
+                sen_ids = []
+                for batch in iterator:
+                    sens, _sen_lens = batch.sen
+                    self.assertLessEqual(
+                        sens.numel(),
+                        max_tokens,
+                        f"Batch of shape {tuple(sens.shape)} exceeds {max_tokens} tokens",
+                    )
+                    sen_ids.extend(batch.sen_idx)
 
-        extracted_activations, extracted_labels = self._base_extract(selection_func)
+                self.assertEqual(sorted(sen_ids), list(range(NUM_DUMMY_SENTENCES)))
 
-        # Confirm that only one activation corresponding to "hog" was extracted
+        # Sentences longer than max_tokens are put in a batch of their own.
+        iterator = create_iterator(self.dummy_corpus, max_tokens=1)
         self.assertEqual(
-            extracted_activations.shape[0],
-            1,
-            "More than one activation extracted by token",
+            [batch.sen_idx for batch in iterator],
+            [[sen_idx] for sen_idx in range(NUM_DUMMY_SENTENCES)],
         )
-        assert extracted_activations[:, -1] == 6
 
-        # Confirm the right labels were extracted
-        self.assertTrue(
-            (extracted_labels == self.all_labels[[6]]).all(),
-            "Wrong labels were extracted based on token.",
+        activation_reader = self._extract_dummy_corpus(max_tokens=12)
+        self._assert_equal_activations(activation_reader)
+
+    def test_memory_budget(self) -> None:
+        """ Test the conversion of a memory budget into a token budget. """
+        # (0, hx) and (1, cx) both have 8 hidden units of 4 bytes
+        token_size = 2 * 8 * 4
+        max_sen_len = max(len(ex.sen) for ex in self.dummy_corpus)
+
+        for memory_budget, max_tokens, expected_max_tokens in [
+            (12 * token_size, None, 12),
+            (12 * token_size + token_size - 1, None, 12),
+            (12 * token_size, max_sen_len, max_sen_len),
+            (max_sen_len * token_size, 12, max_sen_len),
+        ]:
+            extractor = Extractor(
+                self.model,
+                self.dummy_corpus,
+                ACTIVATION_NAMES,
+                max_tokens=max_tokens,
+                memory_budget=memory_budget,
+            )
+            self.assertEqual(extractor.max_tokens, expected_max_tokens)
+
+        # The decoder projection is applied after selection, so only the top hx counts.
+        extractor = Extractor(
+            self.model,
+            self.dummy_corpus,
+            [(1, "out")],
+            memory_budget=12 * 8 * 4,
         )
+        self.assertEqual(extractor.max_tokens, 12)
+
+        with self.assertRaises(ValueError):
+            Extractor(
+                self.model,
+                self.dummy_corpus,
+                ACTIVATION_NAMES,
+                memory_budget=max_sen_len * token_size - 1,
+            )
 
-    def test_activation_extraction_by_misc_info(self) -> None:
-        """ Test the _extract_sentence function for extracting activations based on misc info. """
+        activation_reader = self._extract_dummy_corpus(memory_budget=12 * token_size)
+        self._assert_equal_activations(activation_reader)
 
-        def selection_func(_sen_id: int, _pos: int, example: Example) -> bool:
-            return hasattr(example, "quality") and bool(
-                getattr(example, "quality", "") == "delicious"
-            )
+    def test_out_vocab_ids(self) -> None:
+        """ Test that deferred decoder outputs match the full decoder output. """
+        out_name = (self.model.top_layer, "out")
+        out_vocab_ids = [3, 15, 7]
 
-        extracted_activations, extracted_labels = self._base_extract(selection_func)
+        sen = self.corpus[0].sen
+        input_ids = torch.tensor([self.corpus.tokenizer.convert_tokens_to_ids(sen)])
+        with torch.no_grad():
+            model_out = self.model(input_ids=input_ids, compute_out=True)[out_name][0]
 
-        # Confirm that only the first sentence was extracted
-        expected_activations = self.all_activations[: len(self.corpus[0].sen), :]
-        self.assertTrue(
-            (extracted_activations == expected_activations).all(),
-            "Wrong sentence extracted based on misc info.",
-        )
+        activation_reader = self._extract_dummy_corpus(activation_names=[out_name])
+        full_out = torch.cat(activation_reader[:, out_name])
+        self.assertEqual(full_out.shape[1], len(VOCAB))
 
-        # Confirm the right labels were extracted
+        activation_reader = self._extract_dummy_corpus(
+            "out_vocab_ids", activation_names=[out_name], out_vocab_ids=out_vocab_ids
+        )[1]
+        restricted_out = torch.cat(activation_reader[:, out_name])
         self.assertTrue(
-            (extracted_labels == self.all_labels[: len(self.corpus[0].sen)]).all(),
-            "Wrong labels extracted based on misc info.",
+            torch.allclose(restricted_out, full_out[:, out_vocab_ids], atol=1e-5)
         )
 
-    @suppress_print
-    @patch(
-        "diagnnose.activations.activation_writer.ActivationWriter.concat_pickle_dumps"
-    )
-    @patch("diagnnose.activations.activation_writer.ActivationWriter.dump_activations")
-    def test_extraction_dumping_args(
-        self, dump_activations_mock: MagicMock, _concat_pickle_dumps_mock: MagicMock
+        extractor = Extractor(self.model, self.corpus, [out_name])
+        (extracted_out,) = extractor.extract()[0, out_name]
+        self.assertTrue(torch.allclose(extracted_out, model_out, atol=1e-5))
+
+    def _assert_selected(
+        self, selection_func: SelectionFunc, positions: List[List[int]]
     ) -> None:
+        """Checks that the extracted activations are those of the
+        expected token positions of each sentence.
         """
-        Test whether functions used to dump pickle files during activation extraction are called
-        with the right arguments.
+        extracted_activations = self._extract_activations(selection_func)
+
+        for a_name in ACTIVATION_NAMES:
+            for sen_idx, sen_positions in enumerate(positions):
+                expected = self.all_activations[a_name][sen_idx][sen_positions]
+                self.assertTrue(
+                    torch.allclose(
+                        extracted_activations[a_name][sen_idx], expected, atol=1e-6
+                    ),
+                    f"Wrong activations extracted for sentence {sen_idx}",
+                )
+
+    def _assert_equal_activations(self, activation_reader: ActivationReader) -> None:
+        """Checks that the extracted activations of the dummy corpus are
+        equal to those of a default extraction.
         """
+        for a_name in ACTIVATION_NAMES:
+            self.assertTrue(
+                torch.allclose(
+                    torch.cat(activation_reader[:, a_name]),
+                    self.dummy_activations[a_name],
+                    atol=1e-6,
+                ),
+                f"Extracted {a_name} activations differ from a default extraction",
+            )
 
-        self.extractor.model.reset()
-        self.extractor.extract()
-        call_arg = dump_activations_mock.call_args[0][0]
+    @classmethod
+    @suppress_print
+    def _extract_dummy_corpus(
+        cls, activations_dir: Optional[str] = None, **kwargs: Any
+    ) -> Union[ActivationReader, Tuple[Extractor, ActivationReader]]:
+        """Extracts the dummy corpus, and also returns the extractor if
+        activations are written to disk.
+        """
+        if activations_dir is not None:
+            activations_dir = os.path.join(ACTIVATIONS_DIR, activations_dir)
+        kwargs.setdefault("batch_size", 4)
 
-        # Validate function calls
-        self.assertEqual(
-            dump_activations_mock.call_count,
-            3,
-            "Function was called the wrong number of times.",
-        )
-        self.assertTrue(
-            self.is_tensor_dict(call_arg),
-            "Function was called with wrong type of variable, expected PartialActivationDict.",
+        kwargs.setdefault("activation_names", ACTIVATION_NAMES)
+
+        extractor = Extractor(
+            cls.model, cls.dummy_corpus, activations_dir=activations_dir, **kwargs
         )
+        activation_reader = extractor.extract()
 
-    def _base_extract(self, selection_func: SelectionFunc) -> Tuple[Tensor, Tensor]:
-        self.model.reset()
+        if activations_dir is None:
+            return activation_reader
 
-        sen_activations = []
-        for i, batch in enumerate(self.iterator):
-            sen_activation = self.extractor._extract_sentence(batch, i, selection_func)[
-                0
-            ]
-            for j in sen_activation.keys():
-                sen_activations.append(sen_activation[j])
+        return extractor, activation_reader
 
-        extracted_activations = self._merge_sentence_activations(sen_activations)
-        extracted_labels = create_labels_from_corpus(
-            self.corpus, selection_func=selection_func
+    @classmethod
+    @suppress_print
+    def _extract_activations(
+        cls, selection_func: SelectionFunc
+    ) -> Dict[ActivationName, Tuple[Tensor, ...]]:
+        extractor = Extractor(
+            cls.model, cls.corpus, ACTIVATION_NAMES, selection_func=selection_func
         )
+        activation_reader = extractor.extract()
 
-        return extracted_activations, extracted_labels
-
-    @staticmethod
-    def _merge_sentence_activations(
-        sentences_activations: List[ActivationDict]
-    ) -> Tensor:
-        """ Merge activations from different sentences into one single numpy array. """
-        return torch.cat(
-            [
-                sentence_activations[(0, "hx")]
-                for sentence_activations in sentences_activations
-            ],
-            dim=0,
-        )
+        return {a_name: activation_reader[:, a_name] for a_name in ACTIVATION_NAMES}
 
     @staticmethod
     def is_tensor_dict(var: Any) -> bool:
@@ -326,3 +446,7 @@ class TestExtractor(unittest.TestCase):
                 isinstance(first_value, Tensor),
             ]
         )
+
+
+if __name__ == "__main__":
+    unittest.main()
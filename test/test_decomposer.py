@@ -0,0 +1,184 @@
+import os
+import shutil
+import unittest
+from typing import List
+from unittest.mock import patch
+
+import torch
+from transformers import BatchEncoding
+
+from diagnnose.attribute import ShapleyTensor
+from diagnnose.attribute.decomposer import (
+    ContextualDecomposer,
+    Decomposer,
+    ShapleyDecomposer,
+)
+from diagnnose.attribute.gcd_tensor import GCDTensor
+
+from .test_utils import DummyTokenizer, create_dummy_model
+
+# GLOBALS
+ACTIVATIONS_DIR = "test/test_data"
+SENTENCES = ["the dog runs and", "a big cat", "cats see no"]
+TENSOR_TYPES = ["ShapleyTensor", "GCDTensor"]
+
+
+class TestDecomposer(unittest.TestCase):
+    """ Test the decompositions of the Decomposers. """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        if not os.path.exists(ACTIVATIONS_DIR):
+            os.makedirs(ACTIVATIONS_DIR)
+
+        torch.manual_seed(0)
+        cls.model = create_dummy_model(ACTIVATIONS_DIR, [8, 8])
+        cls.tokenizer = DummyTokenizer()
+
+        input_ids = [cls.tokenizer.encode(sen) for sen in SENTENCES]
+        cls.lengths = [len(sen_ids) for sen_ids in input_ids]
+        max_sen_len = max(cls.lengths)
+        pad_idx = cls.tokenizer.vocab[cls.tokenizer.pad_token]
+        cls.input_ids = [
+            sen_ids + [pad_idx] * (max_sen_len - len(sen_ids)) for sen_ids in input_ids
+        ]
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if os.path.exists(ACTIVATIONS_DIR):
+            shutil.rmtree(ACTIVATIONS_DIR)
+
+    def _create_batch_encoding(self, lengths: bool = True) -> BatchEncoding:
+        batch_encoding = {"input_ids": self.input_ids}
+        if lengths:
+            batch_encoding["length"] = self.lengths
+
+        return BatchEncoding(batch_encoding)
+
+    def _assert_decompositions_equal(
+        self, decomposition: ShapleyTensor, other: ShapleyTensor, msg: str
+    ) -> None:
+        self.assertTrue(torch.allclose(decomposition.data, other.data, atol=1e-6))
+        self.assertEqual(decomposition.num_features, other.num_features)
+        self.assertTrue(
+            torch.allclose(
+                decomposition.stacked_contributions,
+                other.stacked_contributions,
+                atol=1e-6,
+            ),
+            msg,
+        )
+
+    def _explicit_shapley_inputs(self, decomposer: Decomposer) -> ShapleyTensor:
+        """ Contributions that are set to the input at a single position. """
+        inputs_embeds = self.model.create_inputs_embeds(torch.tensor(self.input_ids))
+
+        contributions = [torch.zeros_like(inputs_embeds)]
+        for w_idx in range(inputs_embeds.shape[1]):
+            contribution = torch.zeros_like(inputs_embeds)
+            contribution[:, w_idx] = inputs_embeds[:, w_idx]
+            contributions.append(contribution)
+
+        return decomposer.tensor_type(
+            inputs_embeds,
+            contributions=contributions,
+            validate=True,
+            num_samples=decomposer.num_samples,
+        )
+
+    def _explicit_contextual_inputs(self) -> List[GCDTensor]:
+        """ Beta/gamma pairs of the full input and of each single position. """
+        inputs_embeds = self.model.create_inputs_embeds(torch.tensor(self.input_ids))
+
+        all_contributions = [[torch.zeros_like(inputs_embeds), inputs_embeds]]
+        for w_idx in range(inputs_embeds.shape[1]):
+            beta = torch.zeros_like(inputs_embeds)
+            gamma = inputs_embeds.clone()
+
+            beta[:, w_idx] = gamma[:, w_idx]
+            gamma[:, w_idx] = 0.0
+
+            all_contributions.append([gamma, beta])
+
+        return [
+            GCDTensor(inputs_embeds, contributions=contributions)
+            for contributions in all_contributions
+        ]
+
+    def test_shapley_contribution_masks(self) -> None:
+        """ Compare the masked inputs to explicit contributions per position. """
+        for tensor_type in TENSOR_TYPES:
+            decomposer = ShapleyDecomposer(self.model, tensor_type=tensor_type)
+            explicit_inputs = self._explicit_shapley_inputs(decomposer)
+
+            shapley_in = decomposer.wrap_inputs_embeds(torch.tensor(self.input_ids))
+            self.assertIsNotNone(shapley_in.contribution_masks)
+            self._assert_decompositions_equal(
+                shapley_in, explicit_inputs, f"Inputs of {tensor_type} differ"
+            )
+
+            masked_out = decomposer.decompose(self._create_batch_encoding())
+            with patch.object(
+                decomposer, "wrap_inputs_embeds", return_value=explicit_inputs
+            ):
+                explicit_out = decomposer.decompose(self._create_batch_encoding())
+
+            self._assert_decompositions_equal(
+                masked_out, explicit_out, f"Decomposition of {tensor_type} differs"
+            )
+
+    def test_contextual_contribution_masks(self) -> None:
+        """ Compare the masked beta/gamma pairs to explicit contributions. """
+        decomposer = ContextualDecomposer(self.model)
+        explicit_inputs = self._explicit_contextual_inputs()
+
+        all_shapley_in = decomposer.wrap_inputs_embeds(torch.tensor(self.input_ids))
+        self.assertEqual(len(all_shapley_in), len(explicit_inputs))
+        for shapley_in, explicit_in in zip(all_shapley_in, explicit_inputs):
+            self.assertIsNotNone(shapley_in.contribution_masks)
+            self._assert_decompositions_equal(
+                shapley_in, explicit_in, "Beta/gamma inputs differ"
+            )
+
+        masked_out = decomposer.decompose(self._create_batch_encoding())
+        with patch.object(
+            decomposer, "wrap_inputs_embeds", return_value=explicit_inputs
+        ):
+            explicit_out = decomposer.decompose(self._create_batch_encoding())
+
+        self._assert_decompositions_equal(
+            masked_out, explicit_out, "Contextual decomposition differs"
+        )
+
+    def test_contextual_chunk_size(self) -> None:
+        """ Test that chunking the decompositions yields the same output. """
+        num_decompositions = 1 + len(self.input_ids[0])
+
+        for tensor_type in TENSOR_TYPES:
+            for lengths in [True, False]:
+                batch_encoding = self._create_batch_encoding(lengths=lengths)
+
+                full_out = ContextualDecomposer(
+                    self.model, tensor_type=tensor_type
+                ).decompose(batch_encoding)
+
+                decomposer = ContextualDecomposer(
+                    self.model, tensor_type=tensor_type, chunk_size=2
+                )
+                with patch.object(
+                    self.model, "forward", wraps=self.model.forward
+                ) as forward:
+                    chunked_out = decomposer.decompose(batch_encoding)
+
+                self.assertEqual(forward.call_count, (num_decompositions + 1) // 2)
+                self.assertIsInstance(chunked_out, GCDTensor)
+                self._assert_decompositions_equal(
+                    chunked_out,
+                    full_out,
+                    f"Chunked decomposition of {tensor_type} differs, "
+                    f"with lengths: {lengths}",
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,206 @@
+import os
+import shutil
+import unittest
+from unittest.mock import patch
+
+import torch
+
+from diagnnose.attribute import ShapleyTensor
+from diagnnose.models.init_states import set_init_states
+from diagnnose.models.wrappers import ForwardLSTM
+
+from .test_utils import VOCAB, create_state_dict
+
+# GLOBALS
+NHID = 8
+NUM_LAYERS = 2
+VOCAB_SIZE = len(VOCAB)
+MODEL_DIR = "test/test_model"
+
+
+class TestForwardLSTM(unittest.TestCase):
+    """ Test the fused forward pass of the ForwardLSTM class. """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        if not os.path.exists(MODEL_DIR):
+            os.makedirs(MODEL_DIR)
+
+        torch.manual_seed(0)
+
+        cls.models = {}
+        model_sizes = {"equal": NUM_LAYERS * [NHID], "unequal": [NHID, 5]}
+        for name, layer_sizes in model_sizes.items():
+            state_dict_path = os.path.join(MODEL_DIR, f"{name}.pt")
+            torch.save(create_state_dict(layer_sizes), state_dict_path)
+
+            model = ForwardLSTM(state_dict_path)
+            set_init_states(model)
+            for layer in range(model.num_layers):
+                for hc in ["hx", "cx"]:
+                    model.init_states[layer, hc] = torch.randn_like(
+                        model.init_states[layer, hc]
+                    )
+            cls.models[name] = model
+
+        cls.input_ids = torch.randint(VOCAB_SIZE, (5, 7))
+        cls.input_lengths = torch.tensor([7, 3, 5, 1, 7])
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if os.path.exists(MODEL_DIR):
+            shutil.rmtree(MODEL_DIR)
+
+    def _forward(self, model: ForwardLSTM, fused_lstm: bool, **kwargs):
+        model.fused_lstm = fused_lstm
+        with torch.no_grad():
+            return model(
+                input_ids=self.input_ids, input_lengths=self.input_lengths, **kwargs
+            )
+
+    def test_all_activations(self) -> None:
+        for model in self.models.values():
+            cell_activations = self._forward(model, False, compute_out=True)
+            fused_activations = self._forward(model, True, compute_out=True)
+
+            self.assertEqual(cell_activations.keys(), fused_activations.keys())
+            for a_name, activations in cell_activations.items():
+                self.assertTrue(
+                    torch.allclose(activations, fused_activations[a_name], atol=1e-5),
+                    f"Fused activations of {a_name} don't match the LSTM cell",
+                )
+
+    def test_top_activations(self) -> None:
+        for model in self.models.values():
+            for compute_out in [False, True]:
+                cell_out = self._forward(
+                    model, False, compute_out=compute_out, only_return_top_embs=True
+                )
+                fused_out = self._forward(
+                    model, True, compute_out=compute_out, only_return_top_embs=True
+                )
+
+                self.assertTrue(torch.allclose(cell_out, fused_out, atol=1e-5))
+
+    def test_embeddings_only(self) -> None:
+        """ Test that no layer is run if only the embeddings are requested. """
+        model = self.models["equal"]
+        activation_names = [(0, "emb")]
+        cell_activations = self._forward(
+            model, False, activation_names=activation_names
+        )
+
+        with patch.object(model, "_get_fused_lstm") as get_fused_lstm:
+            fused_activations = self._forward(
+                model, True, activation_names=activation_names
+            )
+
+        get_fused_lstm.assert_not_called()
+        self.assertEqual(list(fused_activations.keys()), activation_names)
+        self.assertTrue(
+            torch.allclose(cell_activations[0, "emb"], fused_activations[0, "emb"])
+        )
+
+    def test_stacked_layers(self) -> None:
+        self.assertTrue(self.models["equal"]._can_stack_layers())
+        self.assertFalse(self.models["unequal"]._can_stack_layers())
+
+    def test_default_fused_lstm(self) -> None:
+        """ Test that gates are only reconstructed if fused_lstm is enabled. """
+        model = self.models["equal"]
+        inputs_embeds = model.create_inputs_embeds(self.input_ids)
+
+        model.fused_lstm = None
+        for activation_names, use_fused in [
+            ([(0, "hx"), (1, "out")], True),
+            ([(0, "emb"), (1, "hx")], True),
+            ([(0, "hx"), (1, "cx")], False),
+            ([(1, "f_g")], False),
+        ]:
+            self.assertEqual(
+                model._use_fused_lstm(inputs_embeds, activation_names), use_fused
+            )
+
+        for fused_lstm in [False, True]:
+            model.fused_lstm = fused_lstm
+            self.assertEqual(
+                model._use_fused_lstm(inputs_embeds, [(1, "cx")]), fused_lstm
+            )
+
+        model.fused_lstm = True
+        shapley_embeds = ShapleyTensor(inputs_embeds)
+        self.assertFalse(model._use_fused_lstm(shapley_embeds, [(1, "hx")]))
+
+    def test_split_order(self) -> None:
+        model = self.models["equal"]
+        model.split_order = ["i", "g", "f", "o"]
+        model.ih_concat_order = ["i", "h"]
+
+        try:
+            cell_activations = self._forward(model, False, compute_out=True)
+            fused_activations = self._forward(model, True, compute_out=True)
+            fused_out = self._forward(
+                model, True, compute_out=True, only_return_top_embs=True
+            )
+        finally:
+            model.split_order = ForwardLSTM.split_order
+            model.ih_concat_order = ForwardLSTM.ih_concat_order
+
+        for a_name, activations in cell_activations.items():
+            self.assertTrue(
+                torch.allclose(activations, fused_activations[a_name], atol=1e-5)
+            )
+        self.assertTrue(
+            torch.allclose(
+                cell_activations[model.top_layer, "out"], fused_out, atol=1e-5
+            )
+        )
+
+    def test_swapped_weights(self) -> None:
+        """ Test that the cached torch LSTMs follow changes to the weights. """
+        model = self.models["equal"]
+        weight, bias = dict(model.weight), model.bias[1].clone()
+
+        self._forward(model, True, compute_out=True)
+        self._forward(model, True, only_return_top_embs=True)
+        fused_lstm = model._get_fused_lstm(0)
+        self.assertIs(model._get_fused_lstm(0), fused_lstm)
+
+        def swap_weights() -> None:
+            model.weight[0] = torch.randn_like(model.weight[0])
+
+        def load_bias() -> None:
+            model.bias[1].copy_(torch.randn_like(model.bias[1]))
+
+        try:
+            for change_weights in [swap_weights, load_bias]:
+                change_weights()
+
+                cell_activations = self._forward(model, False, compute_out=True)
+                fused_activations = self._forward(model, True, compute_out=True)
+                fused_out = self._forward(
+                    model, True, compute_out=True, only_return_top_embs=True
+                )
+
+                for a_name, activations in cell_activations.items():
+                    self.assertTrue(
+                        torch.allclose(
+                            activations, fused_activations[a_name], atol=1e-5
+                        ),
+                        f"Fused {a_name} uses stale weights after {change_weights.__name__}",
+                    )
+                self.assertTrue(
+                    torch.allclose(
+                        cell_activations[model.top_layer, "out"], fused_out, atol=1e-5
+                    ),
+                    f"Stacked LSTM uses stale weights after {change_weights.__name__}",
+                )
+        finally:
+            model.weight = weight
+            model.bias[1].copy_(bias)
+
+        self.assertIsNot(model._get_fused_lstm(0), fused_lstm)
+
+
+if __name__ == "__main__":
+    unittest.main()
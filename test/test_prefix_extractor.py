@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import random
+import shutil
+import unittest
+from typing import Any, Dict, Optional, Type
+
+import torch
+from torch import Tensor
+
+from diagnnose.activations.selection_funcs import final_token
+from diagnnose.corpus import Corpus
+from diagnnose.extract import Extractor, PrefixTrieExtractor
+from diagnnose.typedefs.activations import ActivationName
+from diagnnose.utils.misc import suppress_print
+
+from .test_utils import VOCAB, DummyTokenizer, create_dummy_model
+
+# GLOBALS
+ACTIVATIONS_DIR = "test/test_data"
+ACTIVATION_NAMES = [(0, "cx"), (1, "hx"), (1, "out")]
+NUM_TEST_PAIRS = 12
+
+
+class TestPrefixTrieExtractor(unittest.TestCase):
+    """ Test the activations of the PrefixTrieExtractor. """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        if not os.path.exists(ACTIVATIONS_DIR):
+            os.makedirs(ACTIVATIONS_DIR)
+
+        torch.manual_seed(0)
+        cls.model = create_dummy_model(ACTIVATIONS_DIR, [8, 8])
+
+        # Minimal pairs that only differ in their final token
+        rng = random.Random(0)
+        words = VOCAB[3:]
+        corpus_path = os.path.join(ACTIVATIONS_DIR, "corpus.txt")
+        with open(corpus_path, "w") as f:
+            for _ in range(NUM_TEST_PAIRS):
+                prefix = [rng.choice(words) for _ in range(rng.randint(0, 6))]
+                for final_word in rng.sample(words, 2):
+                    f.write(" ".join(prefix + [final_word]) + "\n")
+
+        cls.corpus = Corpus.create(corpus_path, tokenizer=DummyTokenizer())
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if os.path.exists(ACTIVATIONS_DIR):
+            shutil.rmtree(ACTIVATIONS_DIR)
+
+    @suppress_print
+    def _extract(
+        self, extractor_type: Type[Extractor], **kwargs: Any
+    ) -> Dict[ActivationName, Tensor]:
+        extractor = extractor_type(self.model, self.corpus, ACTIVATION_NAMES, **kwargs)
+        activation_reader = extractor.extract()
+
+        return {
+            a_name: torch.cat(activation_reader[:, a_name])
+            for a_name in ACTIVATION_NAMES
+        }
+
+    def _assert_parity(
+        self, activations_dir: Optional[str] = None, **kwargs: Any
+    ) -> None:
+        activations = {}
+        for extractor_type in [Extractor, PrefixTrieExtractor]:
+            if activations_dir is not None:
+                kwargs["activations_dir"] = os.path.join(
+                    ACTIVATIONS_DIR, activations_dir, extractor_type.__name__
+                )
+            activations[extractor_type] = self._extract(
+                extractor_type, batch_size=5, **kwargs
+            )
+
+        for a_name in ACTIVATION_NAMES:
+            self.assertTrue(
+                torch.allclose(
+                    activations[Extractor][a_name],
+                    activations[PrefixTrieExtractor][a_name],
+                    atol=1e-5,
+                ),
+                f"Trie activations of {a_name} differ from a regular extraction",
+            )
+
+    def test_parity(self) -> None:
+        """ Test that trie extraction yields the same activations. """
+        self._assert_parity()
+        self._assert_parity(selection_func=final_token("sen"))
+        self._assert_parity(max_tokens=9)
+        self._assert_parity(
+            activations_dir="trie",
+            selection_func=final_token("sen"),
+        )
+
+    @unittest.skipUnless(
+        "fork" in multiprocessing.get_all_start_methods(),
+        "Multi-process extraction requires the fork start method",
+    )
+    def test_multi_process_parity(self) -> None:
+        """ Test that sharded trie extraction yields the same activations. """
+        self._assert_parity(num_workers=3)
+        self._assert_parity(
+            activations_dir="trie_shards",
+            num_workers=3,
+        )
+
+    def test_create_shards(self) -> None:
+        """ Test that the sentences of a trie are assigned to a single shard. """
+        extractor = PrefixTrieExtractor(
+            self.model, self.corpus, ACTIVATION_NAMES, batch_size=4, num_workers=3
+        )
+
+        trie_batches = extractor._create_trie_batches(
+            extractor._sen_token_ids(self.corpus)
+        )
+        shards = extractor._create_shards(self.corpus)
+        shard_sen_ids = [{ex.sen_idx for ex in shard} for shard in shards]
+
+        self.assertEqual(len(shards), 3)
+        self.assertEqual(
+            sorted(sen_idx for sen_ids in shard_sen_ids for sen_idx in sen_ids),
+            list(range(len(self.corpus))),
+            "Each sentence should be assigned to exactly one shard",
+        )
+        for sen_ids in trie_batches:
+            self.assertEqual(
+                sum(set(sen_ids) <= shard_ids for shard_ids in shard_sen_ids), 1
+            )
+
+        # Each shard builds the same tries as a single-process extraction.
+        shard_batches = [
+            batch
+            for shard in shards
+            for batch in extractor._create_trie_batches(extractor._sen_token_ids(shard))
+        ]
+        self.assertEqual(shard_batches, trie_batches)
+
+
+if __name__ == "__main__":
+    unittest.main()
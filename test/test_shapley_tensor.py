@@ -0,0 +1,357 @@
+import unittest
+from functools import wraps
+from math import factorial
+from typing import Any, Callable, List, Tuple
+from unittest.mock import patch
+
+import torch
+from torch import Tensor
+
+from diagnnose.attribute import ShapleyTensor, utils
+
+# GLOBALS
+NUM_FEATURES = 4
+DATA_SHAPE = (3, 5)
+
+
+def per_coalition_shapley_values(
+    fn: Callable, num_features: int, *args: Any, **kwargs: Any
+) -> List[Tensor]:
+    """ Computes exact Shapley values by evaluating each coalition per feature. """
+    shapley_factors = utils.calc_shapley_factors(num_features)
+    contributions = []
+
+    for f_idx in range(num_features):
+        other_ids = [i for i in range(num_features) if i != f_idx]
+        contribution = 0.0
+
+        for coalition_ids, factor in shapley_factors:
+            coalition = [other_ids[idx] for idx in coalition_ids]
+            args_wo = utils.unwrap(args, attr="contributions", coalition=coalition)
+            args_with = utils.unwrap(
+                args, attr="contributions", coalition=(coalition + [f_idx])
+            )
+
+            contribution += factor * (fn(*args_with, **kwargs) - fn(*args_wo, **kwargs))
+
+        contributions.append(contribution / factorial(num_features))
+
+    baseline_args = utils.unwrap(args, attr="contributions", coalition=[])
+    contributions[0] += fn(*baseline_args, **kwargs)
+
+    return contributions
+
+
+class TestShapleyTensor(unittest.TestCase):
+    """ Test the decompositions of the ShapleyTensor. """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        torch.manual_seed(0)
+
+        cls.shapley_tensor = cls._create_shapley_tensor()
+        cls.other_shapley_tensor = cls._create_shapley_tensor()
+
+    @staticmethod
+    def _create_shapley_tensor() -> ShapleyTensor:
+        contributions = torch.randn(NUM_FEATURES, *DATA_SHAPE)
+
+        return ShapleyTensor(contributions.sum(dim=0), contributions=contributions)
+
+    def _assert_contributions_equal(
+        self, contributions: Tensor, expected: List[Tensor], msg: str
+    ) -> None:
+        self.assertEqual(contributions.shape, (len(expected), *expected[0].shape))
+        self.assertTrue(
+            torch.allclose(contributions, torch.stack(expected), atol=1e-5), msg
+        )
+
+    def test_exact_shapley_values(self) -> None:
+        """ Compare the exact Shapley values to a separate pass per coalition. """
+        shapley_tensor = self.shapley_tensor
+        other_shapley_tensor = self.other_shapley_tensor
+        weight = torch.randn(DATA_SHAPE[1], 2)
+
+        fns = {
+            "tanh": (torch.tanh, [shapley_tensor], {}),
+            "softmax": (torch.softmax, [shapley_tensor], {"dim": -1}),
+            "mul": (torch.mul, [shapley_tensor, other_shapley_tensor], {}),
+            "matmul": (torch.matmul, [torch.tanh(shapley_tensor), weight], {}),
+            "lambda": (lambda x: torch.tanh(x).sum(dim=0), [shapley_tensor], {}),
+        }
+
+        for fn_name, (fn, args, kwargs) in fns.items():
+            data = fn(*utils.unwrap(args), **kwargs)
+            contributions = utils.calc_exact_shapley_values(
+                fn,
+                NUM_FEATURES,
+                utils.calc_shapley_factors(NUM_FEATURES),
+                data.shape,
+                *args,
+                **kwargs,
+            )
+
+            expected = per_coalition_shapley_values(fn, NUM_FEATURES, *args, **kwargs)
+            self._assert_contributions_equal(
+                contributions, expected, f"Shapley values of {fn_name} differ"
+            )
+
+            # Efficiency: the Shapley values sum up to the full output.
+            self.assertTrue(
+                torch.allclose(contributions.sum(dim=0), data, atol=1e-5),
+                f"Shapley values of {fn_name} don't sum up to the output",
+            )
+
+    def test_shapley_tensor_ops(self) -> None:
+        """ Compare the contributions of non-linear ops to the formula. """
+        for fn_name, fn in [("sigmoid", torch.sigmoid), ("tanh", torch.tanh)]:
+            output = fn(self.shapley_tensor)
+
+            expected = per_coalition_shapley_values(
+                fn, NUM_FEATURES, self.shapley_tensor
+            )
+            self._assert_contributions_equal(
+                output.stacked_contributions,
+                expected,
+                f"Contributions of {fn_name} differ",
+            )
+            self.assertTrue(
+                torch.allclose(
+                    output.stacked_contributions.sum(dim=0), output.data, atol=1e-5
+                )
+            )
+
+    def test_batched_coalition_outputs(self) -> None:
+        """ Compare batched coalition outputs to a separate call per coalition. """
+        shapley_tensor = self.shapley_tensor
+        broadcast_operand = torch.randn(2, *DATA_SHAPE)
+
+        fns = {
+            "add": (torch.add, [shapley_tensor, self.other_shapley_tensor], {}),
+            "mul_broadcast": (torch.mul, [shapley_tensor, broadcast_operand], {}),
+            "mul_broadcast_first": (torch.mul, [broadcast_operand, shapley_tensor], {}),
+            "softmax_pos_dim": (torch.softmax, [shapley_tensor, 0], {}),
+            "softmax_neg_dim": (torch.softmax, [shapley_tensor], {"dim": -1}),
+            "log_softmax_pos_dim": (torch.log_softmax, [shapley_tensor], {"dim": 1}),
+        }
+
+        for fn_name, (fn, args, kwargs) in fns.items():
+            batched, num_calls = self._calc_coalition_outputs(fn, *args, **kwargs)
+            self.assertEqual(num_calls, 1, f"{fn_name} should be batched")
+
+            with patch.object(utils, "batch_args", return_value=None):
+                unbatched, _ = self._calc_coalition_outputs(fn, *args, **kwargs)
+
+            self.assertEqual(batched.shape, unbatched.shape)
+            self.assertTrue(
+                torch.allclose(batched, unbatched, atol=1e-6),
+                f"Batched outputs of {fn_name} differ",
+            )
+
+    def test_unbatched_coalition_outputs(self) -> None:
+        """ Test the fallback for functions that can't be batched. """
+        weight = torch.randn(DATA_SHAPE[1], 2)
+
+        fns = {
+            "matmul": (torch.matmul, [self.shapley_tensor, weight], {}),
+            "sum": (torch.sum, [self.shapley_tensor], {}),
+        }
+
+        for fn_name, (fn, args, kwargs) in fns.items():
+            self._assert_unbatched(fn_name, fn, *args, **kwargs)
+
+        # The batched output of a summed tensor lacks the coalition dimension, and
+        # is discarded.
+        with patch.object(utils, "BROADCAST_FNS", utils.BROADCAST_FNS | {"sum"}):
+            self._assert_unbatched("sum_batched", torch.sum, self.shapley_tensor)
+
+    def _assert_unbatched(
+        self, fn_name: str, fn: Callable, *args: Any, **kwargs: Any
+    ) -> None:
+        coalition_outputs, num_calls = self._calc_coalition_outputs(fn, *args, **kwargs)
+
+        expected = torch.stack(
+            [
+                fn(*utils.unwrap(args, "contributions", coalition), **kwargs)
+                for coalition in self._coalitions()
+            ]
+        )
+        self.assertGreaterEqual(num_calls, 2 ** NUM_FEATURES)
+        self.assertTrue(
+            torch.allclose(coalition_outputs, expected, atol=1e-6),
+            f"Coalition outputs of {fn_name} differ",
+        )
+
+    def test_stacked_contributions(self) -> None:
+        """ Test that the list and stacked views of the contributions agree. """
+        contributions = list(torch.randn(NUM_FEATURES, 4, 5, 6))
+        shapley_tensor = ShapleyTensor(sum(contributions), contributions=contributions)
+        self.assertTrue(
+            torch.equal(
+                shapley_tensor.stacked_contributions, torch.stack(contributions)
+            )
+        )
+
+        ids1, ids2 = torch.tensor([0, 2]), torch.tensor([1, 3])
+        weight = torch.randn(2, 1, 6, 3)
+        bias = torch.randn(7, 1, 1, 6)
+
+        # Linear ops are applied to each contribution separately.
+        ops = {
+            "index": lambda x: x[1:, 2],
+            "index_tensors": lambda x: x[:, ids1, ids2],
+            "index_non_adjacent": lambda x: x[ids1, :, ids2],
+            "index_ellipsis": lambda x: x[..., 1],
+            "index_none": lambda x: x[None, 1],
+            "view": lambda x: x.view(-1, 6),
+            "reshape": lambda x: x.reshape(20, 6),
+            "squeeze": lambda x: x[:, :1].squeeze(1),
+            "unsqueeze": lambda x: x.unsqueeze(-1),
+            "index_select": lambda x: torch.index_select(x, 2, ids1),
+            "cat": lambda x: torch.cat([x, x], dim=-1),
+            "split": lambda x: torch.split(x, 2, dim=1)[1],
+            "scalar_mul": lambda x: x * 0.5,
+            "matmul": lambda x: x @ weight,
+        }
+
+        for op_name, op in ops.items():
+            output = op(shapley_tensor)
+            expected = [op(contribution) for contribution in contributions]
+
+            self._assert_views_agree(output, op_name)
+            self._assert_contributions_equal(
+                output.stacked_contributions, expected, f"{op_name} differs"
+            )
+
+        # A non-ShapleyTensor is added to the default feature.
+        output = bias + shapley_tensor
+        expected = [bias + contributions[0]]
+        expected += [torch.zeros_like(bias) + c for c in contributions[1:]]
+        self._assert_views_agree(output, "add")
+        self._assert_contributions_equal(
+            output.stacked_contributions, expected, "add differs"
+        )
+
+        output = torch.tanh(shapley_tensor) * torch.sigmoid(shapley_tensor)
+        self._assert_views_agree(output, "tanh_mul")
+
+        # Setting a value with contributions pads the empty contributions.
+        output = ShapleyTensor(torch.zeros(4, 5, 6))
+        output[1:3, 2] = shapley_tensor[1:3, 2]
+        expected = [torch.zeros(4, 5, 6) for _ in contributions]
+        for expected_contribution, contribution in zip(expected, contributions):
+            expected_contribution[1:3, 2] = contribution[1:3, 2]
+        self._assert_views_agree(output, "setitem")
+        self._assert_contributions_equal(
+            output.stacked_contributions, expected, "setitem differs"
+        )
+
+        # Unpacking returns the list view.
+        _, unpacked_contributions = shapley_tensor
+        self.assertIsInstance(unpacked_contributions, list)
+        self.assertEqual(len(unpacked_contributions), NUM_FEATURES)
+
+    def test_contribution_masks(self) -> None:
+        """ Compare masked contributions to explicit contributions per position. """
+        data = torch.randn(2, NUM_FEATURES, 3)
+        position_masks = torch.eye(NUM_FEATURES).view(NUM_FEATURES, 1, NUM_FEATURES, 1)
+        contributions = [mask * data for mask in position_masks]
+
+        masked_tensor = ShapleyTensor(
+            data, contribution_masks=position_masks.expand(-1, 2, -1, -1)
+        )
+        explicit_tensor = ShapleyTensor(data, contributions=contributions)
+
+        # Ops that don't involve the last dimension keep the contributions implicit.
+        ops = {
+            "index": (lambda x: x[1, 2:], True),
+            "split": (lambda x: torch.split(x, 2, dim=1)[1], True),
+            "index_select": (
+                lambda x: torch.index_select(x, 0, torch.tensor([1, 0])),
+                True,
+            ),
+            "unsqueeze": (lambda x: x.unsqueeze(2), True),
+            "split_last": (lambda x: torch.split(x, 2, dim=-1)[0], False),
+            "tanh": (torch.tanh, False),
+        }
+
+        for op_name, (op, implicit) in ops.items():
+            masked_output = op(masked_tensor)
+            explicit_output = op(explicit_tensor)
+
+            self.assertEqual(
+                masked_output.contribution_masks is not None,
+                implicit,
+                f"Contributions of {op_name} should be implicit: {implicit}",
+            )
+            self._assert_contributions_equal(
+                masked_output.stacked_contributions,
+                explicit_output.contributions,
+                f"Masked contributions of {op_name} differ",
+            )
+
+        # A single index that isn't wrapped in a tuple.
+        masks = torch.rand(NUM_FEATURES, 2, 3, 1)
+        data = torch.randn(2, 3, 4)
+        for index in [1, slice(0, 1), torch.tensor([1, 0])]:
+            masked_tensor = ShapleyTensor(data, contribution_masks=masks)
+            output = masked_tensor[index]
+
+            self.assertIsNotNone(output.contribution_masks)
+            self._assert_contributions_equal(
+                output.stacked_contributions,
+                list((masks * data)[:, index]),
+                f"Masked contributions of index {index} differ",
+            )
+
+    def _assert_views_agree(self, shapley_tensor: ShapleyTensor, op_name: str) -> None:
+        contributions = shapley_tensor.contributions
+        stacked_contributions = shapley_tensor.stacked_contributions
+
+        self.assertIsInstance(contributions, list)
+        self.assertEqual(len(contributions), shapley_tensor.num_features)
+        self.assertEqual(
+            stacked_contributions.shape,
+            (shapley_tensor.num_features, *shapley_tensor.data.shape),
+            f"Stacked contributions of {op_name} have the wrong shape",
+        )
+        self.assertTrue(
+            torch.equal(torch.stack(contributions), stacked_contributions),
+            f"Contribution views of {op_name} differ",
+        )
+
+    @staticmethod
+    def _coalitions() -> List[List[int]]:
+        """ Coalitions in the order of the bits of their index. """
+        return [
+            [f_idx for f_idx in range(NUM_FEATURES) if (c_idx >> f_idx) & 1]
+            for c_idx in range(2 ** NUM_FEATURES)
+        ]
+
+    @staticmethod
+    def _calc_coalition_outputs(
+        fn: Callable, *args: Any, **kwargs: Any
+    ) -> Tuple[Tensor, int]:
+        """ Returns the outputs of all coalitions and the number of calls to fn. """
+        coalition_masks = torch.zeros(2 ** NUM_FEATURES, NUM_FEATURES, dtype=torch.long)
+        for c_idx, coalition in enumerate(TestShapleyTensor._coalitions()):
+            coalition_masks[c_idx, coalition] = 1
+
+        num_calls = 0
+
+        @wraps(fn)
+        def counted_fn(*fn_args: Any, **fn_kwargs: Any) -> Tensor:
+            nonlocal num_calls
+            num_calls += 1
+            return fn(*fn_args, **fn_kwargs)
+
+        data_shape = fn(*utils.unwrap(args), **kwargs).shape
+        coalition_outputs = utils.calc_coalition_outputs(
+            counted_fn, coalition_masks, data_shape, *args, **kwargs
+        )
+
+        return coalition_outputs, num_calls
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,136 @@
+import os
+import shutil
+import unittest
+from typing import Any
+
+import torch
+
+from diagnnose.activations.selection_funcs import nth_token
+from diagnnose.extract import StreamingExtractor
+from diagnnose.models.lm_session import LMSession
+from diagnnose.utils.misc import suppress_print
+
+from .test_utils import DummyTokenizer, create_dummy_corpus, create_dummy_model
+
+# GLOBALS
+ACTIVATIONS_DIR = "test/test_data"
+ACTIVATION_NAMES = [(0, "hx"), (1, "cx"), (1, "out")]
+NUM_TEST_SENTENCES = 10
+
+
+class TestStreamingExtractor(unittest.TestCase):
+    """ Test the chunked forward passes of the LMSession and StreamingExtractor. """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        if not os.path.exists(ACTIVATIONS_DIR):
+            os.makedirs(ACTIVATIONS_DIR)
+
+        torch.manual_seed(0)
+
+        cls.model = create_dummy_model(ACTIVATIONS_DIR, [8, 6])
+        tokenizer = DummyTokenizer()
+        cls.corpus = create_dummy_corpus(
+            ACTIVATIONS_DIR, tokenizer, NUM_TEST_SENTENCES, max_sen_len=7
+        )
+
+        # The corpus items form a single document.
+        cls.sen_lens = [len(item.sen) for item in cls.corpus]
+        cls.input_ids = torch.tensor(
+            [
+                tokenizer.convert_tokens_to_ids(w)
+                for item in cls.corpus
+                for w in item.sen
+            ]
+        )
+
+        with torch.no_grad():
+            full_activations = cls.model(
+                input_ids=cls.input_ids.unsqueeze(0), activation_names=ACTIVATION_NAMES
+            )
+        cls.full_activations = {
+            a_name: activations[0] for a_name, activations in full_activations.items()
+        }
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if os.path.exists(ACTIVATIONS_DIR):
+            shutil.rmtree(ACTIVATIONS_DIR)
+
+    def test_session_stream(self) -> None:
+        """ Test that streaming chunks yields the states of a full forward pass. """
+        session = LMSession(self.model, ACTIVATION_NAMES)
+
+        for chunk_size in [1, 4, 7, len(self.input_ids)]:
+            session.reset()
+            with torch.no_grad():
+                chunk_activations = list(
+                    session.stream(torch.split(self.input_ids, chunk_size))
+                )
+
+            for a_name in ACTIVATION_NAMES:
+                activations = torch.cat([chunk[a_name] for chunk in chunk_activations])
+                self.assertTrue(
+                    torch.allclose(
+                        activations, self.full_activations[a_name], atol=1e-5
+                    ),
+                    f"Streamed {a_name} differs for chunks of size {chunk_size}",
+                )
+
+    def test_session_reset(self) -> None:
+        """ Test that a reset session starts from the initial states again. """
+        session = LMSession(self.model, ACTIVATION_NAMES)
+        chunk = self.input_ids[:5]
+
+        with torch.no_grad():
+            first_activations = session.step(chunk)
+            continued_activations = session.step(chunk)
+            session.reset()
+            reset_activations = session.step(chunk)
+
+        hx_name = (0, "hx")
+        self.assertTrue(
+            torch.equal(first_activations[hx_name], reset_activations[hx_name])
+        )
+        self.assertFalse(
+            torch.allclose(first_activations[hx_name], continued_activations[hx_name])
+        )
+
+    def test_streaming_extractor(self) -> None:
+        """ Test that the items are conditioned on all preceding items. """
+        for activations_dir in [None, os.path.join(ACTIVATIONS_DIR, "stream")]:
+            for kwargs in [
+                {"batch_size": 1},
+                {"batch_size": 3},
+                {"batch_size": 100, "max_tokens": 4},
+            ]:
+                self._assert_streamed(activations_dir=activations_dir, **kwargs)
+
+        self._assert_streamed(selection_func=nth_token(1), max_tokens=3)
+
+    @suppress_print
+    def _assert_streamed(self, **kwargs: Any) -> None:
+        if kwargs.get("activations_dir") is not None:
+            shutil.rmtree(kwargs["activations_dir"], ignore_errors=True)
+
+        extractor = StreamingExtractor(
+            self.model, self.corpus, ACTIVATION_NAMES, **kwargs
+        )
+        activation_reader = extractor.extract()
+
+        sen_start = 0
+        for sen_idx, sen_len in enumerate(self.sen_lens):
+            start, stop = extractor.activation_offsets[sen_idx : sen_idx + 2]
+            positions = extractor.selected_positions[start:stop]
+            for a_name in ACTIVATION_NAMES:
+                (activations,) = activation_reader[sen_idx, a_name]
+                expected = self.full_activations[a_name][sen_start + positions]
+                self.assertTrue(
+                    torch.allclose(activations, expected, atol=1e-5),
+                    f"Streamed {a_name} of item {sen_idx} differs with {kwargs}",
+                )
+            sen_start += sen_len
+
+
+if __name__ == "__main__":
+    unittest.main()
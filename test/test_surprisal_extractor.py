@@ -0,0 +1,121 @@
+import os
+import shutil
+import unittest
+from typing import Any, Type
+
+import torch
+
+from diagnnose.activations import ActivationReader
+from diagnnose.activations.selection_funcs import nth_token
+from diagnnose.extract import Extractor, SurprisalExtractor
+from diagnnose.utils.misc import suppress_print
+
+from .test_utils import DummyTokenizer, create_dummy_corpus, create_dummy_model
+
+# GLOBALS
+ACTIVATIONS_DIR = "test/test_data"
+NUM_TEST_SENTENCES = 10
+TOP_K = 4
+VOCAB_CHUNK_SIZE = 3
+
+
+class TestSurprisalExtractor(unittest.TestCase):
+    """ Test the chunked next token statistics of the SurprisalExtractor. """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        if not os.path.exists(ACTIVATIONS_DIR):
+            os.makedirs(ACTIVATIONS_DIR)
+
+        torch.manual_seed(0)
+
+        cls.model = create_dummy_model(ACTIVATIONS_DIR, [8, 6])
+        cls.tokenizer = DummyTokenizer()
+        cls.corpus = create_dummy_corpus(
+            ACTIVATIONS_DIR, cls.tokenizer, NUM_TEST_SENTENCES, max_sen_len=7
+        )
+
+        cls.top_layer = cls.model.top_layer
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if os.path.exists(ACTIVATIONS_DIR):
+            shutil.rmtree(ACTIVATIONS_DIR)
+
+    @suppress_print
+    def _extract(
+        self, extractor_type: Type[Extractor], **kwargs: Any
+    ) -> ActivationReader:
+        extractor = extractor_type(self.model, self.corpus, batch_size=4, **kwargs)
+        return extractor.extract()
+
+    def test_next_token_statistics(self) -> None:
+        """ Compare the statistics to the log_softmax of the full logits. """
+        hx_name = (self.top_layer, "hx")
+        hx_reader = self._extract(Extractor, activation_names=[hx_name])
+
+        for activations_dir in [None, os.path.join(ACTIVATIONS_DIR, "surprisal")]:
+            activation_reader = self._extract(
+                SurprisalExtractor,
+                top_k=TOP_K,
+                compute_entropy=True,
+                vocab_chunk_size=VOCAB_CHUNK_SIZE,
+                activations_dir=activations_dir,
+            )
+
+            for sen_idx, item in enumerate(self.corpus):
+                (hidden,) = hx_reader[sen_idx, hx_name]
+                log_probs = torch.log_softmax(self.model.decode(hidden), dim=-1)
+                token_ids = torch.tensor(self.tokenizer.convert_tokens_to_ids(item.sen))
+
+                (log_prob,) = activation_reader[sen_idx, (self.top_layer, "log_prob")]
+                (entropy,) = activation_reader[sen_idx, (self.top_layer, "entropy")]
+                (top_k,) = activation_reader[sen_idx, (self.top_layer, "top_k")]
+
+                # The final token has no next token.
+                self.assertTrue(torch.isnan(log_prob[-1, 0]))
+
+                positions = torch.arange(len(item.sen) - 1)
+                expected_log_prob = log_probs[positions, token_ids[1:]]
+                self.assertTrue(
+                    torch.allclose(log_prob[:-1, 0], expected_log_prob, atol=1e-5),
+                    f"Wrong log_prob for sentence {sen_idx}",
+                )
+
+                expected_entropy = -(log_probs.exp() * log_probs).sum(dim=-1)
+                self.assertTrue(
+                    torch.allclose(entropy[:, 0], expected_entropy, atol=1e-5),
+                    f"Wrong entropy for sentence {sen_idx}",
+                )
+
+                expected_top_k = log_probs.topk(TOP_K, dim=-1).indices
+                self.assertTrue(torch.equal(top_k.long(), expected_top_k))
+
+    def test_selection_func(self) -> None:
+        """ Test that statistics are only computed for the selected positions. """
+        log_prob_name = (self.top_layer, "log_prob")
+
+        all_reader = self._extract(SurprisalExtractor)
+        nth_reader = self._extract(
+            SurprisalExtractor,
+            selection_func=nth_token(1),
+            vocab_chunk_size=VOCAB_CHUNK_SIZE,
+        )
+        self.assertEqual(all_reader.activation_names, [log_prob_name])
+
+        for sen_idx, item in enumerate(self.corpus):
+            (nth_log_prob,) = nth_reader[sen_idx, log_prob_name]
+            if len(item.sen) < 2:
+                self.assertEqual(len(nth_log_prob), 0)
+                continue
+
+            (all_log_prob,) = all_reader[sen_idx, log_prob_name]
+            self.assertTrue(
+                torch.allclose(
+                    nth_log_prob, all_log_prob[[1]], atol=1e-5, equal_nan=True
+                )
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,129 @@
+import os
+import shutil
+import unittest
+from typing import Optional
+
+import torch
+
+from diagnnose.corpus import Corpus
+from diagnnose.models import LanguageModel
+from diagnnose.syntax import SyntacticEvaluator
+from diagnnose.syntax.tasks.task import SyntaxEvalTask
+from diagnnose.utils.misc import suppress_print
+
+from .test_utils import DummyTokenizer, create_dummy_model, create_task_corpus
+
+# GLOBALS
+ACTIVATIONS_DIR = "test/test_data"
+TASK_DIR = os.path.join(ACTIVATIONS_DIR, "task")
+NUM_TEST_ITEMS = 12
+
+
+class TestSyntacticEvaluator(unittest.TestCase):
+    """ Test the shared extraction of the SyntacticEvaluator. """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        if not os.path.exists(TASK_DIR):
+            os.makedirs(TASK_DIR)
+
+        torch.manual_seed(0)
+        cls.models = [
+            create_dummy_model(ACTIVATIONS_DIR, [8, 8]),
+            create_dummy_model(ACTIVATIONS_DIR, [8, 8]),
+        ]
+        cls.tokenizer = DummyTokenizer()
+
+        for seed, subtask in enumerate(["x", "y"]):
+            subtask_path = os.path.join(TASK_DIR, f"{subtask}.tsv")
+            create_task_corpus(
+                subtask_path, NUM_TEST_ITEMS, counter_sen=False, seed=seed
+            )
+
+        cls.pairs_path = os.path.join(ACTIVATIONS_DIR, "pairs.tsv")
+        create_task_corpus(cls.pairs_path, NUM_TEST_ITEMS, counter_sen=True, seed=2)
+
+        cls.config = {
+            "directory": {"path": TASK_DIR},
+            "file": {"path": os.path.join(TASK_DIR, "x.tsv")},
+        }
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if os.path.exists(ACTIVATIONS_DIR):
+            shutil.rmtree(ACTIVATIONS_DIR)
+
+    @suppress_print
+    def _create_evaluator(
+        self, model: Optional[LanguageModel] = None
+    ) -> SyntacticEvaluator:
+        evaluator = SyntacticEvaluator(model, self.tokenizer, self.config)
+
+        # Subtask with conditions, one of which contains counter sentences
+        pairs_corpus = Corpus.create(
+            self.pairs_path,
+            header=["sen", "counter_sen", "token"],
+            tokenize_columns=["sen", "counter_sen"],
+            tokenizer=self.tokenizer,
+        )
+        evaluator.tasks["file"].corpora["conditions"] = {
+            "pairs": pairs_corpus,
+            "tokens": evaluator.tasks["directory"].corpora["y"],
+        }
+
+        return evaluator
+
+    @staticmethod
+    def _condition_accuracy(task: SyntaxEvalTask, corpus: Corpus) -> float:
+        """ Computes the accuracy of a single condition on its own. """
+        activations = task._calc_final_hidden(
+            corpus, task._create_selection_func("sen")
+        )
+        counter_activations = None
+        if "counter_sen" in corpus.fields:
+            counter_activations = task._calc_final_hidden(
+                corpus,
+                task._create_selection_func("counter_sen"),
+                sen_column="counter_sen",
+            )
+
+        return task._calc_accuracy(corpus, activations, counter_activations)
+
+    @suppress_print
+    def test_run(self) -> None:
+        """ Test the nested results against a separate run per condition. """
+        evaluator = self._create_evaluator(self.models[0])
+        results = evaluator.run()
+
+        self.assertEqual(set(results.keys()), {"directory", "file"})
+        self.assertEqual(set(results["directory"].keys()), {"x", "y"})
+        self.assertEqual(set(results["file"].keys()), {"x", "conditions"})
+        self.assertEqual(set(results["file"]["conditions"].keys()), {"pairs", "tokens"})
+
+        for task_name, task in evaluator.tasks.items():
+            for (subtask, condition), corpus in task.flat_corpora().items():
+                accuracy = results[task_name][subtask]
+                if condition is not None:
+                    accuracy = accuracy[condition]
+
+                self.assertAlmostEqual(
+                    accuracy,
+                    self._condition_accuracy(task, corpus),
+                    msg=f"Results of {task_name}/{subtask}/{condition} differ",
+                )
+
+    @suppress_print
+    def test_run_models(self) -> None:
+        """ Test that the task corpora can be reused for multiple models. """
+        evaluator = self._create_evaluator()
+        all_results = list(evaluator.run_models(iter(self.models)))
+
+        self.assertEqual(len(all_results), len(self.models))
+        for model, results in zip(self.models, all_results):
+            self.assertEqual(results, self._create_evaluator(model).run())
+
+        self.assertNotEqual(all_results[0], all_results[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+import os
+import shutil
+import unittest
+from typing import Any
+from unittest.mock import patch
+
+import torch
+
+from diagnnose.activations.selection_funcs import final_token, return_all
+from diagnnose.corpus import Corpus
+from diagnnose.syntax.tasks.task import SyntaxEvalTask
+from diagnnose.utils.misc import suppress_print
+
+from .test_utils import DummyTokenizer, create_dummy_model, create_task_corpus
+
+# GLOBALS
+ACTIVATIONS_DIR = "test/test_data"
+NUM_TEST_ITEMS = 20
+
+
+class TestSyntaxEvalTask(unittest.TestCase):
+    """ Test the joint extraction of the final hidden states of a task. """
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        if not os.path.exists(ACTIVATIONS_DIR):
+            os.makedirs(ACTIVATIONS_DIR)
+
+        torch.manual_seed(0)
+        cls.model = create_dummy_model(ACTIVATIONS_DIR, [8, 8])
+        cls.tokenizer = DummyTokenizer()
+
+        pairs_path = os.path.join(ACTIVATIONS_DIR, "pairs.tsv")
+        create_task_corpus(pairs_path, NUM_TEST_ITEMS, counter_sen=True)
+        header = ["sen", "counter_sen", "token"]
+        cls.pairs_task = cls._create_task(pairs_path, header=header)
+        # Counter sentences are tokenized as well, as done by the Marvin task.
+        cls.pairs_task.corpora["pairs"] = Corpus.create(
+            pairs_path,
+            header=header,
+            tokenize_columns=["sen", "counter_sen"],
+            tokenizer=cls.tokenizer,
+        )
+
+        tokens_path = os.path.join(ACTIVATIONS_DIR, "tokens.tsv")
+        create_task_corpus(tokens_path, NUM_TEST_ITEMS, counter_sen=False, seed=1)
+        cls.tokens_task = cls._create_task(tokens_path)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        if os.path.exists(ACTIVATIONS_DIR):
+            shutil.rmtree(ACTIVATIONS_DIR)
+
+    @classmethod
+    def _create_task(cls, path: str, **config: Any) -> SyntaxEvalTask:
+        return SyntaxEvalTask(
+            cls.model,
+            cls.tokenizer,
+            ignore_unk=False,
+            use_full_model_probs=True,
+            path=path,
+            **config,
+        )
+
+    @suppress_print
+    def test_joint_final_hidden(self) -> None:
+        """ Test the joint extraction against a separate pass per column. """
+        corpus = self.pairs_task.corpora["pairs"]
+        sen_columns = [(corpus, "sen"), (corpus, "counter_sen")]
+
+        final_hidden = self.pairs_task.calc_joint_final_hidden(sen_columns)
+
+        self.assertEqual(len(final_hidden), 2)
+        for (_, sen_column), activations in zip(sen_columns, final_hidden):
+            separate_activations = self.pairs_task._calc_final_hidden(
+                corpus, final_token(sen_column), sen_column=sen_column
+            )
+            self.assertTrue(
+                torch.allclose(activations, separate_activations, atol=1e-5),
+                f"Final hidden states of {sen_column} differ from a separate pass",
+            )
+
+    @suppress_print
+    def test_results(self) -> None:
+        """ Test that the task results are unchanged by the joint extraction. """
+        for task, subtask in [(self.pairs_task, "pairs"), (self.tokens_task, "tokens")]:
+            corpus = task.corpora[subtask]
+
+            activations = task._calc_final_hidden(corpus, final_token("sen"))
+            counter_activations = None
+            if "counter_sen" in corpus.fields:
+                counter_activations = task._calc_final_hidden(
+                    corpus, final_token("counter_sen"), sen_column="counter_sen"
+                )
+            accuracy = task._calc_accuracy(corpus, activations, counter_activations)
+
+            results = task.run()
+            self.assertEqual(list(results.keys()), [subtask])
+            self.assertAlmostEqual(results[subtask], accuracy)
+
+    @suppress_print
+    def test_single_hidden_state(self) -> None:
+        """ Test that each sentence must yield a single final hidden state. """
+        corpus = self.pairs_task.corpora["pairs"]
+
+        with patch.object(
+            self.pairs_task, "_create_selection_func", return_value=return_all
+        ):
+            with self.assertRaises(AssertionError):
+                self.pairs_task.calc_joint_final_hidden([(corpus, "sen")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,140 @@
+import os
 import pickle
 import random
+from typing import Dict, List, Union
 
 import torch
+from torch import Tensor
+
+from diagnnose.corpus import Corpus
+from diagnnose.models.init_states import set_init_states
+from diagnnose.models.wrappers import ForwardLSTM
+from diagnnose.tokenizer import W2I
+
+# GLOBALS
+VOCAB = [
+    "<unk>",
+    "<eos>",
+    "<pad>",
+    "the",
+    "a",
+    "dog",
+    "dogs",
+    "cat",
+    "cats",
+    "runs",
+    "run",
+    "sees",
+    "see",
+    "big",
+    "small",
+    ".",
+    "and",
+    "ever",
+    "no",
+    "has",
+]
+EMB_SIZE = 6
+
+
+class DummyTokenizer:
+    """ Whitespace tokenizer that maps tokens to their index in VOCAB. """
+
+    def __init__(self) -> None:
+        self.vocab = W2I({w: idx for idx, w in enumerate(VOCAB)})
+        self.unk_token = "<unk>"
+        self.eos_token = "<eos>"
+        self.pad_token = "<pad>"
+        self.mask_token = None
+
+    def encode(self, sen: str, add_special_tokens: bool = True) -> List[int]:
+        return [self.vocab[w] for w in sen.split()]
+
+    def convert_ids_to_tokens(
+        self, ids: Union[int, List[int]]
+    ) -> Union[str, List[str]]:
+        if isinstance(ids, list):
+            return [VOCAB[idx] for idx in ids]
+        return VOCAB[ids]
+
+    def convert_tokens_to_ids(
+        self, tokens: Union[str, List[str]]
+    ) -> Union[int, List[int]]:
+        if isinstance(tokens, list):
+            return [self.vocab[w] for w in tokens]
+        return self.vocab[tokens]
+
+
+def create_state_dict(
+    layer_sizes: List[int], vocab_size: int = len(VOCAB), emb_size: int = EMB_SIZE
+) -> Dict[str, Tensor]:
+    """ Creates a random state dict of a multi-layer LSTM LM. """
+    state_dict = {
+        "encoder.weight": torch.randn(vocab_size, emb_size),
+        "decoder.weight": torch.randn(vocab_size, layer_sizes[-1]),
+        "decoder.bias": torch.randn(vocab_size),
+    }
+
+    input_size = emb_size
+    for layer, nhid in enumerate(layer_sizes):
+        state_dict[f"rnn.weight_ih_l{layer}"] = torch.randn(4 * nhid, input_size)
+        state_dict[f"rnn.weight_hh_l{layer}"] = torch.randn(4 * nhid, nhid)
+        state_dict[f"rnn.bias_ih_l{layer}"] = torch.randn(4 * nhid)
+        state_dict[f"rnn.bias_hh_l{layer}"] = torch.randn(4 * nhid)
+        input_size = nhid
+
+    return state_dict
+
+
+def create_dummy_model(model_dir: str, layer_sizes: List[int]) -> ForwardLSTM:
+    """ Creates a ForwardLSTM with random weights and zero init states. """
+    state_dict_path = os.path.join(model_dir, "model.pt")
+    torch.save(create_state_dict(layer_sizes), state_dict_path)
+
+    model = ForwardLSTM(state_dict_path)
+    set_init_states(model)
+
+    return model
+
+
+def create_dummy_corpus(
+    corpus_dir: str,
+    tokenizer: DummyTokenizer,
+    num_sentences: int,
+    max_sen_len: int,
+    seed: int = 0,
+) -> Corpus:
+    """ Creates a corpus of random sentences over the dummy vocabulary. """
+    rng = random.Random(seed)
+    words = VOCAB[3:]
+
+    corpus_path = os.path.join(corpus_dir, "corpus.txt")
+    with open(corpus_path, "w") as f:
+        for _ in range(num_sentences):
+            sen_len = rng.randint(1, max_sen_len)
+            f.write(" ".join(rng.choice(words) for _ in range(sen_len)) + "\n")
+
+    return Corpus.create(corpus_path, tokenizer=tokenizer)
+
+
+def create_task_corpus(
+    path: str, num_items: int, counter_sen: bool, seed: int = 0
+) -> None:
+    """ Creates a task corpus of sentence pairs that differ in their
+    final token, or of sentences with a token and counter token.
+    """
+    rng = random.Random(seed)
+    words = VOCAB[3:]
+
+    with open(path, "w") as f:
+        for _ in range(num_items):
+            prefix = [rng.choice(words) for _ in range(rng.randint(1, 6))]
+            sen = " ".join(prefix + [rng.choice(words)])
+            if counter_sen:
+                counter = " ".join(prefix + [rng.choice(words)])
+            else:
+                counter = rng.choice(words)
+            f.write("\t".join([sen, counter, rng.choice(words)]) + "\n")
 
 
 def create_and_dump_dummy_activations(
@@ -77,12 +210,9 @@ def create_and_dump_dummy_activations(
     with open(f"{activations_dir}/corpus.tsv", "w") as f:
         f.write("\n".join(corpus))
 
-    # Create a new activation ranges file, indexed by non-consecutive keys
-    with open(f"{activations_dir}/ranges.pickle", "wb") as f:
-        ranges = {}
-        for i in range(num_sentences):
-            ranges[(i + 1) ** 2] = sen_lens[i]
-        pickle.dump(ranges, f)
+    # Create a new activation ranges file, as stored by older versions of the library
+    with open(f"{activations_dir}/activation_ranges.pickle", "wb") as f:
+        pickle.dump(sen_lens, f)
 
     return num_labels
 